@@ -0,0 +1,241 @@
+import json
+import time
+import asyncio
+from conversation import (
+    BATCH_UNSUPPORTED_STATUS, batch_idempotency_key, encode_body, gateway_messages, idempotency_key,
+    pack_conversations
+)
+from gateway_limiter import GatewayError, RetryPolicy, parse_retry_after
+import metrics
+
+DEFAULT_BASE_URL = "https://conversation-gateway.flowgpt.com/"
+
+
+class _AiohttpTransport:
+    """HTTP/1.1 连接池（aiohttp），高并发下开销明显低于 httpx"""
+
+    def __init__(self, headers, max_connections, timeout, connect_timeout):
+        import aiohttp
+        self._aiohttp = aiohttp
+        self.headers = headers
+        self.max_connections = max_connections
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.session = None
+
+    async def post(self, url, body, headers=None):
+        """发送已序列化的请求体，返回 (状态码, 响应体文本, Retry-After 头)"""
+        # ClientSession 需要在事件循环中创建
+        if self.session is None:
+            self.session = self._aiohttp.ClientSession(
+                headers=self.headers,
+                timeout=self.timeout,
+                connector=self._aiohttp.TCPConnector(limit=self.max_connections)
+            )
+        try:
+            async with self.session.post(url, data=body, headers=headers) as response:
+                return response.status, await response.text(), response.headers.get('Retry-After')
+        except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise GatewayError(f"{url} failed: {e!r}") from e
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+
+class _HttpxTransport:
+    """HTTP/2（httpx），多个请求在少量连接上多路复用"""
+
+    def __init__(self, headers, max_connections, timeout, connect_timeout):
+        import httpx
+        self._httpx = httpx
+        self.client = httpx.AsyncClient(
+            http2=True,
+            headers=headers,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=httpx.Timeout(timeout, connect=connect_timeout)
+        )
+
+    async def post(self, url, body, headers=None):
+        try:
+            response = await self.client.post(url, content=body, headers=headers)
+        except self._httpx.TransportError as e:
+            raise GatewayError(f"{url} failed: {e!r}") from e
+        return response.status_code, response.text, response.headers.get('Retry-After')
+
+    async def close(self):
+        await self.client.aclose()
+
+
+class AsyncConversationAPI:
+    """基于 asyncio 的会话网关客户端，接口与 ConversationAPI 保持一致
+
+    所有请求共享一个连接池（max_connections 限制连接数），每个请求都有超时。
+    默认使用 aiohttp（HTTP/1.1 keep-alive）；http2=True 时改用 httpx 的 HTTP/2 多路复用。
+    update_conversations / get_conversations_info 把多个会话合并到批量接口，网关不支持时退回逐个请求。
+    传入 AsyncAdaptiveLimiter 时按网关的响应情况自适应限流；429/5xx/超时按 retry_policy 重试。
+    用法：
+
+        async with AsyncConversationAPI() as api:
+            info = await api.get_conversation_info(conversation_id)
+    """
+
+    def __init__(self, base_url=DEFAULT_BASE_URL, max_connections=100, http2=False, timeout=30.0, connect_timeout=5.0,
+                 limiter=None, retry_policy=None, compress=True, batch_max_bytes=1 << 20, batch_max_messages=1000):
+        """
+        Args:
+            max_connections: 连接池上限
+            http2: 使用 HTTP/2（需要 httpx[http2]），否则使用 aiohttp
+            timeout: 单个请求的总超时（秒）
+            connect_timeout: 建立连接的超时（秒）
+            limiter: AsyncAdaptiveLimiter，为 None 时不限流
+            retry_policy: 重试策略，默认 RetryPolicy()
+            compress: 用 gzip 压缩请求体；网关返回 415 时自动关闭
+            batch_max_bytes: 批量更新时每个请求体（压缩前）的大小上限
+            batch_max_messages: 批量更新时每个请求的消息数上限
+        """
+        self.base_url = base_url.rstrip('/')
+        self.headers = {
+            'Content-Type': 'application/json'
+        }
+        transport_class = _HttpxTransport if http2 else _AiohttpTransport
+        self.transport = transport_class(self.headers, max_connections, timeout, connect_timeout)
+        self.limiter = limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.compress = compress
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_max_messages = batch_max_messages
+        self.batch_supported = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.transport.close()
+
+    async def get_conversation_info(self, business_id, cursor=None, length=10, all_main_data=True):
+        payload = {
+            "businessId": business_id,
+            "businessType": "conversation",
+            "cursor": cursor,
+            "length": length,
+            "allMainData": all_main_data
+        }
+
+        return await self._post("info", payload)
+
+    async def get_conversations_info(self, business_ids, length=1, all_main_data=False):
+        """与 ConversationAPI.get_conversations_info 相同"""
+        business_ids = list(business_ids)
+        if self.batch_supported is not False:
+            payload = {
+                "businessIds": business_ids,
+                "businessType": "conversation",
+                "length": length,
+                "allMainData": all_main_data
+            }
+            try:
+                result = await self._post("batchInfo", payload)
+                self.batch_supported = True
+                return result["results"]
+            except GatewayError as e:
+                if self.batch_supported or e.status not in BATCH_UNSUPPORTED_STATUS:
+                    raise
+                self.batch_supported = False
+        infos = await asyncio.gather(*(
+            self.get_conversation_info(business_id, length=length, all_main_data=all_main_data)
+            for business_id in business_ids
+        ))
+        return dict(zip(business_ids, infos))
+
+    async def update_conversations(self, conversations):
+        """与 ConversationAPI.update_conversations 相同"""
+        conversations = list(conversations)
+        if self.batch_supported is not False:
+            results = []
+            try:
+                for batch in pack_conversations(conversations, self.batch_max_bytes, self.batch_max_messages):
+                    payload = {
+                        "businessType": "conversation",
+                        "conversations": [
+                            {"businessId": business_id, "messages": gateway_messages(messages)}
+                            for business_id, messages in batch
+                        ]
+                    }
+                    results.append(await self._post("batchUpdate", payload, batch_idempotency_key(batch)))
+                    self.batch_supported = True
+                return results
+            except GatewayError as e:
+                if self.batch_supported or e.status not in BATCH_UNSUPPORTED_STATUS:
+                    raise
+                self.batch_supported = False
+        return list(await asyncio.gather(*(
+            self.update_conversation(business_id, messages) for business_id, messages in conversations
+        )))
+
+    async def update_conversation(self, business_id, messages):
+        batch_size = 1000
+        if len(messages) <= batch_size:
+            return await self._post_update(business_id, messages)
+
+        results = []
+        for i in range(0, len(messages), batch_size):
+            results.append(await self._post_update(business_id, messages[i:i + batch_size]))
+        return results
+
+    async def _post_update(self, business_id, messages):
+        payload = {
+            "businessId": business_id,
+            "businessType": "conversation",
+            "messages": gateway_messages(messages)
+        }
+
+        return await self._post("update", payload, idempotency_key(business_id, messages))
+
+    async def _post(self, path, payload, key=None):
+        """与 ConversationAPI._post 相同：限流、退避重试，最终失败抛出 GatewayError"""
+        headers = {} if key is None else {'Idempotency-Key': key}
+        attempt = 0
+        while True:
+            try:
+                return await self._send(path, payload, headers)
+            except GatewayError as e:
+                if e.status == 415 and self.compress:
+                    self.compress = False
+                    continue
+                if not self.retry_policy.should_retry(attempt, e):
+                    raise
+                await asyncio.sleep(self.retry_policy.delay(attempt, e.retry_after))
+                attempt += 1
+
+    async def _send(self, path, payload, headers):
+        # 先序列化：编码出错时还没有占用限流器的名额
+        data, encoding = encode_body(payload, self.compress)
+        overloaded = throttled = acquired = False
+        status = 'error'
+        try:
+            if self.limiter is not None:
+                await self.limiter.acquire()
+                acquired = True
+            start = time.monotonic()
+            status, body, retry_after = await self.transport.post(f"{self.base_url}/{path}", data, {**headers, **encoding})
+            if status >= 400:
+                raise GatewayError(
+                    f"{path} returned {status}: {body[:200]}",
+                    status=status,
+                    retry_after=parse_retry_after(retry_after)
+                )
+            return json.loads(body)
+        except GatewayError as e:
+            throttled = e.status == 429
+            overloaded = e.retryable and not throttled
+            raise
+        finally:
+            # 等待名额时被取消或出错的请求没有发出，也没有名额需要归还
+            if acquired or self.limiter is None:
+                latency = time.monotonic() - start
+                metrics.GATEWAY_REQUEST_SECONDS.observe(latency, endpoint=path, status=status)
+            if acquired:
+                await self.limiter.release(latency, error=overloaded, throttled=throttled)
@@ -0,0 +1,235 @@
+import os
+import socket
+import asyncio
+import argparse
+import threading
+from db_manager import DatabaseManager
+from async_conversation import AsyncConversationAPI, DEFAULT_BASE_URL
+from conversation import ledger_entry
+from gateway_limiter import AsyncAdaptiveLimiter
+from json_stream import iter_batches
+import metrics
+
+CONVERSATION_GROUP_SIZE = 100
+# 台账、标记与认领等数据库写入同时占用的连接数上限；另外每个迁移中的用户在读取线程中占用一个流式连接
+DB_WRITE_CONNECTIONS = 4
+
+
+def required_connections(user_concurrency: int) -> int:
+    """AsyncMigrator 同时占用的数据库连接数上限，用于设置连接池大小"""
+    return user_concurrency + DB_WRITE_CONNECTIONS
+
+
+async def iterate_in_thread(iterable_factory, maxsize: int = 100):
+    """在专用的后台线程中运行同步生成器（如数据库流式读取），结果逐个交给事件循环
+
+    生产线程通过 call_soon_threadsafe 放入 asyncio.Queue，事件循环等待时不占用默认线程池，
+    不会与 asyncio.to_thread 的数据库写入争抢线程。消费方取消或提前关闭时通知生产线程停止，
+    并关闭同步生成器，释放其占用的流式数据库连接。
+
+    Args:
+        iterable_factory: 无参函数，返回要迭代的同步可迭代对象
+        maxsize: 线程与事件循环之间的缓冲区大小，消费慢时生产线程会阻塞
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+    slots = threading.BoundedSemaphore(maxsize)
+    stopped = threading.Event()
+    finished = object()
+
+    def deliver(item):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, item)
+        except RuntimeError:
+            # 事件循环已关闭，没有消费方了
+            stopped.set()
+
+    def produce():
+        iterator = None
+        try:
+            iterator = iter(iterable_factory())
+            for item in iterator:
+                # 缓冲区满时等待消费，每隔一段时间检查消费方是否已停止
+                while not slots.acquire(timeout=0.5):
+                    if stopped.is_set():
+                        return
+                if stopped.is_set():
+                    return
+                deliver(item)
+            deliver(finished)
+        except Exception as e:
+            deliver(e)
+        finally:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = await items.get()
+            if item is finished:
+                return
+            if isinstance(item, Exception):
+                raise item
+            slots.release()
+            yield item
+    finally:
+        stopped.set()
+
+
+class AsyncMigrator:
+    """用单个事件循环迁移会话：所有用户的会话组共享一个全局并发上限，取代 10 × 5 的嵌套线程池"""
+
+    def __init__(self, db: DatabaseManager, api: AsyncConversationAPI, concurrency: int = 20,
+                 user_concurrency: int = 20):
+        """
+        Args:
+            concurrency: 全局同时处理的会话组数（每组 CONVERSATION_GROUP_SIZE 个会话）
+            user_concurrency: 同时迁移的用户数；超过 db 连接池能同时提供的读取连接数时按连接池下调，
+                否则读取与写入争抢连接会等到连接池超时
+        """
+        self.db = db
+        self.api = api
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.db_writes = asyncio.Semaphore(DB_WRITE_CONNECTIONS)
+        if db.pool_capacity is not None and required_connections(user_concurrency) > db.pool_capacity:
+            limited = max(1, db.pool_capacity - DB_WRITE_CONNECTIONS)
+            print(f"数据库连接池只有 {db.pool_capacity} 个连接，同时迁移的用户数从 {user_concurrency} 降为 {limited}")
+            user_concurrency = limited
+        self.user_concurrency = user_concurrency
+
+    async def _write(self, fn, *args):
+        """在线程中执行数据库写入，同时进行的写入不超过 DB_WRITE_CONNECTIONS 个"""
+        async with self.db_writes:
+            return await asyncio.to_thread(fn, *args)
+
+    async def process_conversations(self, conversations: list, user_id: str):
+        """处理一组会话：台账中已有的会话直接追加推送新消息；台账未命中的会话一次 /batchInfo 查询，
+        不存在的装箱成 /batchUpdate 请求。确认在网关上后与台账一起把消息标记为已处理"""
+        conversation_ids = [conversation["conversationId"] for conversation in conversations]
+        messages = {conversation["conversationId"]: conversation["messages"] for conversation in conversations}
+        ledgers = {conversation["conversationId"]: conversation["ledger"] for conversation in conversations}
+        unknown = [conversation_id for conversation_id in conversation_ids if ledgers[conversation_id] is None]
+        with metrics.span('lookup'):
+            infos = await self.api.get_conversations_info(unknown) if unknown else {}
+        existing = {conversation_id for conversation_id in unknown if infos.get(conversation_id, {}).get('messages')}
+        pending = [conversation_id for conversation_id in conversation_ids if conversation_id not in existing]
+        if pending:
+            with metrics.span('push'):
+                res = await self.api.update_conversations([(conversation_id, messages[conversation_id]) for conversation_id in pending])
+            print(f"Updated {len(pending)}/{len(conversations)} conversations in {len(res)} requests")
+        with metrics.span('ledger'):
+            await self._write(self.db.record_pushed_conversations, user_id, [
+                ledger_entry(conversation_id, ledgers[conversation_id], messages[conversation_id])
+                for conversation_id in conversation_ids
+            ], [message.id for conversation_id in conversation_ids for message in messages[conversation_id]])
+
+    async def _process_with_limit(self, conversations: list, user_id: str):
+        try:
+            return await self.process_conversations(conversations, user_id)
+        finally:
+            self.semaphore.release()
+
+    async def migrate_one_user(self, user_id: str):
+        print(f"Processing conversations for user {user_id}")
+        tasks = []
+        sizes = []
+        # 先取得并发名额再创建任务，读取速度快于发送时自然阻塞数据库读取
+        groups = iterate_in_thread(
+            lambda: iter_batches(self.db.iter_user_conversation_deltas(user_id), CONVERSATION_GROUP_SIZE)
+        )
+        try:
+            async for group in groups:
+                await self.semaphore.acquire()
+                tasks.append(asyncio.create_task(self._process_with_limit(group, user_id)))
+                sizes.append(len(group))
+        finally:
+            # 读取中途被取消或出错时立即让读取线程停止，归还流式连接
+            await groups.aclose()
+
+        # 每组推送后已与台账一起标记；只标记本次读出并推送的消息，读取之后才导入的消息留到下次迁移
+        failed = 0
+        for size, result in zip(sizes, await asyncio.gather(*tasks, return_exceptions=True)):
+            if isinstance(result, Exception):
+                print(f"Error processing conversations: {result}")
+                failed += size
+
+        total = sum(sizes)
+        if failed:
+            raise RuntimeError(f"{failed}/{total} conversations failed for user {user_id}")
+        print(f"Completed processing user {user_id}: {total - failed}/{total} conversations")
+
+    async def _migrate_claimed_user(self, user_id: str) -> bool:
+        """迁移认领到的用户；成功时由 run() 与同时完成的用户一起标记为已迁移，失败时在这里结束认领"""
+        try:
+            with metrics.span('migrate_user'):
+                await self.migrate_one_user(user_id)
+            return True
+        except Exception as exc:
+            print(f"Error processing user: {exc}")
+            await self._write(self.db.complete_user_migration, user_id, False)
+            return False
+
+    async def _complete_users(self, user_ids: list):
+        """一条语句把这些用户标记为已迁移，再结束认领；标记失败时认领超时后重新迁移（只剩新消息）"""
+        if not user_ids:
+            return
+        try:
+            await self._write(self.db.mark_users_as_migrated, user_ids)
+        except Exception as exc:
+            print(f"标记 {len(user_ids)} 个用户为已迁移时出错: {exc}")
+            return
+        for user_id in user_ids:
+            await self._write(self.db.complete_user_migration, user_id)
+
+    async def run(self, worker_id: str) -> int:
+        """持续从迁移队列认领用户，始终保持 user_concurrency 个用户在处理中"""
+        queued = await self._write(self.db.enqueue_users_for_migration)
+        print(f"迁移队列新增 {queued} 个用户")
+
+        running = {}
+        migrated = 0
+        exhausted = False
+        while True:
+            if not exhausted and len(running) < self.user_concurrency:
+                users = await self._write(self.db.claim_users, self.user_concurrency - len(running), worker_id)
+                exhausted = not users
+                running.update({asyncio.create_task(self._migrate_claimed_user(user_id)): user_id for user_id in users})
+            if not running:
+                return migrated
+            done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            # 同时完成的用户一起标记
+            await self._complete_users([running[task] for task in done if task.result()])
+            for task in done:
+                del running[task]
+            migrated += len(done)
+
+
+async def main(args):
+    # 常驻连接按迁移所需的连接数设置，临时连接留给指标端点等零散查询
+    db = DatabaseManager(pool_size=required_connections(args.user_concurrency))
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    metrics.serve_from_env()
+    metrics.QUEUE_DEPTH.set_function(lambda: db.queue_depth('migration'), queue='migration')
+    report = metrics.CycleReport()
+    limiter = AsyncAdaptiveLimiter(rate=args.rate, concurrency=10, max_concurrency=args.max_connections)
+    async with AsyncConversationAPI(args.base_url, max_connections=args.max_connections, http2=args.http2,
+                                    limiter=limiter) as api:
+        migrator = AsyncMigrator(db, api, concurrency=args.concurrency, user_concurrency=args.user_concurrency)
+        migrated = await migrator.run(worker_id)
+    print(f"本次共处理 {migrated} 个用户，限流器状态: {limiter.snapshot()}")
+    print(report)
+    if os.getenv('METRICS_SNAPSHOT'):
+        metrics.dump_snapshot(os.getenv('METRICS_SNAPSHOT'))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="基于 asyncio 的会话迁移")
+    parser.add_argument('--base-url', default=DEFAULT_BASE_URL)
+    parser.add_argument('--concurrency', type=int, default=20, help="全局同时处理的会话组数")
+    parser.add_argument('--user-concurrency', type=int, default=20, help="同时迁移的用户数")
+    parser.add_argument('--max-connections', type=int, default=100, help="HTTP 连接池上限")
+    parser.add_argument('--rate', type=float, default=50, help="初始请求速率（请求/秒），之后按网关反馈自适应调整")
+    parser.add_argument('--http2', action='store_true', help="使用 HTTP/2 多路复用（需要 httpx[http2]）")
+    asyncio.run(main(parser.parse_args()))
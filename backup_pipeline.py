@@ -0,0 +1,426 @@
+import os
+import queue
+import shutil
+import threading
+import multiprocessing
+import boto3
+from itertools import count, islice
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from ingest_checkpoint import BackupPosition, IngestCheckpoint
+from json_stream import JsonArrayReader, iter_batches
+from message_loader import LoadStats, create_message_loader, message_row, skip_old_rows
+from s3_stream import LocalBackupFile, S3BackupStream
+import metrics
+
+# 收尾线程一次最多合并标记的用户数（只合并队列中已在等待的任务）
+FINALIZE_BATCH_SIZE = 20
+
+_batch_queue = None
+_s3_client = None
+
+
+def _init_parse_worker(batch_queue):
+    global _batch_queue
+    _batch_queue = batch_queue
+
+
+def _worker_s3_client():
+    """解析进程内复用的 S3 客户端（boto3 客户端不能跨进程传递）"""
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+def parse_backup_file(job_id: int, file_path: str, user_id: str, batch_size: int,
+                      high_water_marks: dict = None, resume: BackupPosition = None) -> tuple:
+    """在解析进程中运行：流式解析备份文件，按批次把 (job_id, 序号, 行元组, 续做位置) 放入共享队列
+
+    Args:
+        high_water_marks: 增量导入时各会话已入库的最新 createdAt，早于它的消息不放入队列
+        resume: 从检查点记录的位置续做
+    Returns:
+        (放入队列的批次数, 早于高水位而跳过的消息数)
+    """
+    resume = resume or BackupPosition()
+    with LocalBackupFile(file_path, resume.byte_offset) as backup:
+        return _queue_batches(job_id, backup.text, user_id, batch_size, high_water_marks, resume)
+
+
+def parse_s3_backup(job_id: int, bucket: str, key: str, user_id: str, batch_size: int,
+                    high_water_marks: dict = None, resume: BackupPosition = None) -> tuple:
+    """在解析进程中运行：边从 S3 下载边解析备份，不写临时文件；参数与返回值同 parse_backup_file"""
+    resume = resume or BackupPosition()
+    with S3BackupStream(_worker_s3_client(), bucket, key, size=0, offset=resume.byte_offset) as backup:
+        return _queue_batches(job_id, backup.text, user_id, batch_size, high_water_marks, resume)
+
+
+def _queue_batches(job_id: int, text, user_id: str, batch_size: int, high_water_marks: dict,
+                   resume: BackupPosition) -> tuple:
+    reader = JsonArrayReader(text, start_offset=resume.byte_offset)
+    records = resume.records
+    batches = 0
+    skipped = 0
+    for batch in iter_batches(islice(reader, resume.skip_records, None), batch_size):
+        records += len(batch)
+        rows = [message_row(message, user_id) for message in batch]
+        if high_water_marks:
+            rows = skip_old_rows(rows, high_water_marks)
+            skipped += len(batch) - len(rows)
+            if not rows:
+                continue
+        _batch_queue.put((job_id, batches, rows, BackupPosition(reader.tell(), 0, records)))
+        batches += 1
+    return batches, skipped
+
+
+@dataclass
+class _Job:
+    job_id: int
+    user_id: str
+    backup_key: str
+    # 选中用户时列举到的全部备份，成功后整体归档
+    listed_keys: list
+    checkpoint: IngestCheckpoint
+    download_dir: str = None
+    parsed: bool = False
+    expected_batches: int = 0
+    committed_batches: int = 0
+    failed: bool = False
+    finalized: bool = False
+    stats: LoadStats = field(default_factory=LoadStats)
+    # 多个写库线程乱序提交：next_seq 之前的批次都已提交，committed_position 为其续做位置，
+    # out_of_order 为之后已提交批次的续做位置；saved_records 为已写入（或正在写入）检查点的位置
+    next_seq: int = 0
+    committed_position: BackupPosition = None
+    out_of_order: dict = field(default_factory=dict)
+    saved_records: int = -1
+
+    def checkpoint_after(self, seq: int, position: BackupPosition):
+        """调用方需持有 jobs_lock：与序号为 seq 的批次一起提交的续做位置，不比已记录的位置更新时返回 None
+
+        seq 之前的批次都已提交时，位置延伸到 seq 及其后已乱序提交的批次；
+        否则只能记录已连续提交的前缀，不能越过仍在写入中的批次。
+        """
+        if seq == self.next_seq:
+            seq += 1
+            while seq in self.out_of_order:
+                position = self.out_of_order[seq]
+                seq += 1
+        else:
+            position = self.committed_position
+        if position is None or position.records <= self.saved_records:
+            return None
+        self.saved_records = position.records
+        return position
+
+    def mark_committed(self, seq: int, position: BackupPosition):
+        """调用方需持有 jobs_lock；已连续提交的前缀向后延伸的字节数计入导入读取的字节数"""
+        previous = self.committed_position or self.checkpoint.position
+        self.out_of_order[seq] = position
+        while self.next_seq in self.out_of_order:
+            self.committed_position = self.out_of_order.pop(self.next_seq)
+            self.next_seq += 1
+        if self.committed_position is not None:
+            metrics.INGEST_READ_BYTES.inc(max(self.committed_position.byte_offset - previous.byte_offset, 0))
+
+
+class BackupPipeline:
+    """多用户并发处理备份：S3 列举、下载、解析、写库四个阶段流水线执行
+
+    每个阶段有独立的并发数，阶段之间通过有界队列衔接，下游处理不过来时上游自动阻塞。
+    JSON 解析是 CPU 密集型，在进程池中执行；写库线程共享 DatabaseManager 的连接池。
+    stream_s3 为 True 时下载与解析合并在解析进程中进行：S3 对象边下载边解析，不写临时文件。
+    每批消息提交时在同一事务中记录文件的检查点；中断后重新运行时，未完成的文件从 S3 只读取剩余部分续做。
+    """
+
+    def __init__(self, manager, download_workers: int = 4, parse_workers: int = None, db_writers: int = 4,
+                 batch_size: int = 5000, queue_size: int = None, use_inventory: bool = False, sync: bool = False,
+                 stream_s3: bool = False):
+        """
+        Args:
+            manager: S3BackupManager，提供 S3 客户端、列举和移动方法
+            download_workers: 并发下载线程数
+            parse_workers: 解析进程数，默认 CPU 核数
+            db_writers: 写库线程数，应不超过数据库连接池大小
+            batch_size: 每批写入的消息条数
+            queue_size: 待写入批次队列的容量，默认 db_writers * 4
+            use_inventory: 从本地 S3 清单获取待处理备份
+            sync: 已处理过的用户有新备份时也导入，只写入各会话高水位之后的消息
+            stream_s3: 解析进程直接从 S3 流式读取备份，不经过本地下载目录
+        """
+        self.manager = manager
+        self.db_manager = manager.db_manager
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers or os.cpu_count() or 1
+        self.db_writers = db_writers
+        self.batch_size = batch_size
+        self.queue_size = queue_size or db_writers * 4
+        self.use_inventory = use_inventory
+        self.sync = sync
+        self.stream_s3 = stream_s3
+
+        # 未收尾的任务；收尾后移除，长时间运行的进程中不会无限增长
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self._job_ids = count()
+        self.processed_count = 0
+
+    def run(self) -> int:
+        """处理所有待处理用户，返回成功处理的用户数"""
+        mp_context = multiprocessing.get_context('spawn')
+        self.download_queue = queue.Queue(maxsize=self.download_workers * 2)
+        self.finalize_queue = queue.Queue()
+        self.batch_queue = mp_context.Queue(maxsize=self.queue_size)
+        # 限制已提交但未解析完的文件数，避免下载线程无限堆积解析任务
+        self.parse_slots = threading.Semaphore(self.parse_workers * 2)
+        self.parse_pool = ProcessPoolExecutor(
+            max_workers=self.parse_workers,
+            mp_context=mp_context,
+            initializer=_init_parse_worker,
+            initargs=(self.batch_queue,)
+        )
+        queues = {'download': self.download_queue, 'parsed_batches': self.batch_queue, 'finalize': self.finalize_queue}
+        for name, depth_queue in queues.items():
+            metrics.QUEUE_DEPTH.set_function(depth_queue.qsize, queue=name)
+
+        writers = self._start_threads(self._write_batches, self.db_writers, 'db-writer')
+        finalizer = self._start_threads(self._finalize_jobs, 1, 'finalizer')
+        downloaders = self._start_threads(self._download_backups, self.download_workers, 'downloader')
+        lister = self._start_threads(self._list_backups, 1, 'lister')
+
+        try:
+            self._join(lister)
+            self._join(downloaders)
+            self.parse_pool.shutdown(wait=True)
+            for _ in writers:
+                self.batch_queue.put(None)
+            self._join(writers)
+        finally:
+            self.finalize_queue.put(None)
+            self._join(finalizer)
+            self.batch_queue.close()
+            for name in queues:
+                metrics.QUEUE_DEPTH.remove(queue=name)
+
+        print(f"流水线处理完成，成功处理 {self.processed_count} 个用户")
+        return self.processed_count
+
+    @staticmethod
+    def _start_threads(target, count: int, name: str):
+        threads = [threading.Thread(target=target, name=f"{name}-{i}", daemon=True) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    @staticmethod
+    def _join(threads):
+        for thread in threads:
+            thread.join()
+
+    def _list_backups(self):
+        try:
+            pending = self.manager.pending_backups(use_inventory=self.use_inventory, sync=self.sync)
+            for user_id, earliest_backup, listed_keys in metrics.timed_iter(pending, 'list'):
+                if self.manager.stopping.is_set():
+                    # 已进入队列的用户照常处理完，不再列举新的用户
+                    print("收到停止请求，不再列举新的用户")
+                    break
+                self.download_queue.put((user_id, earliest_backup, listed_keys))
+        except Exception as e:
+            print(f"列举用户备份时出错: {e}")
+        finally:
+            for _ in range(self.download_workers):
+                self.download_queue.put(None)
+
+    def _download_backups(self):
+        while True:
+            item = self.download_queue.get()
+            if item is None:
+                return
+            user_id, backup_key, listed_keys = item
+            # 认领在收尾时释放；用户正由事件处理线程导入时跳过
+            if not self.manager.claim_user(user_id):
+                print(f"用户 {user_id} 正在由其他线程导入，跳过")
+                continue
+            try:
+                self._start_job(user_id, backup_key, listed_keys)
+            except Exception as e:
+                # 任何错误只让这个用户失败，下载线程继续消费队列，否则列举线程会阻塞在有界队列上
+                print(f"处理用户 {user_id} 的备份 {backup_key} 时出错: {e}")
+                # 出错时还没有创建任务，不会经过收尾线程
+                self.manager.release_user(user_id)
+
+    def _add_job(self, *args, **kwargs) -> _Job:
+        with self.jobs_lock:
+            job = _Job(next(self._job_ids), *args, **kwargs)
+            self.jobs[job.job_id] = job
+            return job
+
+    def _fail_job(self, job: _Job):
+        """没有提交解析任务的任务直接按失败收尾"""
+        with self.jobs_lock:
+            job.parsed = True
+            job.failed = True
+            self._check_done(job)
+
+    def _start_job(self, user_id: str, backup_key: str, listed_keys: list):
+        """读取检查点并下载备份，然后提交解析任务；出错时已下载的文件由收尾线程清理"""
+        checkpoint, _ = self.manager.load_backup_checkpoint(backup_key)
+        if checkpoint.done:
+            # 上次已全部导入，只差收尾（标记用户、归档）
+            print(f"{backup_key} 已全部导入，跳过")
+            job = self._add_job(user_id, backup_key, listed_keys, checkpoint, parsed=True)
+            with self.jobs_lock:
+                self._check_done(job)
+            return
+        if self.stream_s3 or checkpoint.resuming:
+            # 上次中断的文件只从 S3 读取未完成的部分
+            download_dir = None
+            print(f"Streaming {backup_key}")
+            parse, source = parse_s3_backup, (self.manager.bucket_name, backup_key)
+        else:
+            download_dir = os.path.join(self.manager.download_base_dir, user_id)
+            download_path = os.path.join(download_dir, os.path.basename(backup_key))
+            parse, source = parse_backup_file, (download_path,)
+        job = self._add_job(user_id, backup_key, listed_keys, checkpoint, download_dir)
+
+        try:
+            if download_dir:
+                os.makedirs(download_dir, exist_ok=True)
+                print(f"Downloading {backup_key} to {download_path}")
+                self.manager.download_file(backup_key, download_path)
+
+            high_water_marks = None
+            if self.sync and self.db_manager.is_user_processed(user_id):
+                high_water_marks = self.db_manager.get_ingest_high_water_marks(user_id)
+
+            self.parse_slots.acquire()
+            try:
+                # 解析进程被杀死后进程池不可用（BrokenProcessPool），之后的提交都会在这里失败
+                future = self.parse_pool.submit(
+                    parse, job.job_id, *source, user_id, self.batch_size, high_water_marks, checkpoint.position
+                )
+            except Exception:
+                self.parse_slots.release()
+                raise
+        except Exception as e:
+            print(f"下载或提交解析用户 {user_id} 的备份时出错: {e}")
+            self._fail_job(job)
+            return
+        future.add_done_callback(lambda f, job_id=job.job_id: self._on_parsed(job_id, f))
+
+    def _on_parsed(self, job_id: int, future):
+        self.parse_slots.release()
+        with self.jobs_lock:
+            job = self.jobs[job_id]
+            job.parsed = True
+            try:
+                job.expected_batches, job.stats.skipped = future.result()
+                metrics.INGEST_MESSAGES.inc(job.stats.skipped, result='skipped')
+            except Exception as e:
+                print(f"解析用户 {job.user_id} 的备份时出错: {e}")
+                job.failed = True
+            self._check_done(job)
+
+    def _write_batches(self):
+        message_loader = create_message_loader(self.db_manager.engine)
+        session = self.db_manager.Session()
+        try:
+            while True:
+                item = self.batch_queue.get()
+                if item is None:
+                    return
+                job_id, seq, rows, position = item
+                with self.jobs_lock:
+                    # 任务失败后已收尾移除时，解析进程之前送出的批次直接丢弃
+                    job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                if job.failed:
+                    stats = None
+                else:
+                    with self.jobs_lock:
+                        checkpoint_position = job.checkpoint_after(seq, position)
+                    metrics.INGEST_MESSAGES.inc(len(rows), result='loaded')
+                    try:
+                        with metrics.span('db_commit'), \
+                                metrics.DB_BATCH_COMMIT_SECONDS.time(loader=message_loader.name):
+                            stats = message_loader.load(session, rows)
+                            if checkpoint_position is not None:
+                                self.db_manager.save_ingest_checkpoint(session, job.checkpoint, job.user_id,
+                                                                       checkpoint_position)
+                            session.commit()
+                    except Exception as e:
+                        print(f"写入用户 {job.user_id} 的消息时出错: {e}")
+                        session.rollback()
+                        stats = None
+                with self.jobs_lock:
+                    job.committed_batches += 1
+                    if stats is None:
+                        job.failed = True
+                    else:
+                        job.stats.add(stats)
+                        job.mark_committed(seq, position)
+                    self._check_done(job)
+        finally:
+            session.close()
+
+    def _check_done(self, job: _Job):
+        """调用方需持有 jobs_lock；解析结束且所有批次都已写入（或已失败）后交给收尾线程"""
+        if job.finalized or not job.parsed:
+            return
+        if not job.failed and job.committed_batches < job.expected_batches:
+            return
+        job.finalized = True
+        self.finalize_queue.put(job)
+
+    def _finalize_jobs(self):
+        while True:
+            job = self.finalize_queue.get()
+            if job is None:
+                return
+            # 队列中已在等待的任务一起收尾，整批用户只需一次标记；不为凑满一批而等待
+            jobs = [job]
+            stop = False
+            while len(jobs) < FINALIZE_BATCH_SIZE:
+                try:
+                    job = self.finalize_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if job is None:
+                    stop = True
+                    break
+                jobs.append(job)
+            self._finalize_batch(jobs)
+            if stop:
+                return
+
+    def _finalize_batch(self, jobs: list):
+        finished = []
+        try:
+            for job in jobs:
+                if job.failed:
+                    print(f"用户 {job.user_id} 的备份处理失败")
+                    continue
+                try:
+                    self.db_manager.complete_ingest_checkpoint(job.checkpoint, job.user_id)
+                    finished.append(job)
+                except Exception as e:
+                    print(f"处理用户备份时出错: {e}")
+            try:
+                self.manager.finalize_users([(job.user_id, job.listed_keys) for job in finished])
+                self.processed_count += len(finished)
+                for job in finished:
+                    print(f"用户 {job.user_id} 的备份处理完成，{job.stats}")
+            except Exception as e:
+                print(f"标记 {len(finished)} 个用户为已处理时出错: {e}")
+        finally:
+            for job in jobs:
+                if job.download_dir:
+                    shutil.rmtree(job.download_dir, ignore_errors=True)
+                self.manager.release_user(job.user_id)
+                # 收尾时解析已结束；失败的任务可能还有批次在队列中，写库线程找不到任务时丢弃
+                with self.jobs_lock:
+                    self.jobs.pop(job.job_id, None)
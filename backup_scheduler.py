@@ -0,0 +1,237 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from event_queue import parse_s3_event
+
+
+class BackupScheduler:
+    """事件驱动的导入调度，取代固定 60 秒一轮的全量扫描
+
+    - 事件：消费 S3 ObjectCreated 通知，按用户去重后交给 workers 个线程立即导入该用户最早的备份。
+      导入成功或无需导入的消息删除；失败的消息保留，可见性超时后由队列重新投递。
+      同一用户处理期间收到的新事件在处理完成后再处理一次。
+    - 对账扫描：在单独的线程中启动时与之后每 reconcile_interval 秒执行一次 process_all_backups，补上丢失的事件；
+      扫描期间事件照常接收处理，同一用户由 S3BackupManager.claim_user 保证同时只由一方导入，
+      被扫描占用的用户的事件保留在队列中，重新投递后再处理。
+      未配置事件队列时扫描是唯一的来源：发现新备份后 min_idle 秒即再扫，空闲时间隔逐步翻倍到 max_idle。
+    - 空闲退避：队列为空时长轮询的等待时间从 min_idle 逐步翻倍到 max_idle（SQS 每次最多 20 秒），收到事件后恢复；
+      长轮询有消息到达即返回，退避只减少空转的请求，不增加事件延迟。
+    - stop()：不再接收事件、扫描不再开始新的用户，等待处理中的用户完成（未完成的消息留在队列中）后 run() 返回。
+    """
+
+    def __init__(self, manager, events=None, workers: int = 4, reconcile_interval: float = 3600,
+                 min_idle: float = 1.0, max_idle: float = 60.0, sweep_options: dict = None, snapshot_path: str = None):
+        """
+        Args:
+            manager: S3BackupManager
+            events: SQSEventQueue / SQLiteEventQueue，为 None 时只做扫描
+            workers: 同时处理事件的用户数
+            reconcile_interval: 对账扫描的间隔（秒）
+            min_idle / max_idle: 空闲退避的起止等待时间（秒），也是没有事件队列时扫描间隔的上下限
+            sweep_options: 透传给 process_all_backups 的参数；其中的 sync / stream_s3 / all_backups 同样用于事件
+            snapshot_path: 每次扫描后写入指标的 JSON 快照
+        """
+        self.manager = manager
+        self.db_manager = manager.db_manager
+        self.events = events
+        self.workers = workers
+        self.reconcile_interval = reconcile_interval
+        self.min_idle = min_idle
+        self.max_idle = max_idle
+        self.sweep_options = sweep_options or {}
+        self.snapshot_path = snapshot_path
+        self.processed_count = 0
+
+        self._stopped = threading.Event()
+        # 可重入：信号处理函数中的 stop() 可能打断持有锁的主线程
+        self._lock = threading.RLock()
+        # 处理中的用户 -> 待删除的消息；处理期间又收到事件的用户 -> 这些事件的消息
+        self._in_flight = {}
+        self._followups = {}
+        self._idle_slot = threading.Condition(self._lock)
+
+    def stop(self):
+        """请求优雅退出，可在信号处理函数中调用"""
+        self._stopped.set()
+        self.manager.stopping.set()
+        with self._idle_slot:
+            self._idle_slot.notify_all()
+
+    def run(self) -> int:
+        """运行到 stop() 被调用，返回处理成功的用户数"""
+        if self.events is not None:
+            metrics.QUEUE_DEPTH.set_function(self.events.depth, queue='backup_events')
+        idle = self.min_idle
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='event-ingest')
+        sweeper = threading.Thread(target=self._sweep_loop, name='reconcile-sweep', daemon=True)
+        sweeper.start()
+        try:
+            while not self._stopped.is_set():
+                if self.events is None:
+                    # 扫描在后台线程中进行，主线程只等待停止信号
+                    self._stopped.wait(self.max_idle)
+                    continue
+                if self._poll(idle):
+                    idle = self.min_idle
+                else:
+                    idle = min(idle * 2, self.max_idle)
+        finally:
+            print("调度器停止，等待处理中的用户完成...")
+            sweeper.join()
+            self.executor.shutdown(wait=True)
+            self.manager.archive_worker.stop()
+            if self.events is not None:
+                metrics.QUEUE_DEPTH.remove(queue='backup_events')
+            print(f"调度器已停止，共处理 {self.processed_count} 个用户")
+        return self.processed_count
+
+    def _sweep_loop(self):
+        """扫描线程：启动时先扫一次，之后按间隔重复，直到 stop()"""
+        interval = self.min_idle
+        while not self._stopped.is_set():
+            found = self._sweep()
+            if self.events is not None:
+                interval = self.reconcile_interval
+            elif found:
+                interval = self.min_idle
+            else:
+                interval = min(interval * 2, self.max_idle)
+            if self._stopped.is_set():
+                return
+            print(f"下一次扫描在 {interval:.0f} 秒后")
+            self._stopped.wait(interval)
+
+    def _sweep(self):
+        """执行一次全量扫描，返回处理的用户数；出错时返回 0"""
+        print("\n开始对账扫描...")
+        report = metrics.CycleReport()
+        try:
+            with metrics.span('sweep'):
+                found = self.manager.process_all_backups(**self.sweep_options) or 0
+        except Exception as e:
+            print(f"扫描过程中发生错误: {e}")
+            found = 0
+        with self._lock:
+            self.processed_count += found
+        print(report)
+        if self.snapshot_path:
+            metrics.dump_snapshot(self.snapshot_path)
+        return found
+
+    def _poll(self, wait_seconds: float) -> bool:
+        """接收一批事件并提交处理，返回是否收到了消息；处理线程都在忙时先等待空闲"""
+        with self._idle_slot:
+            while len(self._in_flight) >= self.workers and not self._stopped.is_set():
+                self._idle_slot.wait()
+            free = self.workers - len(self._in_flight)
+        if self._stopped.is_set():
+            return False
+        try:
+            messages = self.events.receive(max_messages=free, wait_seconds=wait_seconds)
+        except Exception as e:
+            print(f"接收备份事件时出错: {e}")
+            self._stopped.wait(self.min_idle)
+            return False
+        if not messages:
+            return False
+
+        users = {}
+        ignored = []
+        for message in messages:
+            user_ids = self._event_users(message.body)
+            if not user_ids:
+                ignored.append(message.receipt)
+            for user_id in user_ids:
+                users.setdefault(user_id, []).append(message.receipt)
+        if ignored:
+            self.events.delete(ignored)
+
+        with self._lock:
+            for user_id, receipts in users.items():
+                if user_id in self._in_flight:
+                    self._followups.setdefault(user_id, []).extend(receipts)
+                else:
+                    self._submit(user_id, receipts)
+        return True
+
+    def _event_users(self, body: str) -> set:
+        """事件对应的用户ID；其他桶、其他前缀或不是备份文件的对象不处理"""
+        try:
+            objects = parse_s3_event(body)
+        except ValueError as e:
+            print(f"忽略无法解析的消息: {e}")
+            return set()
+        prefix = self.manager.base_prefix
+        return {
+            key[len(prefix):].split('/', 1)[0]
+            for bucket, key in objects
+            if bucket == self.manager.bucket_name and key.startswith(prefix) and key.endswith('.json')
+            and '/' in key[len(prefix):]
+        }
+
+    def _submit(self, user_id: str, receipts: list):
+        """调用方需持有 _lock"""
+        self._in_flight[user_id] = receipts
+        future = self.executor.submit(self._process_user, user_id)
+        future.add_done_callback(lambda f, user_id=user_id: self._on_done(user_id, f))
+
+    def _process_user(self, user_id: str) -> bool:
+        """导入用户最早的备份（all_backups 时为全部备份），规则与扫描相同；返回 True 表示消息可以删除"""
+        sync = self.sweep_options.get('sync', False)
+        if not sync and self.db_manager.is_user_processed(user_id):
+            # 重复投递的事件，或备份在导入后才归档
+            return True
+        listed_keys = self.manager.user_backups_in_order(user_id)
+        if not listed_keys:
+            return True
+        with metrics.span('event'):
+            success = self.manager.process_backup(
+                user_id, listed_keys[0], sync=sync, stream_s3=self.sweep_options.get('stream_s3', False),
+                all_backups=self.sweep_options.get('all_backups', False), listed_keys=listed_keys
+            )
+        if success:
+            with self._lock:
+                self.processed_count += 1
+        return success
+
+    def _on_done(self, user_id: str, future):
+        try:
+            success = future.result()
+        except Exception as e:
+            print(f"处理用户 {user_id} 的备份事件时出错: {e}")
+            success = False
+        with self._lock:
+            receipts = self._in_flight.pop(user_id)
+            followups = self._followups.pop(user_id, None)
+            if followups and not self._stopped.is_set():
+                # 处理期间收到的新事件：再处理一次，完成后与本次的消息一并删除
+                self._submit(user_id, receipts + followups)
+                receipts = []
+            self._idle_slot.notify_all()
+        if success and receipts:
+            try:
+                self.events.delete(receipts)
+            except Exception as e:
+                print(f"删除用户 {user_id} 的备份事件时出错: {e}")
+
+
+def scheduler_from_env(manager, events=None) -> BackupScheduler:
+    """按环境变量创建调度器；扫描参数与原来的 main.py 相同"""
+    return BackupScheduler(
+        manager,
+        events=events,
+        workers=int(os.getenv('INGEST_EVENT_WORKERS', '4')),
+        reconcile_interval=float(os.getenv('INGEST_RECONCILE_INTERVAL', '3600')),
+        max_idle=float(os.getenv('INGEST_MAX_IDLE', '60')),
+        sweep_options=dict(
+            pipeline=os.getenv('INGEST_PIPELINE') == '1',
+            use_inventory=os.getenv('USE_S3_INVENTORY') == '1',
+            sync=os.getenv('INGEST_SYNC') == '1',
+            stream_s3=os.getenv('INGEST_STREAM_S3') == '1',
+            parse_workers=int(os.getenv('INGEST_PARSE_WORKERS', '0')) or None,
+            all_backups=os.getenv('INGEST_ALL_BACKUPS') == '1'
+        ),
+        snapshot_path=os.getenv('METRICS_SNAPSHOT')
+    )
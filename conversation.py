@@ -1,13 +1,141 @@
 import requests
 import json
+import gzip
+import time
+import hashlib
+from requests.adapters import HTTPAdapter
+from gateway_limiter import GatewayError, RetryPolicy, parse_retry_after
+import metrics
+
+# 小于该大小的请求体不压缩，gzip 头尾的开销抵消了收益
+COMPRESS_MIN_BYTES = 1024
+# 批量接口返回这些状态码时视为网关不支持批量，退回逐个会话的请求
+BATCH_UNSUPPORTED_STATUS = frozenset({404, 405, 501})
+
+
+def gateway_messages(messages):
+    """把 MessageRecord 序列转换为网关请求中的消息列表，只在构造请求体时调用"""
+    return [message.to_gateway() for message in messages]
+
+
+def idempotency_key(business_id, messages):
+    """同一批消息每次重试使用相同的幂等键，网关据此去重"""
+    digest = hashlib.sha1()
+    for message in messages:
+        digest.update(str(message.id).encode())
+        digest.update(b'\0')
+    return f"{business_id}:{digest.hexdigest()}"
+
+
+def content_hash(messages, previous=None):
+    """已推送内容的链式哈希：previous 为之前已推送部分的哈希，messages 为本次追加的 MessageRecord
+
+    按网关请求中的消息格式计算，与改用 MessageRecord 之前写入台账的哈希一致。
+    """
+    digest = hashlib.sha1((previous or '').encode())
+    digest.update(json.dumps(gateway_messages(messages), sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode())
+    return digest.hexdigest()
+
+
+def ledger_entry(conversation_id, ledger, messages):
+    """推送成功后的迁移台账记录：在原记录基础上累加条数、延续哈希、推进高水位
+
+    Args:
+        ledger: iter_user_conversation_deltas 产出的台账信息，没有记录时为 None
+        messages: 本次推送的 MessageRecord，按 (createdAt, id) 升序
+    Returns:
+        record_pushed_conversations 所需的 (会话ID, 条数, 哈希, 最后 createdAt, 最后 id)；
+        本次只补推了早于高水位的消息时高水位保持不变
+    """
+    last = messages[-1]
+    if ledger is None:
+        return conversation_id, len(messages), content_hash(messages), last.createdAt, last.id
+    created_at, message_id = last.createdAt, last.id
+    if ledger["last_message_id"] is not None and \
+            (ledger["last_created_at"] or '', ledger["last_message_id"]) > (created_at or '', message_id):
+        created_at, message_id = ledger["last_created_at"], ledger["last_message_id"]
+    return (
+        conversation_id,
+        ledger["message_count"] + len(messages),
+        content_hash(messages, ledger["content_hash"]),
+        created_at,
+        message_id
+    )
+
+
+def batch_idempotency_key(batch):
+    digest = hashlib.sha1()
+    for business_id, messages in batch:
+        digest.update(idempotency_key(business_id, messages).encode())
+    return f"batch:{digest.hexdigest()}"
+
+
+def encode_body(payload, compress):
+    """序列化请求体，compress 为 True 且足够大时使用 gzip，返回 (请求体, 额外请求头)"""
+    body = json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode()
+    if compress and len(body) >= COMPRESS_MIN_BYTES:
+        return gzip.compress(body, compresslevel=5), {'Content-Encoding': 'gzip'}
+    return body, {}
+
+
+def pack_conversations(conversations, max_bytes, max_messages):
+    """把多个会话装箱成批：每批消息数不超过 max_messages，序列化后（未压缩）大约不超过 max_bytes
+
+    conversations 为 (business_id, [MessageRecord, ...]) 序列；超出上限的会话会被拆到相邻的多个批次中，
+    网关按 messageId 写入，拆分不影响结果。单条消息超过 max_bytes 时单独成批。
+    产出 [(business_id, messages), ...]
+    """
+    batch = []
+    batch_bytes = 0
+    batch_messages = 0
+    for business_id, messages in conversations:
+        piece = []
+        for message in messages:
+            size = len(json.dumps(message.to_gateway(), separators=(',', ':'), ensure_ascii=False).encode()) + 1
+            if batch_messages >= max_messages or (batch_messages and batch_bytes + size > max_bytes):
+                if piece:
+                    batch.append((business_id, piece))
+                    piece = []
+                yield batch
+                batch, batch_bytes, batch_messages = [], 0, 0
+            piece.append(message)
+            batch_bytes += size
+            batch_messages += 1
+        if piece:
+            batch.append((business_id, piece))
+    if batch:
+        yield batch
+
 
 class ConversationAPI:
-    def __init__(self, base_url="https://conversation-gateway.flowgpt.com/"):
+    def __init__(self, base_url="https://conversation-gateway.flowgpt.com/", pool_maxsize=50, timeout=(5, 30),
+                 limiter=None, retry_policy=None, compress=True, batch_max_bytes=1 << 20, batch_max_messages=1000):
+        """
+        Args:
+            pool_maxsize: 连接池大小，应不小于并发调用的线程数（migrate.py 为 10 × 5）
+            timeout: (连接超时, 读取超时) 秒
+            limiter: AdaptiveLimiter，为 None 时不限流
+            retry_policy: 429/5xx/超时的重试策略，默认 RetryPolicy()
+            compress: 用 gzip 压缩请求体；网关返回 415 时自动关闭
+            batch_max_bytes: 批量更新时每个请求体（压缩前）的大小上限
+            batch_max_messages: 批量更新时每个请求的消息数上限
+        """
         self.base_url = base_url
         self.headers = {
             'Content-Type': 'application/json'
         }
+        self.timeout = timeout
+        self.limiter = limiter
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.compress = compress
+        self.batch_max_bytes = batch_max_bytes
+        self.batch_max_messages = batch_max_messages
+        # None 表示尚未探测，第一次批量请求后确定
+        self.batch_supported = None
         self.session = requests.session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def get_conversation_info(self, business_id, cursor=None, length=10, all_main_data=True):
         payload = {
@@ -18,43 +146,127 @@ class ConversationAPI:
             "allMainData": all_main_data
         }
         
-        response = self.session.post(
-            f"{self.base_url}/info",
-            headers=self.headers,
-            json=payload
-        )
-        return response.json()
+        return self._post("info", payload)
 
-    def update_conversation(self, business_id, messages):
-        batch_size = 1000
-        if len(messages) <= batch_size:
+    def get_conversations_info(self, business_ids, length=1, all_main_data=False):
+        """一次查询多个会话，返回 {business_id: info}；网关不支持批量时逐个查询"""
+        business_ids = list(business_ids)
+        if self.batch_supported is not False:
             payload = {
-                "businessId": business_id,
+                "businessIds": business_ids,
                 "businessType": "conversation",
-                "messages": messages
+                "length": length,
+                "allMainData": all_main_data
             }
-            
-            response = self.session.post(
-                f"{self.base_url}/update",
-                headers=self.headers,
-                json=payload
-            )
-            return response.json()
+            try:
+                result = self._post("batchInfo", payload)
+                self.batch_supported = True
+                return result["results"]
+            except GatewayError as e:
+                if self.batch_supported or e.status not in BATCH_UNSUPPORTED_STATUS:
+                    raise
+                self.batch_supported = False
+        return {business_id: self.get_conversation_info(business_id, length=length, all_main_data=all_main_data)
+                for business_id in business_ids}
+
+    def update_conversations(self, conversations):
+        """把多个会话装箱成若干个批量请求发送，conversations 为 (business_id, [MessageRecord, ...]) 序列
+
+        网关不支持批量时退回 update_conversation 逐个发送。返回各请求的响应列表。
+        """
+        conversations = list(conversations)
+        if self.batch_supported is not False:
+            results = []
+            try:
+                for batch in pack_conversations(conversations, self.batch_max_bytes, self.batch_max_messages):
+                    payload = {
+                        "businessType": "conversation",
+                        "conversations": [
+                            {"businessId": business_id, "messages": gateway_messages(messages)}
+                            for business_id, messages in batch
+                        ]
+                    }
+                    results.append(self._post("batchUpdate", payload, batch_idempotency_key(batch)))
+                    self.batch_supported = True
+                return results
+            except GatewayError as e:
+                if self.batch_supported or e.status not in BATCH_UNSUPPORTED_STATUS:
+                    raise
+                self.batch_supported = False
+        return [self.update_conversation(business_id, messages) for business_id, messages in conversations]
+
+    def update_conversation(self, business_id, messages):
+        batch_size = 1000
+        if len(messages) <= batch_size:
+            return self._post_update(business_id, messages)
         
         results = []
         for i in range(0, len(messages), batch_size):
-            batch_messages = messages[i:i + batch_size]
-            payload = {
-                "businessId": business_id,
-                "businessType": "conversation",
-                "messages": batch_messages
-            }
-            
+            results.append(self._post_update(business_id, messages[i:i + batch_size]))
+        
+        return results
+
+    def _post_update(self, business_id, messages):
+        payload = {
+            "businessId": business_id,
+            "businessType": "conversation",
+            "messages": gateway_messages(messages)
+        }
+        return self._post("update", payload, idempotency_key(business_id, messages))
+
+    def _post(self, path, payload, key=None):
+        """发送请求：经过限流器，429/5xx/超时按退避策略重试，最终失败抛出 GatewayError"""
+        headers = self.headers if key is None else {**self.headers, 'Idempotency-Key': key}
+        attempt = 0
+        while True:
+            try:
+                return self._send(path, payload, headers)
+            except GatewayError as e:
+                if e.status == 415 and self.compress:
+                    # 网关不接受压缩的请求体，之后的请求都不再压缩
+                    self.compress = False
+                    continue
+                if not self.retry_policy.should_retry(attempt, e):
+                    raise
+                time.sleep(self.retry_policy.delay(attempt, e.retry_after))
+                attempt += 1
+
+    def _send(self, path, payload, headers):
+        # 先序列化：编码出错时还没有占用限流器的名额
+        body, encoding = encode_body(payload, self.compress)
+        overloaded = throttled = acquired = False
+        status = 'error'
+        try:
+            if self.limiter is not None:
+                self.limiter.acquire()
+                acquired = True
+            start = time.monotonic()
             response = self.session.post(
-                f"{self.base_url}/update",
-                headers=self.headers,
-                json=payload
+                f"{self.base_url.rstrip('/')}/{path}",
+                headers={**headers, **encoding},
+                data=body,
+                timeout=self.timeout
             )
-            results.append(response.json())
-        
-        return results
\ No newline at end of file
+            status = response.status_code
+            if response.status_code >= 400:
+                raise GatewayError(
+                    f"{path} returned {response.status_code}: {response.text[:200]}",
+                    status=response.status_code,
+                    retry_after=parse_retry_after(response.headers.get('Retry-After'))
+                )
+            return response.json()
+        except (requests.ConnectionError, requests.Timeout) as e:
+            overloaded = True
+            raise GatewayError(f"{path} failed: {e}") from e
+        except GatewayError as e:
+            throttled = e.status == 429
+            overloaded = e.retryable and not throttled
+            raise
+        finally:
+            # 等待名额时被取消或出错的请求没有发出，也没有名额需要归还
+            if acquired or self.limiter is None:
+                latency = time.monotonic() - start
+                metrics.GATEWAY_REQUEST_SECONDS.observe(latency, endpoint=path, status=status)
+            if acquired:
+                # 429 触发立即降速，5xx/超时计入错误率，其余错误（如 400）不影响限流
+                self.limiter.release(latency, error=overloaded, throttled=throttled)
@@ -1,13 +1,66 @@
 import json
 import os
-from datetime import datetime
-from typing import List, Dict
-from sqlalchemy import create_engine, func
+import time
+from itertools import groupby, islice
+from datetime import datetime, timedelta
+from typing import Iterable, List, Dict
+from sqlalchemy import create_engine, func, select, update, exists, literal, or_, and_, any_, bindparam, tuple_, case
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.types import String
 from sqlalchemy.orm import sessionmaker
-from models import Base, Message, ProcessedUser, MigratedUser
+from sqlalchemy.pool import QueuePool
+from models import (
+    Base, Message, ProcessedUser, MigratedUser, MigrationQueueUser, MigrationLedger, ArchiveQueueUser, ArchiveQueueKey,
+    BackupCheckpoint
+)
+from json_stream import BackupFormatError, JsonArrayReader, iter_batches
+from ingest_checkpoint import BackupPosition, IngestCheckpoint
+from message_loader import LoadStats, SeenMessages, create_message_loader, dialect_insert, message_row, skip_old_rows
+from s3_stream import LocalBackupFile
+from message_record import MessageRecord
+from parallel_decode import ParallelDecoder
+import metrics
+
+# 非 PostgreSQL 数据库按 IN 列表分块查询，避免超过 SQLite 的变量数限制
+USER_ID_CHUNK_SIZE = 1000
+# 迁移时读取的消息列，顺序与 MessageRecord 字段一致
+CONVERSATION_MESSAGE_COLUMNS = (
+    Message.id,
+    Message.promptId,
+    Message.content,
+    Message.createdAt,
+    Message.role,
+    Message.type,
+    Message.conversationId,
+    Message.userId
+)
+_MESSAGE_WIDTH = len(CONVERSATION_MESSAGE_COLUMNS)
+LEDGER_COLUMNS = (
+    MigrationLedger.message_count,
+    MigrationLedger.content_hash,
+    MigrationLedger.last_created_at,
+    MigrationLedger.last_message_id
+)
+# queue_depth 可查询的数据库队列
+WORK_QUEUES = {'migration': MigrationQueueUser, 'archive': ArchiveQueueUser}
+
+class TimedQueuePool(QueuePool):
+    """记录每次取连接的等待时间；连接池耗尽时等待时间上升，说明 pool_size 或并发数需要调整"""
+
+    def _do_get(self):
+        with metrics.DB_POOL_WAIT_SECONDS.time():
+            return super()._do_get()
 
 class DatabaseManager:
-    def __init__(self, db_config: Dict = None):
+    def __init__(self, db_config: Dict = None, cache_processed_users: bool = False, pool_size: int = 5,
+                 max_overflow: int = 10):
+        """
+        Args:
+            cache_processed_users: 在进程内缓存已处理的用户ID，启动时一次性加载，
+                之后由 mark_user(s)_as_processed 同步更新
+            pool_size / max_overflow: PostgreSQL 连接池的常驻连接数与临时连接数；
+                同时占用连接的线程数（如 AsyncMigrator 的流式读取加写入）应不超过 pool_capacity
+        """
         try:
             db_config = {
                 'host': os.getenv('DB_HOST', 'localhost'),
@@ -16,18 +69,28 @@ class DatabaseManager:
                 'user': os.getenv('DB_USER', 'postgres'),
                 'password': os.getenv('DB_PASSWORD', 'postgres')
             }
-            # 构建PostgreSQL连接URL
-            db_url = f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
+            # 构建PostgreSQL连接URL，可通过 DB_URL 直接指定（例如本地测试用的 sqlite）
+            db_url = os.getenv('DB_URL') or f"postgresql://{db_config['user']}:{db_config['password']}@{db_config['host']}:{db_config['port']}/{db_config['database']}"
             
-            self.engine = create_engine(
-                db_url,
-                pool_size=5,
-                max_overflow=10,
-                pool_timeout=30,
-                pool_recycle=1800
-            )
+            if db_url.startswith('sqlite'):
+                self.engine = create_engine(db_url)
+                # 连接数不受连接池限制
+                self.pool_capacity = None
+            else:
+                self.engine = create_engine(
+                    db_url,
+                    poolclass=TimedQueuePool,
+                    pool_size=pool_size,
+                    max_overflow=max_overflow,
+                    pool_timeout=30,
+                    pool_recycle=1800
+                )
+                self.pool_capacity = pool_size + max_overflow
             self.Session = sessionmaker(bind=self.engine)
             self.init_database()
+            self.processed_cache = None
+            if cache_processed_users:
+                self.warm_processed_cache()
         except Exception as e:
             print(f"初始化数据库管理器时出错: {e}")
             raise
@@ -57,43 +120,355 @@ class DatabaseManager:
             session.close()
     
     def get_user_conversations(self, user_id: str):
+        return list(self.iter_user_conversations(user_id))
+
+    def iter_user_conversations(self, user_id: str, yield_per: int = 1000):
+        """生成器：一次有序查询读出用户的全部消息，按会话分组后逐个产出
+
+        结果以服务端游标分批读取，第一个会话读完即可产出，无需等待其余会话。
+        yields: {'conversationId': ..., 'messages': [MessageRecord, ...]}
+        """
         session = self.Session()
         try:
-            conversation_ids = session.query(Message.conversationId)\
-                .filter(Message.userId == user_id)\
-                .group_by(Message.conversationId)\
-                .order_by(func.min(Message.createdAt))\
-                .distinct()\
-                .all()
-            
-            conversations = []
-            for (conv_id,) in conversation_ids:
-                messages = session.query(Message)\
-                    .filter(Message.userId == user_id, Message.conversationId == conv_id)\
-                    .order_by(Message.createdAt)\
-                    .all()
-                
-                conversations.append({
+            rows = session.execute(
+                select(*CONVERSATION_MESSAGE_COLUMNS)
+                .where(Message.userId == user_id)
+                .order_by(Message.conversationId, Message.createdAt, Message.id)
+                .execution_options(stream_results=True, yield_per=yield_per)
+            )
+            for conv_id, messages in groupby(rows, key=lambda row: row.conversationId):
+                yield {
                     'conversationId': conv_id,
-                    'messages': [message.to_dict() for message in messages]
-                })
-            
-            return conversations
+                    'messages': [MessageRecord._make(message) for message in messages]
+                }
+        finally:
+            session.close()
+
+    def iter_user_conversation_deltas(self, user_id: str, yield_per: int = 1000):
+        """生成器：只读出每个会话在迁移台账高水位之后的新消息，以及尚未标记为已处理的消息
+
+        与迁移台账左连接，一次有序查询完成；没有新消息的会话不会产出，
+        读取量只与新增数据相关。台账中没有的会话产出全部消息；添加高水位列之前写入的台账记录
+        （last_message_id 为空）只产出未标记的消息，不会整段重推、重复计数。
+        未标记的消息即使早于高水位（读取之后才导入的旧消息）也会产出，不会被永久遗漏。
+        createdAt 为空的消息按空字符串排序（排在最前），各数据库上顺序一致。
+        yields: {
+            'conversationId': ...,
+            'messages': [MessageRecord, ...]，按 (createdAt, id) 升序,
+            'ledger': None 或 {'message_count', 'content_hash', 'last_created_at', 'last_message_id'}
+        }
+        """
+        created_at = func.coalesce(Message.createdAt, '')
+        session = self.Session()
+        try:
+            rows = session.execute(
+                select(*CONVERSATION_MESSAGE_COLUMNS, *LEDGER_COLUMNS)
+                .outerjoin(MigrationLedger, MigrationLedger.conversation_id == Message.conversationId)
+                .where(
+                    Message.userId == user_id,
+                    or_(
+                        MigrationLedger.conversation_id == None,
+                        Message.processed == False,
+                        Message.processed == None,
+                        and_(
+                            MigrationLedger.last_message_id != None,
+                            tuple_(created_at, Message.id) > tuple_(
+                                func.coalesce(MigrationLedger.last_created_at, ''), MigrationLedger.last_message_id
+                            )
+                        )
+                    )
+                )
+                .order_by(Message.conversationId, created_at, Message.id)
+                .execution_options(stream_results=True, yield_per=yield_per)
+            )
+            ledger_keys = [column.key for column in LEDGER_COLUMNS]
+            for conv_id, group in groupby(rows, key=lambda row: row.conversationId):
+                group = list(group)
+                ledger = dict(zip(ledger_keys, group[0][_MESSAGE_WIDTH:]))
+                yield {
+                    'conversationId': conv_id,
+                    'messages': [MessageRecord._make(row[:_MESSAGE_WIDTH]) for row in group],
+                    'ledger': ledger if ledger['content_hash'] is not None else None
+                }
+        finally:
+            session.close()
+
+    def get_ingest_high_water_marks(self, user_id: str) -> Dict[str, str]:
+        """返回用户每个会话已入库的最新 createdAt，{会话ID: createdAt}"""
+        session = self.Session()
+        try:
+            return dict(session.execute(
+                select(Message.conversationId, func.max(Message.createdAt))
+                .where(Message.userId == user_id)
+                .group_by(Message.conversationId)
+            ).all())
+        finally:
+            session.close()
+
+    def get_users(self, take: int, after: str = None):
+        """按 userId 键集分页列出尚未迁移的用户
+
+        Args:
+            take: 每页用户数
+            after: 上一页最后一个用户ID，第一页传 None
+        Returns:
+            [(user_id,), ...]，按 user_id 升序
+        """
+        session = self.Session()
+        try:
+            query = session.query(Message.userId)\
+                .filter(~exists().where(MigratedUser.user_id == Message.userId))
+            if after is not None:
+                query = query.filter(Message.userId > after)
+            return query.distinct()\
+                .order_by(Message.userId)\
+                .limit(take)\
+                .all()
+        finally:
+            session.close()
+
+    def enqueue_users_for_migration(self) -> int:
+        """把尚未迁移、或迁移后又有新消息的用户加入迁移队列
+
+        之前失败或已完成的用户重新置为待处理，增量迁移只会推送高水位之后的新消息。
+
+        Returns:
+            本次新加入或重置的用户数
+        """
+        session = self.Session()
+        try:
+            table = MigrationQueueUser.__table__
+            now = datetime.utcnow()
+            stmt = dialect_insert(self.engine.dialect.name)(table).from_select(
+                ['user_id', 'status', 'updated_at'],
+                select(Message.userId, literal('pending'), literal(now))
+                    .where(~exists().where(MigratedUser.user_id == Message.userId))
+                    .union(
+                        # 已迁移用户只要有未推送的消息（idx_unprocessed_user）就重新入队
+                        select(Message.userId, literal('pending'), literal(now))
+                            .where(Message.processed.isnot(True))
+                    )
+            )
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['user_id'],
+                set_={'status': 'pending', 'claimed_by': None, 'claimed_at': None, 'updated_at': now},
+                where=table.c.status.in_(['failed', 'done'])
+            )
+            count = len(session.execute(stmt.returning(table.c.user_id)).all())
+            session.commit()
+            return count
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def claim_users(self, take: int, worker_id: str, lease_seconds: int = 3600) -> List[str]:
+        """从迁移队列认领一批用户
+
+        PostgreSQL 上使用 SELECT ... FOR UPDATE SKIP LOCKED，多个进程并发认领时互不阻塞、
+        不会领到同一用户；超过 lease_seconds 仍未完成的认领视为进程已退出，可被重新认领。
+        """
+        return [user_id for user_id, in self._claim(MigrationQueueUser, take, worker_id, lease_seconds)]
+
+    def complete_user_migration(self, user_id: str, success: bool = True):
+        """结束对用户的认领；失败的用户在下次 enqueue_users_for_migration 时重新入队"""
+        self._complete_claim(MigrationQueueUser, user_id, success)
+
+    def enqueue_user_archive(self, user_id: str, destination: str, keys: Iterable[str] = ()):
+        """把导入完成的用户及其导入过的备份文件加入归档队列；已在队列中且未被认领的用户重新置为待处理
+
+        用户正被认领时新加入的文件在本次归档完成后由 complete_user_archive 重新置为待处理。
+        """
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            key_rows = [{'user_id': user_id, 'key': key} for key in dict.fromkeys(keys)]
+            if key_rows:
+                session.execute(
+                    dialect_insert(self.engine.dialect.name)(ArchiveQueueKey.__table__)
+                    .on_conflict_do_nothing(index_elements=['user_id', 'key']),
+                    key_rows
+                )
+            stmt = dialect_insert(self.engine.dialect.name)(ArchiveQueueUser.__table__).values(
+                user_id=user_id, destination=destination, status='pending', updated_at=now
+            )
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['user_id'],
+                set_={'destination': destination, 'status': 'pending', 'claimed_by': None,
+                      'claimed_at': None, 'updated_at': now},
+                where=ArchiveQueueUser.__table__.c.status != 'claimed'
+            ))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def claim_archive_users(self, take: int, worker_id: str, lease_seconds: int = 3600) -> List[tuple]:
+        """从归档队列认领一批用户，认领方式同 claim_users
+
+        Returns:
+            [(user_id, destination), ...]
+        """
+        return self._claim(ArchiveQueueUser, take, worker_id, lease_seconds, ArchiveQueueUser.destination)
+
+    def get_archive_keys(self, user_id: str) -> List[str]:
+        """归档队列中用户待移动的备份文件；为空时是记录文件之前入队的用户"""
+        session = self.Session()
+        try:
+            return list(session.execute(
+                select(ArchiveQueueKey.key).where(ArchiveQueueKey.user_id == user_id).order_by(ArchiveQueueKey.key)
+            ).scalars())
         finally:
             session.close()
 
-    def get_users(self,take: int, skip: int):
+    def complete_user_archive(self, user_id: str, success: bool = True, keys: Iterable[str] = ()):
+        """结束对归档用户的认领；失败的用户由 retry_failed_archives 重新置为待处理
+
+        成功时删除已移动的 keys；认领期间又有文件入队时用户重新置为待处理，而不是完成。
+        """
+        keys = list(keys)
         session = self.Session()
-        users = session.query(Message.userId)\
-           .join(MigratedUser, Message.userId != MigratedUser.user_id, isouter=True)\
-           .filter(MigratedUser.user_id == None)\
-           .limit(take)\
-           .offset(skip)\
-           .distinct()\
-           .all()  
-        return users 
-           
+        try:
+            status = 'failed'
+            if success:
+                for i in range(0, len(keys), USER_ID_CHUNK_SIZE):
+                    session.execute(
+                        ArchiveQueueKey.__table__.delete()
+                        .where(ArchiveQueueKey.user_id == user_id,
+                               ArchiveQueueKey.key.in_(keys[i:i + USER_ID_CHUNK_SIZE]))
+                    )
+                remaining = session.execute(
+                    select(exists().where(ArchiveQueueKey.user_id == user_id))
+                ).scalar()
+                status = 'pending' if remaining else 'done'
+            session.execute(
+                update(ArchiveQueueUser)
+                .where(ArchiveQueueUser.user_id == user_id)
+                .values(status=status, updated_at=datetime.utcnow())
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def retry_failed_archives(self) -> int:
+        """把归档失败的用户重新置为待处理，返回重置的用户数"""
+        session = self.Session()
+        try:
+            result = session.execute(
+                update(ArchiveQueueUser)
+                .where(ArchiveQueueUser.status == 'failed')
+                .values(status='pending', updated_at=datetime.utcnow())
+            )
+            session.commit()
+            return result.rowcount
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def queue_depth(self, queue: str) -> int:
+        """数据库队列（WORK_QUEUES 中的 'migration' / 'archive'）中等待认领的用户数，供指标导出"""
+        model = WORK_QUEUES[queue]
+        session = self.Session()
+        try:
+            return session.execute(
+                select(func.count()).select_from(model).where(model.status == 'pending')
+            ).scalar()
+        finally:
+            session.close()
+
+    def _claim(self, model, take: int, worker_id: str, lease_seconds: int, *columns) -> List[tuple]:
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            expired = now - timedelta(seconds=lease_seconds)
+            rows = session.execute(
+                select(model.user_id, *columns)
+                .where(or_(
+                    model.status == 'pending',
+                    and_(model.status == 'claimed', model.claimed_at < expired)
+                ))
+                .order_by(model.status, model.user_id)
+                .limit(take)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if rows:
+                session.execute(
+                    update(model)
+                    .where(model.user_id.in_([row[0] for row in rows]))
+                    .values(status='claimed', claimed_by=worker_id, claimed_at=now, updated_at=now)
+                )
+            session.commit()
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _complete_claim(self, model, user_id: str, success: bool):
+        session = self.Session()
+        try:
+            session.execute(
+                update(model)
+                .where(model.user_id == user_id)
+                .values(status='done' if success else 'failed', updated_at=datetime.utcnow())
+            )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def warm_processed_cache(self):
+        """一次查询加载全部已处理用户ID到进程内缓存"""
+        session = self.Session()
+        try:
+            self.processed_cache = set(session.execute(select(ProcessedUser.user_id)).scalars())
+            print(f"已加载 {len(self.processed_cache)} 个已处理用户到缓存")
+        finally:
+            session.close()
+
+    def filter_unprocessed_users(self, user_ids: Iterable[str]) -> List[str]:
+        """返回 user_ids 中尚未处理的用户，保持原有顺序"""
+        user_ids = list(user_ids)
+        if self.processed_cache is not None:
+            # 缓存只记录已处理的用户且不会失效，未命中的仍需查询数据库（可能由其他进程处理）
+            user_ids = [user_id for user_id in user_ids if user_id not in self.processed_cache]
+        existing = self._find_existing_users(ProcessedUser, user_ids)
+        if self.processed_cache is not None:
+            self.processed_cache.update(existing)
+        return [user_id for user_id in user_ids if user_id not in existing]
+
+    def _find_existing_users(self, model, user_ids: List[str]) -> set:
+        if not user_ids:
+            return set()
+        session = self.Session()
+        try:
+            if self.engine.dialect.name == 'postgresql':
+                # = ANY(:ids) 只绑定一个数组参数，任意数量的用户都只需一次查询
+                ids = bindparam('ids', value=list(set(user_ids)), type_=ARRAY(String))
+                return set(session.execute(select(model.user_id).where(model.user_id == any_(ids))).scalars())
+
+            existing = set()
+            for i in range(0, len(user_ids), USER_ID_CHUNK_SIZE):
+                chunk = user_ids[i:i + USER_ID_CHUNK_SIZE]
+                existing.update(session.execute(select(model.user_id).where(model.user_id.in_(chunk))).scalars())
+            return existing
+        finally:
+            session.close()
+
     def is_user_processed(self, user_id: str) -> bool:
+        if self.processed_cache is not None and user_id in self.processed_cache:
+            return True
         session = self.Session()
         try:
             processed = session.query(ProcessedUser).filter(ProcessedUser.user_id == user_id).first()
@@ -132,94 +507,387 @@ class DatabaseManager:
             raise e
         finally:
             session.close()
+        if self.processed_cache is not None:
+            self.processed_cache.add(user_id)
+
+    def mark_users_as_processed(self, user_ids: Iterable[str]):
+        """一条语句批量标记用户为已处理，已存在的记录保持不变"""
+        user_ids = list(user_ids)
+        self._insert_users(ProcessedUser, user_ids)
+        if self.processed_cache is not None:
+            self.processed_cache.update(user_ids)
+
+    def mark_users_as_migrated(self, user_ids: Iterable[str]):
+        """一条语句批量标记用户为已迁移，已存在的记录保持不变"""
+        self._insert_users(MigratedUser, list(user_ids))
+
+    def _insert_users(self, model, user_ids: List[str]):
+        if not user_ids:
+            return
+        session = self.Session()
+        try:
+            stmt = dialect_insert(self.engine.dialect.name)(model.__table__).on_conflict_do_nothing(index_elements=['user_id'])
+            now = datetime.utcnow()
+            session.execute(stmt, [{'user_id': user_id, 'processed_at': now} for user_id in dict.fromkeys(user_ids)])
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
     
-    def mark_conversation_as_processed(self, conversationId: str):
+    def mark_messages_as_processed(self, message_ids: Iterable[str], user_id: str) -> int:
+        """按主键 (userId, id) 把已推送的消息标记为已处理
+
+        迁移只标记本次读出并确认在网关上的消息；读取之后才导入的消息保持未标记，下次迁移时补推。
+        Returns:
+            实际更新的消息条数
+        """
+        message_ids = list(dict.fromkeys(message_ids))
+        if not message_ids:
+            return 0
         session = self.Session()
         try:
-            messages = session.query(Message)\
-                .filter(Message.conversationId == conversationId)\
-                .all()
-            
-            for message in messages:
-                message.processed = True
-            
+            updated = self._mark_messages(session, message_ids, user_id)
             session.commit()
+            return updated
         except Exception as e:
             session.rollback()
             raise e
         finally:
             session.close()
 
-    def process_backup_file(self, file_path: str, user_id: str):
+    def _mark_messages(self, session, message_ids: list, user_id: str) -> int:
+        """在调用方的事务中按主键标记消息，返回更新的条数"""
+        if self.engine.dialect.name == 'postgresql':
+            ids = bindparam('ids', value=message_ids, type_=ARRAY(String))
+            chunks = [Message.id == any_(ids)]
+        else:
+            chunks = [
+                Message.id.in_(message_ids[i:i + USER_ID_CHUNK_SIZE])
+                for i in range(0, len(message_ids), USER_ID_CHUNK_SIZE)
+            ]
+
+        updated = 0
+        for condition in chunks:
+            updated += session.execute(
+                update(Message)
+                .where(Message.userId == user_id, condition,
+                       or_(Message.processed == False, Message.processed == None))
+                .values(processed=True)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+        return updated
+
+    def mark_conversation_as_processed(self, conversationId: str, user_id: str):
+        self.mark_conversations_as_processed([conversationId], user_id)
+
+    def mark_conversations_as_processed(self, conversation_ids: Iterable[str], user_id: str) -> int:
+        """一条 UPDATE 语句把同一用户的多个会话的消息标记为已处理，不加载 ORM 对象
+
+        Args:
+            conversation_ids: 会话ID列表
+            user_id: 会话所属的用户。messages 表按 userId 分区且没有单独的 conversationId 索引，
+                按用户过滤后只更新一个分区并使用 (userId, conversationId) 索引
+        Returns:
+            实际更新的消息条数（已标记过的消息不会重复写入）
+        """
+        conversation_ids = list(dict.fromkeys(conversation_ids))
+        if not conversation_ids:
+            return 0
+        session = self.Session()
+        try:
+            if self.engine.dialect.name == 'postgresql':
+                ids = bindparam('ids', value=conversation_ids, type_=ARRAY(String))
+                chunks = [Message.conversationId == any_(ids)]
+            else:
+                chunks = [
+                    Message.conversationId.in_(conversation_ids[i:i + USER_ID_CHUNK_SIZE])
+                    for i in range(0, len(conversation_ids), USER_ID_CHUNK_SIZE)
+                ]
+
+            updated = 0
+            for condition in chunks:
+                stmt = update(Message)\
+                    .where(Message.userId == user_id, condition,
+                           or_(Message.processed == False, Message.processed == None))\
+                    .values(processed=True)\
+                    .execution_options(synchronize_session=False)
+                updated += session.execute(stmt).rowcount
+            session.commit()
+            return updated
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def record_pushed_conversations(self, user_id: str, entries: Iterable[tuple], message_ids: Iterable[str] = ()):
+        """把已确认存在于网关的会话写入迁移台账，已有记录则更新计数、哈希、高水位与推送时间
+
+        台账与消息标记在同一个事务中提交：两者之间中断时不会出现台账已前进、消息仍未标记，
+        下次迁移又把这些消息读出重推并重复计入条数与哈希的情况。
+
+        Args:
+            entries: (会话ID, 已推送消息条数, 内容哈希, 最后一条消息的 createdAt, 最后一条消息的 id) 序列
+            message_ids: 这些会话本次推送（或确认已存在）的消息 id，一并标记为已处理
+        """
+        rows = {
+            conversation_id: {
+                'conversation_id': conversation_id,
+                'user_id': user_id,
+                'message_count': message_count,
+                'content_hash': content_hash,
+                'last_created_at': last_created_at,
+                'last_message_id': last_message_id,
+                'pushed_at': datetime.utcnow()
+            }
+            for conversation_id, message_count, content_hash, last_created_at, last_message_id in entries
+        }
+        if not rows:
+            return
+        session = self.Session()
+        try:
+            stmt = dialect_insert(self.engine.dialect.name)(MigrationLedger.__table__)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['conversation_id'],
+                set_={
+                    'message_count': stmt.excluded.message_count,
+                    'content_hash': stmt.excluded.content_hash,
+                    'last_created_at': stmt.excluded.last_created_at,
+                    'last_message_id': stmt.excluded.last_message_id,
+                    'pushed_at': stmt.excluded.pushed_at
+                }
+            )
+            session.execute(stmt, list(rows.values()))
+            message_ids = list(dict.fromkeys(message_ids))
+            if message_ids:
+                self._mark_messages(session, message_ids, user_id)
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def get_ingest_checkpoint(self, key: str, etag: str = None) -> IngestCheckpoint:
+        """读取备份文件的导入检查点；没有记录或 ETag 不同（文件已被替换）时返回从头开始的检查点"""
+        session = self.Session()
+        try:
+            row = session.get(BackupCheckpoint, key)
+            if row is None or (etag is not None and row.etag != etag):
+                return IngestCheckpoint(key, etag)
+            position = BackupPosition(row.byte_offset, row.skip_records, row.records)
+            return IngestCheckpoint(key, row.etag, position, row.batches, row.done)
+        finally:
+            session.close()
+
+    def save_ingest_checkpoint(self, session, checkpoint: IngestCheckpoint, user_id: str, position: BackupPosition):
+        """在调用方的事务中记录已提交到的位置，与同一批消息一起提交，不会出现进度超前于数据的情况
+
+        同一文件的进度只前进不后退（并发写入的批次可能乱序提交）；ETag 变化时从新位置重新计数。
+        """
+        table = BackupCheckpoint.__table__
+        stmt = dialect_insert(self.engine.dialect.name)(table).values(
+            key=checkpoint.key, user_id=user_id, etag=checkpoint.etag, byte_offset=position.byte_offset,
+            skip_records=position.skip_records, records=position.records, batches=1, done=False,
+            updated_at=datetime.utcnow()
+        )
+        replaced = table.c.etag.is_distinct_from(stmt.excluded.etag)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=['key'],
+            set_={
+                'user_id': stmt.excluded.user_id,
+                'etag': stmt.excluded.etag,
+                'byte_offset': stmt.excluded.byte_offset,
+                'skip_records': stmt.excluded.skip_records,
+                'records': stmt.excluded.records,
+                'batches': case((replaced, 1), else_=table.c.batches + 1),
+                'done': False,
+                'updated_at': stmt.excluded.updated_at
+            },
+            where=or_(replaced, table.c.records < stmt.excluded.records)
+        ))
+
+    def complete_ingest_checkpoint(self, checkpoint: IngestCheckpoint, user_id: str):
+        """文件已全部导入；之后再处理同一文件（如标记用户前进程中断）时直接跳过"""
+        session = self.Session()
+        try:
+            now = datetime.utcnow()
+            stmt = dialect_insert(self.engine.dialect.name)(BackupCheckpoint.__table__).values(
+                key=checkpoint.key, user_id=user_id, etag=checkpoint.etag, done=True, updated_at=now
+            )
+            session.execute(stmt.on_conflict_do_update(
+                index_elements=['key'],
+                set_={'etag': stmt.excluded.etag, 'done': True, 'updated_at': now}
+            ))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def process_backup_file(self, file_path: str, user_id: str, batch_size: int = 5000, stream: bool = True,
+                            loader: str = 'auto', on_conflict: str = 'update', incremental: bool = False,
+                            decoder: ParallelDecoder = None, checkpoint: IngestCheckpoint = None,
+                            seen: SeenMessages = None):
+        """将备份文件中的消息批量写入数据库
+
+        Args:
+            file_path: 备份文件路径，内容为消息组成的 JSON 数组，gzip / zstd 压缩的文件自动解压
+            user_id: 用户ID
+            batch_size: 每批提交的消息条数
+            stream: 为 True 时增量解析文件，内存占用只与批大小相关；
+                为 False 时一次性 json.load 整个文件
+            loader: 写入方式，'copy'（PostgreSQL COPY）、'upsert'（INSERT ... ON CONFLICT），
+                'auto' 按数据库类型选择
+            on_conflict: 已存在的消息 id 如何处理，'update' 内容变化时覆盖，'nothing' 保持不变
+            incremental: 为 True 时跳过早于各会话已入库最新 createdAt 的消息，
+                用于已处理用户的新备份，写库量只与新增消息相关
+            decoder: 传入 ParallelDecoder 时，未压缩的备份切块后在进程池中解析，
+                当前线程只负责写库；压缩的备份仍在当前线程流式解析
+            checkpoint: 传入 get_ingest_checkpoint 读出的检查点时，从上次提交到的位置续做，
+                并随每批提交记录新的位置（stream 为 False 时只读取，不记录）
+            seen: 按时间顺序导入同一用户的多个备份时共用的 SeenMessages，跳过之前的文件已写入且内容未变的消息；
+                去重在当前线程进行，此时不使用 decoder
+
+        Returns:
+            成功时返回本文件的 LoadStats（新增/更新/重复行数），失败时返回 False
+        """
+        resume = checkpoint.position if checkpoint else BackupPosition()
+        try:
+            backup = LocalBackupFile(file_path, resume.byte_offset)
+        except Exception as e:
+            print(f"打开备份文件时出错: {e}")
+            print(f"文件路径: {file_path}")
+            return False
+        with backup:
+            if decoder is None or backup.compression != 'none' or seen is not None:
+                return self.process_backup_stream(backup, user_id, batch_size, stream, loader, on_conflict,
+                                                  incremental, checkpoint, seen)
+
+            def row_batches(message_loader, high_water_marks):
+                return decoder.iter_batches(
+                    file_path, user_id, batch_size, high_water_marks, copy_text=message_loader.name == 'copy',
+                    resume=resume
+                )
+
+            return self._load_backup(backup, user_id, loader, on_conflict, incremental, row_batches,
+                                     f"{decoder.workers} 个解析进程", checkpoint)
+
+    def process_backup_stream(self, backup, user_id: str, batch_size: int = 5000, stream: bool = True,
+                              loader: str = 'auto', on_conflict: str = 'update', incremental: bool = False,
+                              checkpoint: IngestCheckpoint = None, seen: SeenMessages = None):
+        """将已打开的备份（LocalBackupFile 或 S3BackupStream）中的消息批量写入数据库
+
+        backup 需提供 text（文本流）、name、total_bytes 与 bytes_read（用于显示进度），
+        续做时 backup 须以检查点的 byte_offset 打开。其余参数与返回值同 process_backup_file。
+        """
+        resume = checkpoint.position if checkpoint else BackupPosition()
+
+        def row_batches(message_loader, high_water_marks):
+            reader = None
+            if stream or resume.records:
+                reader = JsonArrayReader(backup.text, start_offset=resume.byte_offset)
+                messages = islice(reader, resume.skip_records, None)
+            else:
+                messages = json.load(backup.text)
+                if not isinstance(messages, list):
+                    raise BackupFormatError("顶层结构不是 JSON 数组")
+            records = resume.records
+            for batch in iter_batches(messages, batch_size):
+                records += len(batch)
+                rows = [message_row(message, user_id) for message in batch]
+                if high_water_marks:
+                    rows = skip_old_rows(rows, high_water_marks)
+                if seen is not None:
+                    rows = seen.filter(rows)
+                position = BackupPosition(reader.tell(), 0, records) if reader else None
+                yield rows, len(batch) - len(rows), backup.bytes_read, position
+
+        return self._load_backup(backup, user_id, loader, on_conflict, incremental, row_batches, "单线程解析",
+                                 checkpoint)
+
+    def _load_backup(self, backup, user_id: str, loader: str, on_conflict: str, incremental: bool,
+                     row_batches, parser_name: str, checkpoint: IngestCheckpoint = None):
+        """逐批写入 row_batches(message_loader, high_water_marks) 产出的 (批次, 跳过数, 已读取字节数, 续做位置)，
+        每批提交一次；传入检查点时续做位置与该批消息在同一事务中提交"""
         session = None
         try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                if not isinstance(data, list):
-                    print(f"备份文件格式错误: {file_path}")
+            message_loader = create_message_loader(self.engine, loader, on_conflict)
+            high_water_marks = self.get_ingest_high_water_marks(user_id) if incremental else None
+            batches = row_batches(message_loader, high_water_marks)
+            total_bytes = backup.total_bytes
+            print(f"开始处理备份文件 {backup.name} ({total_bytes} 字节), "
+                  f"写入方式: {message_loader.name}, 解析方式: {parser_name}")
+            processed = 0
+            if checkpoint and checkpoint.resuming:
+                processed = checkpoint.position.records
+                print(f"从检查点续做: 已提交 {processed} 条记录，"
+                      f"从偏移 {checkpoint.position.byte_offset} 字节处继续")
+
+            session = self.Session()
+            file_stats = LoadStats()
+            last_progress_time = time.monotonic()
+            progress_interval = 2  # 每2秒更新一次进度
+
+            last_read_bytes = checkpoint.position.byte_offset if checkpoint else 0
+
+            while True:
+                try:
+                    with metrics.span('parse'):
+                        rows, skipped, read_bytes, position = next(batches, (None, 0, 0, None))
+                except Exception as e:
+                    print(f"处理消息时出错: {e}")
                     return False
-                
-                total_messages = len(data)
-                print(f"开始处理 {total_messages} 条消息记录...")
-                
-                session = self.Session()
-                batch_size = 5000  # 增加批处理大小以提高性能
-                messages_batch = []
-                last_progress_time = datetime.now()
-                progress_interval = 2  # 每2秒更新一次进度
-                
-                for i, message in enumerate(data, 1):
+                if rows is None:
+                    break
+                file_stats.skipped += skipped
+                metrics.INGEST_MESSAGES.inc(len(rows), result='loaded')
+                metrics.INGEST_MESSAGES.inc(skipped, result='skipped')
+                metrics.INGEST_READ_BYTES.inc(max(read_bytes - last_read_bytes, 0))
+                last_read_bytes = max(read_bytes, last_read_bytes)
+
+                # 重复的 id 由数据库 ON CONFLICT 处理，重新导入同一备份不会触发回滚
+                if rows:
                     try:
-                        db_message = Message(
-                            id=message['id'],
-                            promptId=message['promptId'],
-                            content=message['content'],
-                            createdAt=message['createdAt'],
-                            role=message['role'],
-                            type=message['type'],
-                            conversationId=message['conversationId'],
-                            userId=user_id
-                        )
-                        messages_batch.append(db_message)
-                        
-                        current_time = datetime.now()
-                        time_diff = (current_time - last_progress_time).total_seconds()
-                        
-                        # 批量提交条件：达到批处理大小、处理完所有数据，或者距离上次进度显示超过指定时间
-                        if len(messages_batch) >= batch_size or i == total_messages or time_diff >= progress_interval:
-                            if messages_batch:  # 确保有数据才进行提交
-                                try:
-                                    session.bulk_save_objects(messages_batch, preserve_order=False)
-                                    session.commit()
-                                except Exception as e:
-                                    if 'UNIQUE constraint failed' in str(e):
-                                        print(f"警告: 跳过重复的消息记录")
-                                        session.rollback()
-                                    else:
-                                        print(f"处理消息时出错: {e}")
-                                        session.rollback()
-                                        return False
-                                messages_batch = []
-                            
-                            # 显示进度
-                            progress = (i / total_messages) * 100
-                            print(f"处理进度: {progress:.1f}% ({i}/{total_messages}), 已处理 {i} 条记录")
-                            last_progress_time = current_time
-                            
+                        with metrics.span('db_commit'), \
+                                metrics.DB_BATCH_COMMIT_SECONDS.time(loader=message_loader.name):
+                            file_stats.add(message_loader.load(session, rows))
+                            if checkpoint is not None and position is not None:
+                                self.save_ingest_checkpoint(session, checkpoint, user_id, position)
+                            session.commit()
                     except Exception as e:
                         print(f"处理消息时出错: {e}")
                         session.rollback()
                         return False
-                
-                print("数据处理完成！")
-                return True
-                
+                processed += len(rows) + skipped
+
+                # 显示进度（每批检查一次）
+                current_time = time.monotonic()
+                if current_time - last_progress_time >= progress_interval:
+                    self._print_progress(read_bytes, processed, total_bytes)
+                    last_progress_time = current_time
+
+            if checkpoint is not None:
+                self.complete_ingest_checkpoint(checkpoint, user_id)
+            self._print_progress(total_bytes, processed, total_bytes)
+            print(f"数据处理完成！{file_stats}")
+            return file_stats
+
         except Exception as e:
             print(f"处理备份文件时出错: {e}")
-            print(f"文件路径: {file_path}")
+            print(f"文件路径: {backup.name}")
             if session:
                 session.rollback()
             return False
         finally:
             if session:
-                session.close()
\ No newline at end of file
+                session.close()
+
+    @staticmethod
+    def _print_progress(read_bytes: int, processed: int, total_bytes: int):
+        read_bytes = min(read_bytes, total_bytes)
+        progress = (read_bytes / total_bytes) * 100 if total_bytes else 100.0
+        print(f"处理进度: {progress:.1f}% ({read_bytes}/{total_bytes} 字节), 已处理 {processed} 条记录")
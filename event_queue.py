@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import boto3
+from contextlib import contextmanager
+from typing import Iterable, List, NamedTuple
+from urllib.parse import quote_plus, unquote_plus
+
+# SQS receive_message 的限制：每次最多 10 条消息，长轮询最长 20 秒
+SQS_MAX_MESSAGES = 10
+SQS_MAX_WAIT_SECONDS = 20
+
+
+class EventMessage(NamedTuple):
+    body: str
+    # 删除消息时使用；消息被重新投递后旧的 receipt 失效
+    receipt: str
+
+
+def s3_event(bucket: str, key: str, event_name: str = 'ObjectCreated:Put') -> str:
+    """构造与 S3 事件通知格式相同的消息体，用于向队列替身投递事件"""
+    return json.dumps({'Records': [{
+        'eventSource': 'aws:s3',
+        'eventName': event_name,
+        's3': {'bucket': {'name': bucket}, 'object': {'key': quote_plus(key, safe='/')}}
+    }]})
+
+
+def parse_s3_event(body: str) -> List[tuple]:
+    """取出 S3 事件通知（直接投递到 SQS 或经 SNS 转发）中新建对象的 (桶, 键)
+
+    s3:TestEvent 等不含对象新建记录的消息返回空列表；消息体不是合法的事件通知时抛出 ValueError。
+    """
+    try:
+        payload = json.loads(body)
+        if 'Records' not in payload and isinstance(payload.get('Message'), str):
+            payload = json.loads(payload['Message'])
+        return [
+            (record['s3']['bucket']['name'], unquote_plus(record['s3']['object']['key']))
+            for record in payload.get('Records', [])
+            if record.get('eventName', '').startswith('ObjectCreated:')
+        ]
+    except (TypeError, KeyError, AttributeError) as e:
+        raise ValueError(f"无法解析 S3 事件通知: {e!r}") from e
+
+
+class SQSEventQueue:
+    """接收 S3 事件通知的 SQS 队列
+
+    消息被接收后在 visibility_timeout 秒内对其他消费者不可见，处理完成后删除；
+    未删除的消息（处理失败或进程退出）超时后重新投递。visibility_timeout 应大于处理单个用户的最长时间，
+    重复投递多次仍失败的消息由队列的死信队列（redrive policy）接收。
+    """
+
+    def __init__(self, queue_url: str, sqs_client=None, visibility_timeout: int = 3600):
+        self.queue_url = queue_url
+        self.sqs_client = sqs_client or boto3.client('sqs')
+        self.visibility_timeout = visibility_timeout
+
+    def receive(self, max_messages: int = SQS_MAX_MESSAGES, wait_seconds: float = SQS_MAX_WAIT_SECONDS) -> List[EventMessage]:
+        """长轮询接收消息：有消息到达立即返回，最多等待 wait_seconds 秒（不超过 20 秒）"""
+        response = self.sqs_client.receive_message(
+            QueueUrl=self.queue_url,
+            MaxNumberOfMessages=max(1, min(max_messages, SQS_MAX_MESSAGES)),
+            WaitTimeSeconds=int(min(wait_seconds, SQS_MAX_WAIT_SECONDS)),
+            VisibilityTimeout=self.visibility_timeout
+        )
+        return [EventMessage(message['Body'], message['ReceiptHandle']) for message in response.get('Messages', [])]
+
+    def delete(self, receipts: Iterable[str]):
+        receipts = list(receipts)
+        for i in range(0, len(receipts), SQS_MAX_MESSAGES):
+            self.sqs_client.delete_message_batch(
+                QueueUrl=self.queue_url,
+                Entries=[{'Id': str(j), 'ReceiptHandle': receipt}
+                         for j, receipt in enumerate(receipts[i:i + SQS_MAX_MESSAGES])]
+            )
+
+    def send(self, body: str):
+        self.sqs_client.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+    def depth(self) -> int:
+        """队列中可接收的消息数（近似值）"""
+        attributes = self.sqs_client.get_queue_attributes(
+            QueueUrl=self.queue_url, AttributeNames=['ApproximateNumberOfMessages']
+        )['Attributes']
+        return int(attributes['ApproximateNumberOfMessages'])
+
+
+class SQLiteEventQueue:
+    """本地测试用的队列替身，保存在一个 SQLite 文件中，接收、可见性超时与删除的语义与 SQSEventQueue 相同
+
+    多个进程可以共用同一个文件：接收时在写事务中取出可见的消息并推迟其可见时间，同一条消息不会同时交给两个消费者。
+    """
+
+    def __init__(self, path: str, visibility_timeout: int = 3600, poll_interval: float = 0.2):
+        self.path = path
+        self.visibility_timeout = visibility_timeout
+        self.poll_interval = poll_interval
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS events ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, '
+                'visible_at REAL NOT NULL DEFAULT 0, receipt TEXT, receive_count INTEGER NOT NULL DEFAULT 0)'
+            )
+
+    @contextmanager
+    def _connect(self):
+        # 每次调用使用独立的连接（自动提交模式），调度线程与处理线程可以并发访问
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def receive(self, max_messages: int = SQS_MAX_MESSAGES, wait_seconds: float = SQS_MAX_WAIT_SECONDS) -> List[EventMessage]:
+        """有可见的消息时立即返回，否则每 poll_interval 秒检查一次，最多等待 wait_seconds 秒"""
+        deadline = time.monotonic() + wait_seconds
+        while True:
+            messages = self._claim(max(1, max_messages))
+            remaining = deadline - time.monotonic()
+            if messages or remaining <= 0:
+                return messages
+            time.sleep(min(self.poll_interval, remaining))
+
+    def _claim(self, max_messages: int) -> List[EventMessage]:
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                rows = conn.execute(
+                    'SELECT id, body FROM events WHERE visible_at <= ? ORDER BY id LIMIT ?', (now, max_messages)
+                ).fetchall()
+                messages = []
+                for event_id, body in rows:
+                    receipt = uuid.uuid4().hex
+                    conn.execute(
+                        'UPDATE events SET visible_at = ?, receipt = ?, receive_count = receive_count + 1 WHERE id = ?',
+                        (now + self.visibility_timeout, receipt, event_id)
+                    )
+                    messages.append(EventMessage(body, receipt))
+                conn.execute('COMMIT')
+                return messages
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+
+    def delete(self, receipts: Iterable[str]):
+        receipts = list(receipts)
+        if not receipts:
+            return
+        with self._connect() as conn:
+            conn.execute(f"DELETE FROM events WHERE receipt IN ({','.join('?' * len(receipts))})", receipts)
+
+    def send(self, body: str):
+        with self._connect() as conn:
+            conn.execute('INSERT INTO events (body) VALUES (?)', (body,))
+
+    def depth(self) -> int:
+        with self._connect() as conn:
+            return conn.execute('SELECT count(*) FROM events WHERE visible_at <= ?', (time.time(),)).fetchone()[0]
+
+
+def event_queue_from_env():
+    """INGEST_EVENT_QUEUE_URL 为 SQS 队列地址，INGEST_EVENT_QUEUE_PATH 为本地 SQLite 队列替身的文件路径；
+    都未设置时返回 None（只靠定期扫描发现新备份）"""
+    visibility_timeout = int(os.getenv('INGEST_EVENT_VISIBILITY_TIMEOUT', '3600'))
+    if os.getenv('INGEST_EVENT_QUEUE_URL'):
+        return SQSEventQueue(os.getenv('INGEST_EVENT_QUEUE_URL'), visibility_timeout=visibility_timeout)
+    if os.getenv('INGEST_EVENT_QUEUE_PATH'):
+        return SQLiteEventQueue(os.getenv('INGEST_EVENT_QUEUE_PATH'), visibility_timeout=visibility_timeout)
+    return None
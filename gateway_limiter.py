@@ -0,0 +1,221 @@
+import time
+import random
+import asyncio
+import threading
+
+# 视为网关过载或暂时故障、可以重试的状态码
+RETRYABLE_STATUS = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class GatewayError(Exception):
+    """网关返回非 2xx 或请求失败"""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        # status 为 None 表示连接错误或超时
+        return self.status is None or self.status in RETRYABLE_STATUS
+
+
+def parse_retry_after(value):
+    """解析 Retry-After 头（仅支持秒数形式），无法解析时返回 None"""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """带抖动的指数退避：第 n 次重试前等待 uniform(0, min(max_delay, base_delay × 2^n)) 秒
+
+    网关给出 Retry-After 时以其为等待下限。
+    """
+
+    def __init__(self, retries: int = 5, base_delay: float = 0.2, max_delay: float = 10.0):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int, retry_after=None) -> float:
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_delay))
+        return delay
+
+    def should_retry(self, attempt: int, error: GatewayError) -> bool:
+        return error.retryable and attempt < self.retries
+
+
+class _AIMDState:
+    """令牌桶限速 + AIMD 并发控制的共享状态（不负责等待）
+
+    每完成 window 个请求评估一次：错误率超过 error_threshold，或窗口平均延迟超过
+    latency_tolerance × 历史最低窗口延迟（给定 latency_target 时改用该绝对值）时，
+    并发上限与发送速率乘以 decrease；否则并发上限加 increase，速率按同样比例增加。
+    429 是网关明确的过载信号，不等窗口结束立即降速；降速之前发出的请求反映的是旧的并发水平，
+    它们随后返回的 429 不再重复降速。
+    第一次过载之前处于慢启动阶段，每个健康窗口并发上限翻倍，以便尽快逼近网关的实际容量。
+    窗口大小随当前并发上限变化，相当于大约每个往返周期调整一次。
+    """
+
+    def __init__(self, rate: float = 50.0, max_rate: float = 5000.0, min_rate: float = 1.0,
+                 concurrency: int = 10, min_concurrency: int = 1, max_concurrency: int = 500,
+                 latency_target: float = None, latency_tolerance: float = 2.0, error_threshold: float = 0.1,
+                 increase: float = 1.0, decrease: float = 0.5):
+        """
+        Args:
+            rate: 初始发送速率（请求/秒），即令牌桶的补充速度
+            concurrency: 初始并发上限
+            latency_target: 窗口平均延迟超过该值（秒）视为网关过载，为 None 时按 latency_tolerance 判断
+            latency_tolerance: 窗口平均延迟超过最低窗口延迟的倍数，视为网关开始排队
+            error_threshold: 窗口错误率超过该值视为网关过载
+            increase: 每个健康窗口并发上限的加性增量
+            decrease: 过载时并发上限与速率的乘性系数
+        """
+        self.rate = float(rate)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.limit = float(concurrency)
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.latency_target = latency_target
+        self.latency_tolerance = latency_tolerance
+        self.base_latency = None
+        self.error_threshold = error_threshold
+        self.increase = increase
+        self.decrease = decrease
+
+        self.in_flight = 0
+        self._tokens = 1.0
+        self._refilled_at = time.monotonic()
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+        self._decreased_at = 0.0
+        self.decreases = 0
+
+    def _try_acquire(self, now: float):
+        """成功返回 0；受并发上限阻塞返回 None；受速率限制返回需要等待的秒数"""
+        # 突发量不超过一秒的速率，也不超过并发上限
+        burst = max(1.0, min(self.rate, self.limit))
+        self._tokens = min(burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self.in_flight >= int(self.limit):
+            return None
+        if self._tokens < 1.0:
+            return (1.0 - self._tokens) / self.rate
+        self._tokens -= 1.0
+        self.in_flight += 1
+        return 0
+
+    def _record(self, latency: float, error: bool, throttled: bool):
+        self.in_flight -= 1
+        if throttled:
+            if time.monotonic() - latency > self._decreased_at:
+                self._adjust(overloaded=True)
+            return
+
+        self._window_count += 1
+        # 被拒绝的请求返回得很快，不计入延迟，避免拉低窗口平均延迟
+        if error:
+            self._window_errors += 1
+        else:
+            self._window_latency += latency
+
+        window = max(10, int(self.limit))
+        allowed_errors = self.error_threshold * window
+        # 错误数已超过本窗口允许的上限时立即降速，不必等窗口结束
+        if self._window_errors > allowed_errors:
+            self._adjust(overloaded=True)
+        elif self._window_count >= window:
+            succeeded = self._window_count - self._window_errors
+            self._adjust(overloaded=succeeded == 0 or self._latency_exceeded(self._window_latency / succeeded))
+
+    def _latency_exceeded(self, latency: float) -> bool:
+        if self.latency_target is not None:
+            return latency > self.latency_target
+        self.base_latency = latency if self.base_latency is None else min(self.base_latency, latency)
+        return latency > self.base_latency * self.latency_tolerance
+
+    def _adjust(self, overloaded: bool):
+        if overloaded:
+            self._decreased_at = time.monotonic()
+            self.limit = max(self.min_concurrency, self.limit * self.decrease)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.decreases += 1
+        else:
+            previous = self.limit
+            step = self.limit if self.decreases == 0 else self.increase
+            self.limit = min(self.max_concurrency, self.limit + step)
+            self.rate = min(self.max_rate, self.rate * self.limit / previous + self.increase)
+        self._window_count = 0
+        self._window_errors = 0
+        self._window_latency = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            'concurrency': int(self.limit),
+            'rate': round(self.rate, 1),
+            'in_flight': self.in_flight,
+            'base_latency': self.base_latency,
+            'decreases': self.decreases
+        }
+
+
+class AdaptiveLimiter(_AIMDState):
+    """线程安全的自适应限流器，供 ConversationAPI（多线程）使用
+
+    用法：
+        limiter.acquire()
+        start = time.monotonic()
+        ... 发送请求 ...
+        limiter.release(time.monotonic() - start, error=是否 5xx/超时, throttled=是否 429)
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire(time.monotonic())
+                if wait == 0:
+                    return
+                self._cond.wait(wait)
+
+    def release(self, latency: float, error: bool = False, throttled: bool = False):
+        with self._cond:
+            self._record(latency, error, throttled)
+            self._cond.notify_all()
+
+
+class AsyncAdaptiveLimiter(_AIMDState):
+    """同一事件循环内使用的自适应限流器，供 AsyncConversationAPI 使用"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._cond = None
+
+    async def acquire(self):
+        # asyncio.Condition 需要在事件循环中创建
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        async with self._cond:
+            while True:
+                wait = self._try_acquire(time.monotonic())
+                if wait == 0:
+                    return
+                try:
+                    await asyncio.wait_for(self._cond.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, latency: float, error: bool = False, throttled: bool = False):
+        async with self._cond:
+            self._record(latency, error, throttled)
+            self._cond.notify_all()
@@ -0,0 +1,28 @@
+from dataclasses import dataclass
+from typing import NamedTuple, Optional
+
+
+class BackupPosition(NamedTuple):
+    """备份中已提交到的位置：从 byte_offset 处继续解析，并跳过其后 skip_records 条消息即可续做
+
+    byte_offset 是解压后 JSON 文本中某个数组元素结束处的字节偏移，0 表示文件开头；
+    records 是到该位置为止的消息总数（含早于高水位而跳过的）。
+    """
+    byte_offset: int = 0
+    skip_records: int = 0
+    records: int = 0
+
+
+@dataclass
+class IngestCheckpoint:
+    """一个备份文件的导入检查点，由 DatabaseManager.get_ingest_checkpoint 读出"""
+    key: str
+    etag: Optional[str] = None
+    position: BackupPosition = BackupPosition()
+    batches: int = 0
+    done: bool = False
+
+    @property
+    def resuming(self) -> bool:
+        """上次导入中断在文件中途"""
+        return not self.done and self.position.records > 0
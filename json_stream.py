@@ -0,0 +1,137 @@
+import json
+from typing import Iterable, Iterator, List, TextIO
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]'
+
+
+class BackupFormatError(ValueError):
+    """备份文件不是合法的 JSON 数组"""
+
+
+def iter_json_array(fp: TextIO, chunk_size: int = 1 << 20) -> Iterator:
+    """增量解析顶层 JSON 数组，逐个产出数组元素
+
+    每次只从文件读取 chunk_size 个字符，内存占用与单条消息大小相关，
+    与整个文件大小无关。
+
+    Args:
+        fp: 以文本模式打开的文件对象
+        chunk_size: 每次读取的字符数
+    """
+    return iter(JsonArrayReader(fp, chunk_size))
+
+
+def _utf8_len(text: str) -> int:
+    return len(text) if text.isascii() else len(text.encode('utf-8'))
+
+
+class JsonArrayReader:
+    """iter_json_array 的实现，另外记录已解析到的字节偏移，用于断点续传
+
+    tell() 返回最后产出的元素结束处在 UTF-8 文本中的字节偏移；start_offset 不为 0 时，
+    fp 须已定位到这样一个偏移（元素之后、分隔逗号之前），从下一个元素继续解析。
+    fp 需以 newline='' 打开，换行不被转换，偏移才与文件中的字节一致。
+    """
+
+    def __init__(self, fp: TextIO, chunk_size: int = 1 << 20, start_offset: int = 0):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.start_offset = start_offset
+        # 当前缓冲区首字符的字节偏移，以及最后产出的元素在缓冲区中的结束位置
+        self._base = start_offset
+        self._buf = ''
+        self._end = 0
+
+    def tell(self) -> int:
+        return self._base + _utf8_len(self._buf[:self._end])
+
+    def __iter__(self) -> Iterator:
+        fp = self.fp
+        chunk_size = self.chunk_size
+        decoder = json.JSONDecoder()
+        buf = ''
+        pos = 0
+        eof = False
+
+        def fill():
+            nonlocal buf, pos, eof
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                eof = True
+            # 最后产出的元素结束位置之前的内容已不再需要
+            keep = min(pos, self._end)
+            self._base += _utf8_len(buf[:keep])
+            self._end -= keep
+            buf = buf[keep:] + chunk
+            pos -= keep
+            self._buf = buf
+
+        def skip_whitespace():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buf) or eof:
+                    return
+                fill()
+
+        skip_whitespace()
+        if self.start_offset:
+            # 从上一个元素之后继续，下一个字符应为分隔逗号或数组结束
+            first = False
+            expect_value = False
+        else:
+            if pos >= len(buf) or buf[pos] != '[':
+                raise BackupFormatError("顶层结构不是 JSON 数组")
+            pos += 1
+            first = True
+            expect_value = True
+
+        while True:
+            skip_whitespace()
+            if pos >= len(buf):
+                raise BackupFormatError("JSON 数组未正常结束")
+
+            char = buf[pos]
+            if char == ']' and (first or not expect_value):
+                return
+            if not expect_value:
+                if char != ',':
+                    raise BackupFormatError(f"数组元素之间缺少逗号: {char!r}")
+                pos += 1
+                expect_value = True
+                continue
+
+            while True:
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                    fill()
+                    continue
+                # 数字可能恰好在缓冲区边界被截断，需读到后续分隔符才能确认结束
+                if not eof and (end == len(buf) or (
+                        isinstance(item, (int, float)) and buf[end] not in _DELIMITERS)):
+                    fill()
+                    continue
+                break
+
+            pos = end
+            self._end = end
+            first = False
+            expect_value = False
+            yield item
+
+
+def iter_batches(items: Iterable, batch_size: int) -> Iterator[List]:
+    """将可迭代对象切分为固定大小的批次"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -1,30 +1,32 @@
-import os
-import time
+import signal
 from s3Util import S3BackupManager
-from db_manager import DatabaseManager
+from backup_scheduler import scheduler_from_env
+from event_queue import event_queue_from_env
+import metrics
 
 def migrate():
     try:
         print("初始化S3备份管理器...")
         manager = S3BackupManager()
-        
-        while True:
-            try:
-                print("\n开始新一轮备份文件处理...")
-                manager.process_all_backups()
-                print("本轮处理完成，等待60秒后开始下一轮...")
-                time.sleep(60)  # 休眠60秒后继续下一轮处理
-                
-            except Exception as e:
-                print(f"处理过程中发生错误: {e}")
-                print("等待60秒后重试...")
-                time.sleep(60)
-                continue
-            
+        # METRICS_PORT 启动本地指标端点；METRICS_SNAPSHOT 为文件路径时每次扫描结束写入一次 JSON 快照
+        metrics.serve_from_env()
+        # INGEST_EVENT_QUEUE_URL / INGEST_EVENT_QUEUE_PATH 配置 S3 事件队列，未配置时只靠扫描发现新备份
+        scheduler = scheduler_from_env(manager, event_queue_from_env())
+
+        def shutdown(signum, frame):
+            print(f"\n收到信号 {signum}，处理中的用户完成后退出（再次发送信号立即退出）...")
+            scheduler.stop()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        scheduler.run()
+
     except Exception as e:
         print(f"程序初始化过程中发生错误: {e}")
         return 1
-    
+
     return 0
 
 if __name__ == "__main__":
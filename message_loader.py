@@ -0,0 +1,282 @@
+import io
+from dataclasses import dataclass
+from typing import Dict, List, Sequence, Tuple
+from sqlalchemy import text, select, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import Message
+from message_record import MessageRecord
+import metrics
+
+# 写入 messages 表的列顺序，与 message_row 产出的 MessageRecord 字段一一对应
+MESSAGE_COLUMNS = MessageRecord._fields
+# messages 表的主键，也是 ON CONFLICT 的冲突目标；userId 在前，PostgreSQL 上写入只落到一个分区
+MESSAGE_KEY_COLUMNS = ('userId', 'id')
+ON_CONFLICT_MODES = ('nothing', 'update')
+# SeenMessages 最多记录的消息数；每条约 150 字节，上限约 150 MB
+SEEN_MESSAGES_MAX_ENTRIES = 1_000_000
+
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+_DIALECT_INSERTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+
+@dataclass
+class LoadStats:
+    """写入统计：新增、因内容变化被更新、重复（内容未变或被忽略），以及未写库而跳过的行数
+    （增量导入时早于高水位，或按顺序导入多个备份时与之前的备份重复）"""
+    inserted: int = 0
+    updated: int = 0
+    duplicates: int = 0
+    skipped: int = 0
+
+    def add(self, other: 'LoadStats'):
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.duplicates += other.duplicates
+        self.skipped += other.skipped
+
+    def __str__(self):
+        text = f"新增 {self.inserted} 条, 更新 {self.updated} 条, 重复 {self.duplicates} 条"
+        if self.skipped:
+            text += f", 跳过 {self.skipped} 条"
+        return text
+
+
+@dataclass
+class CopyBatch:
+    """已序列化为 COPY 文本格式的一批行，可在解析进程中生成，写库线程直接发送"""
+    data: str
+    count: int
+
+    def __len__(self):
+        return self.count
+
+
+def to_copy_text(rows: Sequence[Tuple]) -> str:
+    """把行元组序列化为 PostgreSQL COPY 文本格式"""
+    lines: List[str] = []
+    for row in rows:
+        lines.append('\t'.join(
+            '\\N' if value is None else str(value).translate(_COPY_ESCAPES)
+            for value in row
+        ))
+    lines.append('')
+    return '\n'.join(lines)
+
+
+def message_row(message: Dict, user_id: str) -> MessageRecord:
+    """将备份中的一条消息校验并转换为按 MESSAGE_COLUMNS 排列的 MessageRecord
+
+    Raises:
+        InvalidMessageError: 缺少字段或 id 为空
+    """
+    return MessageRecord.from_json(message, user_id)
+
+
+_ID = MESSAGE_COLUMNS.index('id')
+_CREATED_AT = MESSAGE_COLUMNS.index('createdAt')
+_CONVERSATION_ID = MESSAGE_COLUMNS.index('conversationId')
+_KEY_INDEXES = tuple(MESSAGE_COLUMNS.index(c) for c in MESSAGE_KEY_COLUMNS)
+
+
+def skip_old_rows(rows: Sequence[Tuple], high_water_marks: Dict[str, str]) -> List[Tuple]:
+    """去掉 createdAt 早于所在会话高水位的行；与高水位相同的行保留，由 ON CONFLICT 去重"""
+    return [
+        row for row in rows
+        if row[_CREATED_AT] is None
+        or row[_CREATED_AT] >= high_water_marks.get(row[_CONVERSATION_ID], row[_CREATED_AT])
+    ]
+
+
+class SeenMessages:
+    """按时间顺序导入同一用户的多个备份时跨文件去重，记录已写入的消息 id 与整行的摘要
+
+    快照式备份的后一个文件大多重复前一个文件的消息：与已写入的行完全相同的直接跳过，
+    内容有变化（消息被编辑过）的照常写入，由 ON CONFLICT 覆盖为较新的版本，
+    写库行数只与不同的消息（及其改动）相关。每条消息只占一个 id 和一个整数的内存。
+
+    最多记录 max_entries 条消息，内存不随用户的消息量无限增长：记满后已记录的消息照常去重，
+    新的消息不再记录、全部写库，由 ON CONFLICT 在数据库中比较（内容相同的行不会被改写）。
+    这些消息计入 untracked 与 ingest_dedup_untracked_total。
+    """
+
+    def __init__(self, max_entries: int = SEEN_MESSAGES_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.untracked = 0
+        self._digests: Dict[str, int] = {}
+
+    def __len__(self):
+        return len(self._digests)
+
+    def filter(self, rows: Sequence[Tuple]) -> List[Tuple]:
+        """返回未写入过或内容有变化的行，并把它们记为已写入（记满后新的消息不再记录）"""
+        digests = self._digests
+        fresh = []
+        untracked = 0
+        for row in rows:
+            digest = hash(row)
+            previous = digests.get(row[_ID])
+            if previous == digest:
+                continue
+            if previous is not None or len(digests) < self.max_entries:
+                digests[row[_ID]] = digest
+            else:
+                untracked += 1
+            fresh.append(row)
+        if untracked:
+            self.untracked += untracked
+            metrics.INGEST_DEDUP_UNTRACKED.inc(untracked)
+        return fresh
+
+
+def _row_key(row) -> Tuple[str, str]:
+    """行的主键 (userId, id)；行可以是 MessageRecord 或按 MESSAGE_COLUMNS 排列的普通元组"""
+    return tuple(row[i] for i in _KEY_INDEXES)
+
+
+def dialect_insert(dialect_name: str):
+    """返回支持 ON CONFLICT 的方言 insert 构造函数"""
+    if dialect_name not in _DIALECT_INSERTS:
+        raise ValueError(f"数据库 {dialect_name} 不支持 ON CONFLICT 写入")
+    return _DIALECT_INSERTS[dialect_name]
+
+
+def _check_on_conflict(on_conflict: str):
+    if on_conflict not in ON_CONFLICT_MODES:
+        raise ValueError(f"不支持的 on_conflict: {on_conflict}")
+
+
+class UpsertMessageLoader:
+    """用 SQLAlchemy Core 的 INSERT ... ON CONFLICT ("userId", id) 批量写入，不构造 ORM 对象，适用于 SQLite 等非 COPY 场景
+
+    同一用户下重复的 id 按 on_conflict 处理：'nothing' 保留已有记录，
+    'update' 仅在内容变化时覆盖已有记录。
+    """
+    name = 'upsert'
+    # 单条 IN 查询的参数个数上限，避免超过 SQLite 的变量数限制
+    lookup_chunk_size = 500
+
+    def __init__(self, dialect_name: str, on_conflict: str = 'update'):
+        _check_on_conflict(on_conflict)
+        self.insert = dialect_insert(dialect_name)
+        self.on_conflict = on_conflict
+
+    def load(self, session, rows: Sequence[Tuple]) -> LoadStats:
+        # 同一批次内重复的 (userId, id) 只保留最后一条
+        latest = {_row_key(row): row for row in rows}
+        existing = self._fetch_existing(session, list(latest))
+
+        stats = LoadStats()
+        for key, row in latest.items():
+            if key not in existing:
+                stats.inserted += 1
+            elif self.on_conflict == 'update' and existing[key] != row:
+                stats.updated += 1
+        stats.duplicates = len(rows) - stats.inserted - stats.updated
+
+        table = Message.__table__
+        stmt = self.insert(table)
+        if self.on_conflict == 'update':
+            others = [c for c in MESSAGE_COLUMNS if c not in MESSAGE_KEY_COLUMNS]
+            stmt = stmt.on_conflict_do_update(
+                index_elements=MESSAGE_KEY_COLUMNS,
+                set_={c: stmt.excluded[c] for c in others},
+                where=or_(*[table.c[c].is_distinct_from(stmt.excluded[c]) for c in others])
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=MESSAGE_KEY_COLUMNS)
+        session.execute(stmt, [dict(zip(MESSAGE_COLUMNS, row), processed=False) for row in latest.values()])
+        return stats
+
+    def _fetch_existing(self, session, keys: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Tuple]:
+        """按 (userId, id) 查出已有的行；一个批次通常只属于一个用户，按用户分组查询以便只扫描一个分区"""
+        table = Message.__table__
+        columns = [table.c[c] for c in MESSAGE_COLUMNS]
+        ids_by_user = {}
+        for user_id, message_id in keys:
+            ids_by_user.setdefault(user_id, []).append(message_id)
+        existing = {}
+        for user_id, ids in ids_by_user.items():
+            for i in range(0, len(ids), self.lookup_chunk_size):
+                chunk = ids[i:i + self.lookup_chunk_size]
+                query = select(*columns).where(table.c.userId == user_id, table.c.id.in_(chunk))
+                for row in session.execute(query):
+                    existing[_row_key(row)] = tuple(row)
+        return existing
+
+
+class CopyMessageLoader:
+    """PostgreSQL 专用：COPY FROM STDIN 写入临时表，再合并到 messages 表
+
+    同一用户下重复的 id 按 on_conflict 处理：
+    'nothing' 保留已有记录，'update' 仅在内容变化时覆盖已有记录。
+    """
+    name = 'copy'
+    staging_table = 'messages_staging'
+
+    def __init__(self, on_conflict: str = 'update'):
+        _check_on_conflict(on_conflict)
+        self.on_conflict = on_conflict
+
+    def load(self, session, rows) -> LoadStats:
+        """rows 为行元组序列，或已序列化好的 CopyBatch"""
+        columns = ', '.join(f'"{c}"' for c in MESSAGE_COLUMNS)
+        # 临时表属于当前连接，提交时自动清空，连接复用时直接沿用；seq 记录 COPY 的先后顺序
+        session.execute(text(
+            f'CREATE TEMP TABLE IF NOT EXISTS {self.staging_table} '
+            f'(LIKE messages INCLUDING DEFAULTS, seq bigserial) ON COMMIT DELETE ROWS'
+        ))
+
+        copy_sql = f'COPY {self.staging_table} ({columns}) FROM STDIN'
+        data = rows.data if isinstance(rows, CopyBatch) else to_copy_text(rows)
+        cursor = session.connection().connection.cursor()
+        try:
+            if hasattr(cursor, 'copy_expert'):
+                # psycopg2
+                cursor.copy_expert(copy_sql, io.StringIO(data))
+            else:
+                # psycopg 3
+                with cursor.copy(copy_sql) as copy:
+                    copy.write(data)
+        finally:
+            cursor.close()
+
+        key = ', '.join(f'"{c}"' for c in MESSAGE_KEY_COLUMNS)
+        # 同一批次内可能出现重复 id，DISTINCT ON 按 seq 只保留最后一条（与 UpsertMessageLoader 相同），
+        # 也避免 ON CONFLICT 重复更新同一行。
+        # 分区表不支持 RETURNING xmax 区分新增与更新，因此先 DO NOTHING 写入并统计新增，
+        # 有冲突时再用 DO UPDATE 覆盖内容变化的行；两步都只经过主键索引，不受分区统计信息过期的影响
+        inserted = self._merge(session, columns, key, 'DO NOTHING')
+        updated = 0
+        if self.on_conflict == 'update' and inserted < len(rows):
+            others = [f'"{c}"' for c in MESSAGE_COLUMNS if c not in MESSAGE_KEY_COLUMNS]
+            updates = ', '.join(f'{c} = EXCLUDED.{c}' for c in others)
+            changed = ' OR '.join(f'messages.{c} IS DISTINCT FROM EXCLUDED.{c}' for c in others)
+            updated = self._merge(session, columns, key, f'DO UPDATE SET {updates} WHERE {changed}')
+        return LoadStats(inserted, updated, len(rows) - inserted - updated)
+
+    def _merge(self, session, columns: str, key: str, conflict: str) -> int:
+        """把临时表合并到 messages，返回实际写入（新增或更新）的行数"""
+        return session.execute(text(
+            f'WITH merged AS ('
+            f'INSERT INTO messages ({columns}, "processed") '
+            f'SELECT DISTINCT ON ({key}) {columns}, false FROM {self.staging_table} '
+            f'ORDER BY {key}, seq DESC '
+            f'ON CONFLICT ({key}) {conflict} '
+            f'RETURNING 1) '
+            f'SELECT count(*) FROM merged'
+        )).scalar()
+
+
+def create_message_loader(engine, loader: str = 'auto', on_conflict: str = 'update'):
+    """根据数据库类型选择写入方式：PostgreSQL 默认使用 COPY，其余使用 INSERT ... ON CONFLICT"""
+    if loader == 'auto':
+        loader = 'copy' if engine.dialect.name == 'postgresql' else 'upsert'
+    if loader == 'copy':
+        return CopyMessageLoader(on_conflict)
+    # 'orm' 为旧名称，保留以兼容已有的配置
+    if loader in ('upsert', 'orm'):
+        return UpsertMessageLoader(engine.dialect.name, on_conflict)
+    raise ValueError(f"不支持的 loader: {loader}")
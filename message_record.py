@@ -0,0 +1,58 @@
+from typing import Dict, NamedTuple, Optional
+
+
+class InvalidMessageError(ValueError):
+    """备份中的消息缺少字段或字段类型不对"""
+
+
+class MessageRecord(NamedTuple):
+    """一条消息在导入与迁移热路径上的唯一表示
+
+    NamedTuple 没有实例 __dict__，字段顺序与 messages 表的写入列一致，
+    写库时可直接当作行元组使用；解析备份时校验一次，之后原样传到网关序列化为止。
+    """
+    id: str
+    promptId: Optional[str]
+    content: Optional[str]
+    createdAt: Optional[str]
+    role: Optional[str]
+    type: Optional[str]
+    conversationId: Optional[str]
+    userId: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, message: Dict, user_id: str) -> 'MessageRecord':
+        """从备份中的一条 JSON 消息构造并校验：字段必须齐全（值可以为 null），id 不能为空"""
+        try:
+            record = cls(
+                message['id'],
+                message['promptId'],
+                message['content'],
+                message['createdAt'],
+                message['role'],
+                message['type'],
+                message['conversationId'],
+                user_id
+            )
+        except KeyError as e:
+            raise InvalidMessageError(f"消息缺少字段 {e.args[0]}: id={message.get('id')!r}") from None
+        except TypeError:
+            raise InvalidMessageError(f"消息不是 JSON 对象: {message!r:.100}") from None
+        if record.id is None or record.id == '':
+            raise InvalidMessageError(f"消息 id 不能为空: conversationId={record.conversationId!r}")
+        return record
+
+    def to_gateway(self) -> Dict:
+        """网关请求中的一条消息；只在序列化请求体时调用，结果用完即丢"""
+        return {
+            "messageId": self.id,
+            "messageData": {
+                'id': self.id,
+                'promptId': self.promptId,
+                'content': self.content,
+                'createdAt': self.createdAt,
+                'role': self.role,
+                'type': self.type,
+                'conversationId': self.conversationId
+            }
+        }
@@ -0,0 +1,403 @@
+import os
+import json
+import time
+import bisect
+import contextvars
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, Tuple
+
+# 延迟类直方图的默认分桶（秒），从单个 S3/网关请求到整批写库都能覆盖
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class _Metric:
+    """指标的公共部分：名称、说明、标签名，以及按标签值分组的样本"""
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        with _registry_lock:
+            if name in _registry:
+                raise ValueError(f"指标 {name} 已注册")
+            _registry[name] = self
+
+    def _key(self, labels: Dict) -> tuple:
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> Iterator[tuple]:
+        """产出 (标签值元组, 样本)"""
+        with self._lock:
+            return iter(list(self._values.items()))
+
+
+class Counter(_Metric):
+    """只增不减的计数；bytes/sec、rows/sec 等速率由 Prometheus 的 rate() 或两次快照的差值得到"""
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；set_function 注册的回调在每次导出时读取，用于队列深度等随时变化的量"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function: Callable[[], float], **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+
+    def remove(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values.pop(key, None)
+            self._functions.pop(key, None)
+
+    def _samples(self) -> Iterator[tuple]:
+        with self._lock:
+            samples = list(self._values.items())
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                samples.append((key, function()))
+            except Exception:
+                # 回调失败（例如数据库暂时不可用）时本次导出不包含该样本，不影响其他指标
+                continue
+        return iter(samples)
+
+
+class _HistogramValue:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram(_Metric):
+    """按固定分桶统计分布，导出时转换为 Prometheus 的累计桶"""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self._values.get(key)
+            if histogram is None:
+                histogram = self._values[key] = _HistogramValue(len(self.buckets) + 1)
+            histogram.counts[index] += 1
+            histogram.sum += value
+            histogram.count += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """统计 with 块的耗时，块内抛出异常时同样记录"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def quantile(self, q: float, **labels):
+        """按分桶线性插值估算分位数（与 Prometheus 的 histogram_quantile 相同），没有样本时返回 None
+
+        labels 可以只给出部分标签，其余标签的样本合并计算；落在最后一个桶（+Inf）的返回最大的有限边界。
+        """
+        unknown = set(labels) - set(self.labelnames)
+        if unknown:
+            raise ValueError(f"指标 {self.name} 没有标签 {sorted(unknown)}")
+        positions = [(self.labelnames.index(name), str(value)) for name, value in labels.items()]
+        counts = [0] * (len(self.buckets) + 1)
+        with self._lock:
+            for key, value in self._values.items():
+                if all(key[index] == expected for index, expected in positions):
+                    counts = [total + count for total, count in zip(counts, value.counts)]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        cumulative = 0
+        lower = 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def totals(self) -> Dict[tuple, Tuple[int, float]]:
+        """各标签值的 (次数, 总耗时)"""
+        with self._lock:
+            return {key: (value.count, value.sum) for key, value in self._values.items()}
+
+
+# 下面的指标覆盖导入与迁移的热路径；S3 请求由 instrument_s3_client 挂到 botocore 的事件上统计
+S3_REQUEST_SECONDS = Histogram(
+    's3_request_seconds', 'S3 API 请求耗时（到收到响应头为止），ListObjectsV2 即每页列举的延迟',
+    ('operation', 'status')
+)
+S3_DOWNLOAD_SECONDS = Histogram('s3_download_seconds', '整个备份文件下载到本地的耗时')
+S3_DOWNLOAD_BYTES = Counter('s3_download_bytes_total', '下载到本地的备份字节数')
+INGEST_READ_BYTES = Counter('ingest_read_bytes_total', '导入时已解析的备份字节数（本地文件或 S3 流）')
+INGEST_MESSAGES = Counter(
+    'ingest_messages_total', '导入时解析出的消息数，result 为 loaded（写库）或 skipped（早于高水位或与之前的备份重复）',
+    ('result',)
+)
+INGEST_DEDUP_UNTRACKED = Counter(
+    'ingest_dedup_untracked_total', '跨文件去重集合已满后不再记录、直接交给 ON CONFLICT 处理的消息数'
+)
+DB_BATCH_COMMIT_SECONDS = Histogram('db_batch_commit_seconds', '导入时每批消息写库并提交的耗时', ('loader',))
+DB_POOL_WAIT_SECONDS = Histogram(
+    'db_pool_wait_seconds', '从连接池取得连接的等待时间',
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+)
+GATEWAY_REQUEST_SECONDS = Histogram(
+    'gateway_request_seconds', '会话网关请求耗时，status 为 HTTP 状态码，连接失败或超时为 error',
+    ('endpoint', 'status')
+)
+QUEUE_DEPTH = Gauge('queue_depth', '各工作队列中等待处理的条目数', ('queue',))
+STAGE_SECONDS = Histogram('stage_seconds', 'span() 记录的各阶段耗时，嵌套的阶段以 / 连接', ('stage',))
+
+# 当前所在阶段的完整路径；ContextVar 在每个线程与每个 asyncio 任务中相互独立
+_current_stage = contextvars.ContextVar('metrics_stage', default='')
+
+
+@contextmanager
+def span(stage: str):
+    """记录一个阶段的耗时；嵌套的 span 以 / 连接成完整路径，例如 cycle/ingest/load/db_commit"""
+    parent = _current_stage.get()
+    path = f'{parent}/{stage}' if parent else stage
+    token = _current_stage.set(path)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=path)
+        _current_stage.reset(token)
+
+
+def timed_iter(iterable: Iterable, stage: str) -> Iterator:
+    """逐个产出 iterable 的元素，等待每个元素的时间记入 span(stage)；用于列举等惰性生成器"""
+    iterator = iter(iterable)
+    while True:
+        with span(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def instrument_s3_client(s3_client):
+    """在 boto3 客户端上注册事件钩子，按操作与状态码统计每个 S3 API 请求的耗时"""
+    def before_call(model, context, **kwargs):
+        context['metrics_start'] = time.perf_counter()
+        context['metrics_operation'] = model.name
+
+    def after_call(model, context, http_response=None, **kwargs):
+        start = context.pop('metrics_start', None)
+        if start is not None:
+            status = http_response.status_code if http_response is not None else 'error'
+            S3_REQUEST_SECONDS.observe(time.perf_counter() - start, operation=model.name, status=status)
+
+    def after_call_error(context=None, exception=None, **kwargs):
+        # 连接错误、超时等没有 HTTP 响应，botocore 只传 context 与 exception；钩子不能抛出异常，否则会打断重试
+        start = (context or {}).pop('metrics_start', None)
+        if start is not None:
+            operation = context.get('metrics_operation', 'unknown')
+            S3_REQUEST_SECONDS.observe(time.perf_counter() - start, operation=operation, status='error')
+
+    events = s3_client.meta.events
+    events.register('before-call.s3', before_call, unique_id='metrics-before-call')
+    events.register('after-call.s3', after_call, unique_id='metrics-after-call')
+    events.register('after-call-error.s3', after_call_error, unique_id='metrics-after-call-error')
+    return s3_client
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: tuple, extra: Dict = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_bound(bound: float) -> str:
+    return '+Inf' if bound == float('inf') else repr(float(bound))
+
+
+def _metrics():
+    with _registry_lock:
+        return list(_registry.values())
+
+
+def render_prometheus() -> str:
+    """所有指标的 Prometheus 文本格式"""
+    lines = []
+    for metric in _metrics():
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for key, value in metric._samples():
+            if metric.kind != 'histogram':
+                lines.append(f'{metric.name}{_format_labels(metric.labelnames, key)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value.counts):
+                cumulative += count
+                labels = _format_labels(metric.labelnames, key, {'le': _format_bound(bound)})
+                lines.append(f'{metric.name}_bucket{labels} {cumulative}')
+            labels = _format_labels(metric.labelnames, key)
+            lines.append(f'{metric.name}_sum{labels} {value.sum}')
+            lines.append(f'{metric.name}_count{labels} {value.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot() -> Dict:
+    """所有指标当前值的快照，可直接序列化为 JSON"""
+    result = {'timestamp': time.time(), 'metrics': {}}
+    for metric in _metrics():
+        samples = []
+        for key, value in metric._samples():
+            labels = dict(zip(metric.labelnames, key))
+            if metric.kind == 'histogram':
+                samples.append({
+                    'labels': labels,
+                    'count': value.count,
+                    'sum': value.sum,
+                    'buckets': {_format_bound(bound): count
+                                for bound, count in zip(metric.buckets + (float('inf'),), value.counts)}
+                })
+            else:
+                samples.append({'labels': labels, 'value': value})
+        result['metrics'][metric.name] = {'type': metric.kind, 'help': metric.documentation, 'samples': samples}
+    return result
+
+
+def dump_snapshot(path: str):
+    """把快照写入 JSON 文件；先写临时文件再替换，读取方不会读到写了一半的文件"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot(), f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = render_prometheus().encode(), 'text/plain; version=0.0.4; charset=utf-8'
+        elif self.path == '/metrics.json':
+            body, content_type = json.dumps(snapshot(), ensure_ascii=False).encode(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # 抓取请求很频繁，不写访问日志
+        pass
+
+
+def start_http_server(port: int, addr: str = '127.0.0.1') -> ThreadingHTTPServer:
+    """在后台线程中提供 /metrics（Prometheus 文本格式）与 /metrics.json（JSON 快照）"""
+    server = ThreadingHTTPServer((addr, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    return server
+
+
+def serve_from_env():
+    """设置了 METRICS_PORT 时启动指标端点（监听地址默认 127.0.0.1，可用 METRICS_ADDR 修改）"""
+    port = os.getenv('METRICS_PORT')
+    if not port:
+        return None
+    server = start_http_server(int(port), os.getenv('METRICS_ADDR', '127.0.0.1'))
+    print(f"指标端点已启动: http://{server.server_address[0]}:{server.server_address[1]}/metrics")
+    return server
+
+
+class CycleReport:
+    """一轮处理中各阶段的耗时、网关请求与吞吐：创建时记下各指标的值，转为字符串时与当前值相减
+
+    用法：
+
+        report = CycleReport()
+        with span('cycle'):
+            ...
+        print(report)
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = STAGE_SECONDS.totals()
+        self.gateway = GATEWAY_REQUEST_SECONDS.totals()
+        self.counters = self._counters()
+
+    @staticmethod
+    def _counters() -> tuple:
+        messages = INGEST_MESSAGES.value(result='loaded') + INGEST_MESSAGES.value(result='skipped')
+        return messages, INGEST_READ_BYTES.value(), S3_DOWNLOAD_BYTES.value()
+
+    @staticmethod
+    def _delta(histogram: Histogram, before: Dict) -> Iterator[tuple]:
+        """产出本轮内有新样本的 (标签值元组, 次数, 总耗时)"""
+        for key, (count, total) in sorted(histogram.totals().items()):
+            before_count, before_total = before.get(key, (0, 0.0))
+            if count > before_count:
+                yield key, count - before_count, total - before_total
+
+    def __str__(self) -> str:
+        elapsed = time.perf_counter() - self.start
+        lines = [f"本轮耗时 {elapsed:.2f}s"]
+        for (stage,), count, total in self._delta(STAGE_SECONDS, self.stages):
+            lines.append(f"  阶段 {stage}: {total:.2f}s / {count} 次")
+        for (endpoint, status), count, total in self._delta(GATEWAY_REQUEST_SECONDS, self.gateway):
+            lines.append(f"  网关 {endpoint} {status}: {count} 次, 平均 {total / count * 1000:.1f}ms")
+        messages, read_bytes, download_bytes = (
+            after - before for after, before in zip(self._counters(), self.counters)
+        )
+        if messages or download_bytes:
+            rate = elapsed or 1.0
+            lines.append(
+                f"  吞吐: 解析 {messages / rate:.0f} 条/秒, 读取 {read_bytes / rate / 1e6:.2f} MB/秒, "
+                f"下载 {download_bytes / rate / 1e6:.2f} MB/秒"
+            )
+        return '\n'.join(lines)
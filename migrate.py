@@ -1,67 +1,113 @@
+import os
+import socket
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from db_manager import DatabaseManager
-from conversation import ConversationAPI
+from conversation import ConversationAPI, ledger_entry
+from gateway_limiter import AdaptiveLimiter
+from json_stream import iter_batches
+import metrics
 
 db = DatabaseManager()
-api = ConversationAPI()
+# 从较低的速率起步，按网关的延迟与错误率逐步逼近其实际容量
+api = ConversationAPI(limiter=AdaptiveLimiter(rate=50, concurrency=10, max_concurrency=50))
 
-def process_conversation(conversation: dict):
-    conversation_id = conversation["conversationId"]
-    resp = api.get_conversation_info(conversation_id)
-    db.mark_conversation_as_processed(conversation_id)
-    if not resp.get('messages') or len(resp['messages']) <= 0:
-        res = api.update_conversation(conversation_id, conversation["messages"])
-        print(f"Response for conversation {conversation_id}: {res}")
-    
+# 每组会话共用一次 /batchInfo 查询，需要更新的会话再按大小装箱成 /batchUpdate 请求
+CONVERSATION_GROUP_SIZE = 100
+
+def process_conversations(conversations: list, user_id: str):
+    """处理一组会话，确认在网关上后与台账一起把消息标记为已处理；任一请求最终失败时整组抛出异常
+
+    conversations 来自 iter_user_conversation_deltas：迁移台账中已有的会话只带高水位之后的新消息，
+    直接追加推送；台账中没有的会话先向网关查询是否已存在，不存在才推送全部消息。
+    消息为 MessageRecord，原样交给 ConversationAPI，序列化请求体时才转换为网关格式。
+    """
+    messages = {conversation["conversationId"]: conversation["messages"] for conversation in conversations}
+    ledgers = {conversation["conversationId"]: conversation["ledger"] for conversation in conversations}
+    conversation_ids = list(messages)
+    unknown = [conversation_id for conversation_id in conversation_ids if ledgers[conversation_id] is None]
+    with metrics.span('lookup'):
+        infos = api.get_conversations_info(unknown) if unknown else {}
+    existing = {conversation_id for conversation_id in unknown if infos.get(conversation_id, {}).get('messages')}
+    pending = [conversation_id for conversation_id in conversation_ids if conversation_id not in existing]
+    if pending:
+        with metrics.span('push'):
+            res = api.update_conversations([(conversation_id, messages[conversation_id]) for conversation_id in pending])
+        print(f"Updated {len(pending)}/{len(conversations)} conversations in {len(res)} requests")
+    # 本组会话此时都已确认在网关上：本次推送成功的，以及查询到已存在的
+    # 只标记本次读出并推送的消息，读取之后才导入的消息留到下次迁移
+    with metrics.span('ledger'):
+        db.record_pushed_conversations(user_id, [
+            ledger_entry(conversation_id, ledgers[conversation_id], messages[conversation_id])
+            for conversation_id in conversation_ids
+        ], [message.id for conversation_id in conversation_ids for message in messages[conversation_id]])
 
 def migrate_one_user(user_id: str):
-    conversations = db.get_user_conversations(user_id)
-    conversations = convert_format(conversations)
-    total_convs = len(conversations)
-    print(f"Processing {total_convs} conversations for user {user_id}")
+    """推送用户的新消息；成功后由调用方把整批用户一次标记为已迁移"""
+    print(f"Processing conversations for user {user_id}")
     
     with ThreadPoolExecutor(max_workers=5) as conv_executor:
-        futures = [conv_executor.submit(process_conversation, conv) for conv in conversations]
+        # 会话边读边提交，第一个会话读出后即可开始发送
+        # 只读出高水位之后的新消息，持续同步的开销只与新增数据相关
+        conversations = db.iter_user_conversation_deltas(user_id)
+        futures = {
+            conv_executor.submit(process_conversations, group, user_id): len(group)
+            for group in metrics.timed_iter(iter_batches(conversations, CONVERSATION_GROUP_SIZE), 'read')
+        }
+        total_convs = sum(futures.values())
         completed = 0
+        failed = 0
         for future in as_completed(futures):
             try:
                 future.result()
-                completed += 1
-                if completed % 10 == 0:  # 每处理10个会话显示一次进度
-                    print(f"User {user_id}: Processed {completed}/{total_convs} conversations")
+                completed += futures[future]
+                print(f"User {user_id}: Processed {completed}/{total_convs} conversations")
             except Exception as exc:
-                print(f"Error processing conversation: {exc}")
-    
-    print(f"Completed processing user {user_id}")
-    db.mark_user_as_migrated(user_id)
+                failed += futures[future]
+                print(f"Error processing conversations: {exc}")
 
-def convert_format(raw: list) -> list:
-    result = []
-    for conversation in raw:
-        conversation_id = conversation["conversationId"]
-        messages = conversation["messages"]
-        new_messages = list(map(lambda message: {"messageId": message["id"], "messageData": message}, messages))
-        result.append({"conversationId": conversation_id, "messages": new_messages})
-    return result
+    # 有会话失败时不标记用户已迁移，由调用方放回队列，下次只会重发未标记的会话
+    if failed:
+        raise RuntimeError(f"{failed}/{total_convs} conversations failed for user {user_id}")
+    print(f"Completed processing user {user_id}")
 
 if __name__ == "__main__":
     max_workers = 10
     batch_size = 10
-    offset = 0
-    
+    # 每个进程使用唯一的认领标识，多个节点可同时运行 migrate.py 领取不重叠的用户
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    metrics.serve_from_env()
+    metrics.QUEUE_DEPTH.set_function(lambda: db.queue_depth('migration'), queue='migration')
+    report = metrics.CycleReport()
+
+    queued = db.enqueue_users_for_migration()
+    print(f"迁移队列新增 {queued} 个用户")
+
     while True:
-        users = db.get_users(batch_size, offset)
+        users = db.claim_users(batch_size, worker_id)
         if not users:
             break
-            
-        print(f"Processing batch of users from offset {offset}")
+
+        print(f"Processing batch of {len(users)} users claimed by {worker_id}")
+        migrated = []
         with ThreadPoolExecutor(max_workers=max_workers) as user_executor:
-            futures = [user_executor.submit(migrate_one_user, user[0]) for user in users]
+            futures = {user_executor.submit(migrate_one_user, user_id): user_id for user_id in users}
             for future in as_completed(futures):
+                user_id = futures[future]
                 try:
                     future.result()
+                    migrated.append(user_id)
                 except Exception as exc:
                     print(f"Error processing user: {exc}")
-        
-        offset += batch_size
-        print(f"Completed batch, moving to offset {offset}")
\ No newline at end of file
+                    db.complete_user_migration(user_id, success=False)
+
+        # 整批成功的用户一条语句标记为已迁移，之后才结束认领；标记失败时认领超时后重新迁移（只剩新消息）
+        db.mark_users_as_migrated(migrated)
+        for user_id in migrated:
+            db.complete_user_migration(user_id)
+
+        print(f"Completed batch of {len(users)} users")
+
+    print(report)
+    if os.getenv('METRICS_SNAPSHOT'):
+        metrics.dump_snapshot(os.getenv('METRICS_SNAPSHOT'))
@@ -0,0 +1,36 @@
+import sys
+import os
+from sqlalchemy import inspect, text
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+
+def add_conversation_index():
+    """为 messages.conversationId 添加单列索引
+
+    mark_conversations_as_processed 只按 conversationId 过滤，
+    已有的 idx_user_conversation 以 userId 开头，无法用于该查询。
+
+    partition_messages 之后（主键为 (userId, id)）不再需要该索引：按用户更新会话只扫描一个分区并使用
+    (userId, conversationId) 索引；PostgreSQL 也不支持在分区表上 CREATE INDEX CONCURRENTLY。此时直接跳过。
+    """
+    engine = DatabaseManager().engine
+
+    try:
+        if inspect(engine).get_pk_constraint('messages')['constrained_columns'] == ['userId', 'id']:
+            print("messages 表已按 userId 分区，不需要 idx_conversation，跳过")
+            return
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY 不会阻塞写入，但不能在事务中执行
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_conversation ON messages ("conversationId")'))
+        else:
+            with engine.begin() as conn:
+                conn.execute(text('CREATE INDEX IF NOT EXISTS idx_conversation ON messages ("conversationId")'))
+        print("成功创建 idx_conversation 索引")
+    except Exception as e:
+        print(f"创建索引时发生错误: {e}")
+
+if __name__ == '__main__':
+    add_conversation_index()
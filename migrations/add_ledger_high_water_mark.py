@@ -0,0 +1,41 @@
+import sys
+import os
+from sqlalchemy import inspect, text
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+
+def add_ledger_high_water_mark():
+    """为迁移台账添加高水位列，并为未推送的消息添加部分索引
+
+    增量迁移只读取比 (last_created_at, last_message_id) 更新的消息；
+    idx_unprocessed_user 让入队时查找有新消息的用户无需扫描全表。
+    """
+    engine = DatabaseManager().engine
+
+    try:
+        columns = {column['name'] for column in inspect(engine).get_columns('migration_ledger')}
+        with engine.begin() as conn:
+            for column in ('last_created_at', 'last_message_id'):
+                if column not in columns:
+                    conn.execute(text(f'ALTER TABLE migration_ledger ADD COLUMN {column} VARCHAR'))
+
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY 不会阻塞写入，但不能在事务中执行
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text(
+                    'CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_unprocessed_user ON messages ("userId") '
+                    'WHERE processed IS NOT TRUE'
+                ))
+        else:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    'CREATE INDEX IF NOT EXISTS idx_unprocessed_user ON messages ("userId") WHERE processed IS NOT 1'
+                ))
+        print("成功添加台账高水位列与 idx_unprocessed_user 索引")
+    except Exception as e:
+        print(f"迁移时发生错误: {e}")
+
+if __name__ == '__main__':
+    add_ledger_high_water_mark()
@@ -0,0 +1,60 @@
+import sys
+import os
+from sqlalchemy import inspect, text
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from models import Message, MESSAGE_PARTITIONS
+
+BACKUP_TABLE = 'messages_unpartitioned'
+# 旧表上的索引；索引名在库内唯一，新表建索引前先删掉
+OLD_INDEXES = ('idx_user_conversation', 'idx_created_at', 'idx_conversation', 'idx_unprocessed_user')
+
+def partition_messages():
+    """把 messages 表重建为主键 (userId, id)、PostgreSQL 上按 userId 哈希分区的新表
+
+    旧表改名为 messages_unpartitioned 保留，数据在同一个事务中复制到新表，确认无误后再手动删除。
+    复制期间旧表被锁住，执行前请停止导入与迁移进程；userId 为空的旧数据无法放入新表，会被跳过。
+    SQLite 不支持分区，只改主键并去掉不再使用的索引。
+    """
+    engine = DatabaseManager().engine
+    columns = ', '.join(f'"{column.name}"' for column in Message.__table__.columns)
+
+    try:
+        inspector = inspect(engine)
+        if inspector.get_pk_constraint('messages')['constrained_columns'] == ['userId', 'id']:
+            print("messages 表已迁移，无需重复执行")
+            return
+        if inspector.has_table(BACKUP_TABLE):
+            print(f"{BACKUP_TABLE} 已存在，请确认上次迁移的结果并删除该表后重试")
+            return
+
+        with engine.begin() as conn:
+            conn.execute(text(f'ALTER TABLE messages RENAME TO {BACKUP_TABLE}'))
+            if engine.dialect.name == 'postgresql':
+                conn.execute(text(f'ALTER TABLE {BACKUP_TABLE} RENAME CONSTRAINT messages_pkey TO {BACKUP_TABLE}_pkey'))
+            for index in OLD_INDEXES:
+                conn.execute(text(f'DROP INDEX IF EXISTS {index}'))
+
+            # 建表时由 models 中的 after_create 钩子创建各分区
+            Message.__table__.create(conn)
+            copied = conn.execute(text(
+                f'INSERT INTO messages ({columns}) SELECT {columns} FROM {BACKUP_TABLE} WHERE "userId" IS NOT NULL'
+            )).rowcount
+            skipped = conn.execute(text(f'SELECT count(*) FROM {BACKUP_TABLE} WHERE "userId" IS NULL')).scalar()
+
+        if engine.dialect.name == 'postgresql':
+            with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+                conn.execute(text('ANALYZE messages'))
+            print(f"成功将 messages 表重建为 {MESSAGE_PARTITIONS} 个哈希分区，复制 {copied} 条消息")
+        else:
+            print(f"成功将 messages 表主键改为 (userId, id)，复制 {copied} 条消息")
+        if skipped:
+            print(f"跳过 userId 为空的消息 {skipped} 条")
+        print(f"确认无误后执行 DROP TABLE {BACKUP_TABLE} 删除旧表")
+    except Exception as e:
+        print(f"迁移时发生错误: {e}")
+
+if __name__ == '__main__':
+    partition_messages()
@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, Column, String, Text, DateTime, Index, Boolean
+from sqlalchemy import create_engine, Column, String, Text, DateTime, Index, Boolean, BigInteger, Integer, PrimaryKeyConstraint, text, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from datetime import datetime
@@ -16,14 +16,80 @@ class ProcessedUser(Base):
     user_id = Column(String, primary_key=True)
     processed_at = Column(DateTime, default=datetime.utcnow)
 
+class MigrationQueueUser(Base):
+    """待迁移用户的工作队列，多个 migrate.py 进程通过认领（claim）各自领取不重叠的用户"""
+    __tablename__ = 'migration_queue'
+    __table_args__ = (
+        Index('idx_migration_queue_status', 'status', 'user_id'),
+    )
+
+    user_id = Column(String, primary_key=True)
+    status = Column(String, nullable=False, default='pending')  # pending / claimed / done / failed
+    claimed_by = Column(String)
+    claimed_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ArchiveQueueUser(Base):
+    """待归档到 processed-backups 的用户；导入完成即入队，由后台归档线程认领处理，进程中断后可续做"""
+    __tablename__ = 'archive_queue'
+    __table_args__ = (
+        Index('idx_archive_queue_status', 'status', 'user_id'),
+    )
+
+    user_id = Column(String, primary_key=True)
+    destination = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='pending')  # pending / claimed / done / failed
+    claimed_by = Column(String)
+    claimed_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ArchiveQueueKey(Base):
+    """归档队列中用户待移动的备份文件：只移动导入过的文件，导入之后才上传的备份留在原处等待下次导入"""
+    __tablename__ = 'archive_queue_keys'
+
+    user_id = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+
+class MigrationLedger(Base):
+    """已成功推送到会话网关的会话及其高水位
+
+    (last_created_at, last_message_id) 是已推送的最后一条消息，之后只需推送比它更新的消息；
+    content_hash 为已推送内容的链式哈希。
+    """
+    __tablename__ = 'migration_ledger'
+    __table_args__ = (
+        Index('idx_ledger_user', 'user_id'),
+    )
+
+    conversation_id = Column(String, primary_key=True)
+    user_id = Column(String, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    content_hash = Column(String, nullable=False)
+    last_created_at = Column(String)
+    last_message_id = Column(String)
+    pushed_at = Column(DateTime, nullable=False)
+
+# PostgreSQL 上 messages 表按 userId 哈希分区的分区数；修改后需要重建表（见 migrations/partition_messages.py）
+MESSAGE_PARTITIONS = 16
+
 class Message(Base):
+    """消息表，主键为 (userId, id)
+
+    PostgreSQL 上按 userId 哈希分区：一个用户的消息都在同一个分区，
+    按用户的读取、导入和标记已推送只涉及一个分区，每个分区的索引和 VACUUM 也都更小。
+    所有查询都带 userId 条件，因此不再维护全表的 createdAt / conversationId 索引。
+    """
     __tablename__ = 'messages'
     __table_args__ = (
+        PrimaryKeyConstraint('userId', 'id'),
         Index('idx_user_conversation', 'userId', 'conversationId'),
-        Index('idx_created_at', 'createdAt')
+        # 只索引尚未推送的消息，迁移入队时据此找出有新消息的用户
+        Index('idx_unprocessed_user', 'userId',
+              postgresql_where=text('processed IS NOT TRUE'), sqlite_where=text('processed IS NOT 1')),
+        {'postgresql_partition_by': 'HASH ("userId")'}
     )
 
-    id = Column(String, primary_key=True)
+    id = Column(String)
     promptId = Column(String)
     content = Column(Text)
     createdAt = Column(String)
@@ -42,4 +108,59 @@ class Message(Base):
             'role': self.role,
             'type': self.type,
             'conversationId': self.conversationId
-        }
\ No newline at end of file
+        }
+
+
+@event.listens_for(Message.__table__, 'after_create')
+def create_message_partitions(target, connection, **kw):
+    """建表后创建各哈希分区；分区自动继承父表上的主键和索引"""
+    if connection.dialect.name != 'postgresql':
+        return
+    for remainder in range(MESSAGE_PARTITIONS):
+        connection.execute(text(
+            f'CREATE TABLE IF NOT EXISTS {target.name}_p{remainder} PARTITION OF {target.name} '
+            f'FOR VALUES WITH (MODULUS {MESSAGE_PARTITIONS}, REMAINDER {remainder})'
+        ))
+
+class S3InventoryObject(Base):
+    """本地记录的 S3 备份文件清单，避免每轮都全量列举存储桶"""
+    __tablename__ = 's3_inventory'
+    __table_args__ = (
+        Index('idx_inventory_user', 'user_id', 'backup_ts'),
+    )
+
+    key = Column(String, primary_key=True)
+    user_id = Column(String, nullable=False)
+    backup_ts = Column(BigInteger)  # 文件名中的时间戳，非数字文件名为空
+    etag = Column(String)
+    size = Column(BigInteger)
+    last_modified = Column(DateTime)
+    processed = Column(Boolean, default=False, nullable=False)
+    seen_at = Column(DateTime, nullable=False)
+
+class S3InventoryState(Base):
+    """清单刷新进度：中断的全量列举从 last_key 继续，已导入的 S3 Inventory manifest"""
+    __tablename__ = 's3_inventory_state'
+
+    name = Column(String, primary_key=True)
+    last_key = Column(String)
+    walk_started_at = Column(DateTime)
+    manifest_key = Column(String)
+
+class BackupCheckpoint(Base):
+    """单个备份文件的导入进度，随每批消息在同一事务中提交；进程中断后从这里续做，不再从头导入
+
+    (byte_offset, skip_records) 为续做位置：解压后的 JSON 文本中某个数组元素结束处的字节偏移，
+    以及该偏移之后已提交的消息数。etag 不同说明文件已被替换，进度作废。
+    """
+    __tablename__ = 'backup_checkpoints'
+
+    key = Column(String, primary_key=True)  # S3 对象键
+    user_id = Column(String, nullable=False)
+    etag = Column(String)
+    byte_offset = Column(BigInteger, nullable=False, default=0)
+    skip_records = Column(Integer, nullable=False, default=0)
+    records = Column(BigInteger, nullable=False, default=0)  # 已提交的消息数（含早于高水位跳过的）
+    batches = Column(Integer, nullable=False, default=0)
+    done = Column(Boolean, nullable=False, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
@@ -0,0 +1,219 @@
+import os
+import re
+import json
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+from json_stream import iter_batches
+from ingest_checkpoint import BackupPosition
+from message_loader import CopyBatch, message_row, skip_old_rows, to_copy_text
+
+try:
+    import orjson
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    _loads = json.loads
+
+# 每个解析任务的字节数
+DECODE_CHUNK_BYTES = 8 * 1024 * 1024
+# 在目标切分点之后查找元素边界时每次读取的字节数
+BOUNDARY_WINDOW = 256 * 1024
+
+# 顶层数组元素之间的边界：'}' ',' '{"key'。字符串中的 '"' 一定被转义，
+# 因此后面紧跟键名字符的 '{"' 不可能位于字符串内部；嵌套在元素内部的对象数组也可能匹配，
+# 这种切分会让相邻两块都解析失败，由 ParallelDecoder 合并后重新解析
+_ELEMENT_BOUNDARY = re.compile(rb'\}\s*,\s*(?=\{\s*"[A-Za-z_])')
+
+
+def split_backup_file(file_path: str, chunk_bytes: int = DECODE_CHUNK_BYTES,
+                      start_offset: int = 0) -> List[Tuple[int, int]]:
+    """把未压缩的 JSON 数组备份按元素边界切成约 chunk_bytes 的字节区间
+
+    只读取切分点附近的少量字节，不解析整个文件。
+    Args:
+        start_offset: 续传时从该偏移（某个元素结束处）之后的元素开始切分
+    Returns:
+        [(start, end), ...]，每个区间是若干完整元素（不含首尾的方括号与分隔逗号）
+    """
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as f:
+        head = f.read(4096)
+        stripped = head.lstrip()
+        tail_offset = max(size - 4096, 0)
+        f.seek(tail_offset)
+        tail = f.read().rstrip()
+        if not stripped.startswith(b'[') or not tail.endswith(b']'):
+            raise ValueError("顶层结构不是 JSON 数组")
+        start = len(head) - len(stripped) + 1
+        end = tail_offset + len(tail) - 1
+        if start_offset:
+            f.seek(start_offset)
+            window = f.read(4096)
+            rest = window.lstrip()
+            if start_offset + len(window) - len(rest) >= end:
+                return []
+            if not rest.startswith(b','):
+                raise ValueError(f"续传偏移 {start_offset} 不在元素边界上")
+            start = start_offset + len(window) - len(rest) + 1
+
+        ranges = []
+        pos = start
+        while end - pos > chunk_bytes:
+            split = _find_boundary(f, pos + chunk_bytes, end)
+            if split is None:
+                break
+            element_end, next_start = split
+            ranges.append((pos, element_end))
+            pos = next_start
+        ranges.append((pos, end))
+        return ranges
+
+
+def _find_boundary(f, offset: int, end: int):
+    """从 offset 起查找下一个元素边界，返回 (前一元素结束位置, 下一元素起始位置)"""
+    while offset < end:
+        f.seek(offset)
+        window = f.read(min(BOUNDARY_WINDOW, end - offset))
+        match = _ELEMENT_BOUNDARY.search(window)
+        if match:
+            return offset + match.start() + 1, offset + match.end()
+        # 保留窗口末尾的少量字节，避免边界恰好跨两个窗口
+        offset += max(len(window) - 64, 1)
+    return None
+
+
+def decode_range(file_path: str, start: int, end: int, user_id: str, batch_size: int,
+                 high_water_marks: dict = None, copy_text: bool = False, skip_records: int = 0) -> Tuple[list, int, int]:
+    """在解析进程中运行：读取 [start, end) 的字节，解析为消息并转换成写库批次
+
+    Args:
+        high_water_marks: 增量导入时各会话的高水位，早于它的消息在此丢弃
+        copy_text: 为 True 时每批直接序列化为 CopyBatch，传回主进程的只是一个字符串
+        skip_records: 续传时区间开头已提交过的消息数，直接丢弃
+    Returns:
+        ([(批次, 区间内截至该批次解析过的消息数), ...], 早于高水位而跳过的消息数, 区间内解析过的消息总数)；
+        区间不是完整的元素序列（误切）时返回 None
+    Raises:
+        InvalidMessageError: 消息缺少字段
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    try:
+        messages = _loads(b'[' + data + b']')
+    except json.JSONDecodeError:
+        # orjson.JSONDecodeError 也是 json.JSONDecodeError 的子类；不把整块数据随异常传回主进程
+        return None
+    batches = []
+    skipped = 0
+    consumed = skip_records
+    for batch in iter_batches(messages[skip_records:], batch_size):
+        consumed += len(batch)
+        rows = [message_row(message, user_id) for message in batch]
+        if high_water_marks:
+            rows = skip_old_rows(rows, high_water_marks)
+            skipped += len(batch) - len(rows)
+            if not rows:
+                continue
+        batches.append((CopyBatch(to_copy_text(rows), len(rows)) if copy_text else rows, consumed))
+    return batches, skipped, consumed
+
+
+class ParallelDecoder:
+    """用进程池并行解析单个大备份文件
+
+    主进程只计算切分点；各解析进程自行读取各自的字节区间，用 orjson（未安装时用 json）解析，
+    转换成 MessageRecord（COPY 写入时直接序列化成 COPY 文本）后传回，主进程只负责写库。
+    结果按文件顺序产出，同时在途的区间数有上限，内存占用与文件大小无关。
+    """
+
+    def __init__(self, workers: int = None, chunk_bytes: int = DECODE_CHUNK_BYTES):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_bytes = chunk_bytes
+        self._pool = None
+
+    def iter_batches(self, file_path: str, user_id: str, batch_size: int, high_water_marks: dict = None,
+                     copy_text: bool = False, resume: BackupPosition = None
+                     ) -> Iterator[Tuple[list, int, int, BackupPosition]]:
+        """按文件顺序产出 (批次, 该区间内早于高水位而跳过的消息数, 已解析到的文件偏移, 续做位置)
+
+        批次为 MessageRecord 列表，copy_text 为 True 时为 CopyBatch；跳过数只随区间的第一个批次产出。
+        区间中途的续做位置以前一个区间的结束处为基准，再跳过区间内已产出的消息。
+        Args:
+            resume: 从检查点记录的位置续做，为空时从头解析
+        Raises:
+            ValueError: 文件不是合法的 JSON 数组
+        """
+        resume = resume or BackupPosition()
+        ranges = split_backup_file(file_path, self.chunk_bytes, resume.byte_offset)
+        # 每个区间之前最后一个元素的结束位置
+        boundaries = dict(zip((start for start, _ in ranges), [resume.byte_offset] + [end for _, end in ranges]))
+        first_start = ranges[0][0] if ranges else None
+        records = resume.records
+        pool = self._get_pool()
+        options = (user_id, batch_size, high_water_marks, copy_text)
+        in_flight = deque()
+        pending = iter(ranges)
+        carry = None  # 因误切而解析失败的区间起点，与后续区间合并后重新解析
+
+        def skip_for(start):
+            return resume.skip_records if start == first_start else 0
+
+        def submit_next():
+            for start, end in pending:
+                future = pool.submit(decode_range, file_path, start, end, *options, skip_for(start))
+                in_flight.append((start, end, future))
+                return
+
+        for _ in range(self.workers * 2):
+            submit_next()
+
+        while in_flight:
+            start, end, future = in_flight.popleft()
+            submit_next()
+            if carry is None:
+                result = future.result()
+            else:
+                future.cancel()
+                start = carry
+                result = decode_range(file_path, start, end, *options, skip_for(start))
+            if result is None:
+                if carry is None:
+                    carry = start
+                continue
+            batches, skipped, consumed = result
+            carry = None
+            boundary, skip = boundaries[start], skip_for(start)
+            if not batches:
+                yield [], skipped, end, BackupPosition(end, 0, records + consumed - skip)
+            for i, (batch, batch_consumed) in enumerate(batches):
+                if batch_consumed == consumed:
+                    position = BackupPosition(end, 0, records + consumed - skip)
+                else:
+                    position = BackupPosition(boundary, batch_consumed, records + batch_consumed - skip)
+                yield batch, skipped if i == 0 else 0, end, position
+            records += consumed - skip
+
+        if carry is not None:
+            raise ValueError(f"备份文件格式错误，无法解析偏移 {carry} 之后的内容")
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,108 +1,308 @@
 import boto3
 import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import List
 import shutil
 from db_manager import DatabaseManager
+from json_stream import iter_batches
+from message_loader import LoadStats, SeenMessages
+# 逐个处理时攒够 FINALIZE_BATCH_SIZE 个导入成功的用户后一次标记为已处理并加入归档队列
+from backup_pipeline import BackupPipeline, FINALIZE_BATCH_SIZE
+from s3_inventory import S3Inventory
+from s3_stream import S3BackupStream
+from s3_archiver import S3Archiver, ArchiveWorker
+from parallel_decode import ParallelDecoder
+import metrics
+
+# 并发列举用户时的分片数；分片按用户ID首字符在该字母表上均匀切分
+LIST_WORKERS = 8
+USER_ID_SHARD_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# 批量检查用户是否已处理时每批的用户数
+USER_FILTER_BATCH_SIZE = 200
 
 class S3BackupManager:
     def __init__(self):
-        self.s3_client = boto3.client('s3')
+        self.s3_client = metrics.instrument_s3_client(boto3.client('s3'))
         self.bucket_name = 'flow-app-uploads-temp'
         self.base_prefix = 'app-user-messages/'
         self.download_base_dir = 'downloaded_backups'
-        self.db_manager = DatabaseManager()
+        self.db_manager = DatabaseManager(cache_processed_users=True)
+        self.inventory = S3Inventory(
+            self.s3_client,
+            self.bucket_name,
+            self.base_prefix,
+            self.db_manager,
+            manifest_prefix=os.getenv('S3_INVENTORY_PREFIX')
+        )
+        self.archiver = S3Archiver(self.s3_client, self.bucket_name)
+        self.archive_worker = ArchiveWorker(self)
+        # 设置后正在进行的处理在当前用户完成后停止，不再开始新的用户（用于优雅退出）
+        self.stopping = threading.Event()
+        # 正在导入的用户：扫描与事件处理在不同线程中进行，同一用户同时只由一方处理
+        self._active_users = set()
+        self._active_users_lock = threading.Lock()
+        metrics.QUEUE_DEPTH.set_function(lambda: self.db_manager.queue_depth('archive'), queue='archive')
+
+    def claim_user(self, user_id: str) -> bool:
+        """开始导入用户前认领，用户正由其他线程导入时返回 False"""
+        with self._active_users_lock:
+            if user_id in self._active_users:
+                return False
+            self._active_users.add(user_id)
+            return True
+
+    def release_user(self, user_id: str):
+        with self._active_users_lock:
+            self._active_users.discard(user_id)
 
     def process_user_backups(self, user_id: str) -> bool:
-        """下载并处理用户的备份文件"""
+        """按时间顺序导入用户的所有备份文件，跨文件去重"""
         # 检查用户是否已经处理过
         if self.db_manager.is_user_processed(user_id):
             print(f"用户 {user_id} 已经处理过，跳过处理")
             return True
 
-        download_dir = self.download_user_backups(user_id)
-        if not download_dir:
-            return False
-
-        success = True
         try:
-            # 处理下载目录中的所有备份文件
-            for file_name in os.listdir(download_dir):
-                file_path = os.path.join(download_dir, file_name)
-                if not self.db_manager.process_backup_file(file_path, user_id):
-                    success = False
-                    break
+            success = self._load_backups(user_id, self.user_backups_in_order(user_id), incremental=False)
 
-            # 处理完成后移动到已处理目录并标记用户为已处理
+            # 处理完成后标记用户为已处理
             if success:
                 # self.move_user_directory(user_id, "processed-backups")
-                self.db_manager.mark_user_as_processed(user_id)
-
-            # 清理下载目录
-            shutil.rmtree(download_dir)
+                self.db_manager.mark_users_as_processed([user_id])
+                self.inventory.mark_users_processed([user_id])
             return success
 
         except Exception as e:
             print(f"处理用户备份时出错: {e}")
             return False
 
-    def process_all_backups(self):
-        """处理所有用户的备份文件，每个用户只处理最早的备份"""
+    def process_all_backups(self, pipeline: bool = False, use_inventory: bool = False, sync: bool = False,
+                            stream_s3: bool = False, parse_workers: int = None, all_backups: bool = False,
+                            **pipeline_options):
+        """处理所有用户的备份文件，每个用户只处理最早的备份（all_backups 为 True 时处理全部备份）
+
+        Args:
+            pipeline: 为 True 时使用 BackupPipeline 并发处理多个用户，
+                pipeline_options 透传给 BackupPipeline（各阶段并发数、队列大小等）
+            use_inventory: 为 True 时从本地 S3 清单获取待处理备份，不再逐个用户列举
+            sync: 为 True 时已处理过的用户有新备份也会导入，只写入各会话高水位之后的消息
+            stream_s3: 为 True 时直接从 S3 流式解析备份（大对象分段并发下载），不写临时文件
+            parse_workers: 解析进程数。流水线模式下为解析进程池大小；逐个处理时大于 0 则把每个
+                下载到本地的备份切块并行解析（ParallelDecoder），为空时在当前线程解析
+            all_backups: 为 True 时按时间顺序导入每个用户前缀下的全部备份，跨文件按消息 id 去重，
+                每条不同的消息只写入一次；只支持逐个处理
+        """
+        if pipeline and all_backups:
+            raise ValueError("流水线模式不支持 all_backups")
+        # 导入完成的用户由后台线程归档；先启动它，续做上次中断时队列中剩余的用户
+        self.archive_worker.start()
+        if pipeline:
+            return BackupPipeline(
+                self, use_inventory=use_inventory, sync=sync, stream_s3=stream_s3, parse_workers=parse_workers,
+                **pipeline_options
+            ).run()
+
+        decoder = ParallelDecoder(parse_workers) if parse_workers else None
+        try:
+            return self._process_backups_serially(use_inventory, sync, stream_s3, decoder, all_backups)
+        finally:
+            if decoder:
+                decoder.close()
+
+    def _process_backups_serially(self, use_inventory: bool, sync: bool, stream_s3: bool,
+                                  decoder: ParallelDecoder = None, all_backups: bool = False) -> int:
         processed_count = 0
-        for user_id, earliest_backup in self.backup_processor():
-            # if processed_count >= 10:
-            #     print("已处理10条记录，测试完成")
-            #     break
+        # 导入成功、尚未标记的 (用户ID, 待归档的备份)；中断时未标记的用户下次扫描从检查点直接收尾
+        finished = []
+        pending = self.pending_backups(use_inventory=use_inventory, sync=sync)
+        try:
+            for user_id, earliest_backup, listed_keys in metrics.timed_iter(pending, 'list'):
+                # if processed_count >= 10:
+                #     print("已处理10条记录，测试完成")
+                #     break
+                if self.stopping.is_set():
+                    print("收到停止请求，不再处理新的用户")
+                    break
 
-            print(f"处理用户 {user_id} 的备份")
-            if self.db_manager.is_user_processed(user_id):
-                print(f"用户 {user_id} 已经处理过，跳过处理")
-                continue
+                archive_keys = self._ingest_user(
+                    user_id, earliest_backup, sync, stream_s3, decoder, all_backups, listed_keys
+                )
+                if archive_keys:
+                    finished.append((user_id, archive_keys))
+                if len(finished) >= FINALIZE_BATCH_SIZE:
+                    processed_count += self._finalize_users_safely(finished)
+                    finished = []
+        finally:
+            processed_count += self._finalize_users_safely(finished)
 
-            # 创建临时下载目录
-            user_download_dir = os.path.join(self.download_base_dir, user_id)
-            os.makedirs(user_download_dir, exist_ok=True)
+        return processed_count
 
-            try:
-                # 只下载最早的备份文件
-                file_name = os.path.basename(earliest_backup)
-                download_path = os.path.join(user_download_dir, file_name)
-                
-                print(f"Downloading {earliest_backup} to {download_path}")
-                self.s3_client.download_file(
-                    self.bucket_name,
-                    earliest_backup,
-                    download_path
+    def _finalize_users_safely(self, finished: list) -> int:
+        """收尾一批用户，返回完成的用户数；出错时只打印，这些用户下次扫描时重新收尾"""
+        try:
+            self.finalize_users(finished)
+        except Exception as e:
+            print(f"标记 {len(finished)} 个用户为已处理时出错: {e}")
+            return 0
+        for user_id, _ in finished:
+            print(f"用户 {user_id} 的备份处理完成")
+        return len(finished)
+
+    def process_backup(self, user_id: str, backup_key: str, sync: bool = False, stream_s3: bool = False,
+                       decoder: ParallelDecoder = None, all_backups: bool = False,
+                       listed_keys: List[str] = None) -> bool:
+        """导入用户的一个备份，成功后标记用户并加入归档队列；出错时返回 False，不抛出异常"""
+        archive_keys = self._ingest_user(user_id, backup_key, sync, stream_s3, decoder, all_backups, listed_keys)
+        if not archive_keys:
+            return False
+        try:
+            self.finalize_users([(user_id, archive_keys)])
+        except Exception as e:
+            print(f"处理用户备份时出错: {e}")
+            return False
+        print(f"用户 {user_id} 的备份处理完成")
+        return True
+
+    def _ingest_user(self, user_id: str, backup_key: str, sync: bool = False, stream_s3: bool = False,
+                     decoder: ParallelDecoder = None, all_backups: bool = False,
+                     listed_keys: List[str] = None) -> List[str]:
+        """导入用户的备份但不标记，成功时返回收尾时要归档的备份；失败时返回 None，不抛出异常
+
+        all_backups 为 True 时不只导入 backup_key，而是按时间顺序导入 listed_keys 中的全部备份。
+        listed_keys 为选中该用户时列举到的全部备份（按时间排列），成功后整体归档，与原来移动整个目录相同；
+        为空时在这里重新列举。之后才上传的备份不在其中，留给下次导入。
+        用户正由其他线程导入时直接返回 None。
+        """
+        if not self.claim_user(user_id):
+            print(f"用户 {user_id} 正在由其他线程导入，跳过")
+            return None
+        print(f"处理用户 {user_id} 的备份")
+
+        try:
+            if listed_keys is None:
+                listed_keys = self.user_backups_in_order(user_id)
+            # 处理备份文件；已处理过的用户只写入新消息
+            with metrics.span('ingest'):
+                incremental = sync and self.db_manager.is_user_processed(user_id)
+                backup_keys = listed_keys if all_backups else [backup_key]
+                success = self._load_backups(user_id, backup_keys, incremental, stream_s3, decoder)
+
+            if success:
+                return listed_keys or backup_keys
+            print(f"用户 {user_id} 的备份处理失败")
+
+        except Exception as e:
+            print(f"处理用户备份时出错: {e}")
+        finally:
+            self.release_user(user_id)
+        return None
+
+    def finalize_users(self, finished: list):
+        """收尾导入成功的用户：一条语句把整批用户标记为已处理，再逐个加入归档队列，最后批量更新清单
+
+        先标记再归档：归档后备份不再出现在前缀下，未标记的用户就不会再被发现。
+
+        Args:
+            finished: (用户ID, 待归档的备份) 列表
+        """
+        if not finished:
+            return
+        user_ids = [user_id for user_id, _ in finished]
+        with metrics.span('finalize'):
+            self.db_manager.mark_users_as_processed(user_ids)
+            for user_id, archive_keys in finished:
+                self.archive_user_directory(user_id, "processed-backups", archive_keys)
+            self.inventory.mark_users_processed(user_ids)
+
+    def _load_backups(self, user_id: str, backup_keys: List[str], incremental: bool, stream_s3: bool = False,
+                      decoder: ParallelDecoder = None) -> bool:
+        """依次导入用户的备份；多个备份共用一个 SeenMessages，后面的文件只写入之前没有写过或内容有变化的消息
+
+        去重集合有上限（SEEN_MESSAGES_MAX_ENTRIES），消息特别多的用户超出部分由 ON CONFLICT 去重，内存仍有界。
+
+        中断后续做时已完成的文件直接跳过，其中的消息不在去重集合中，与之重复的行交给 ON CONFLICT 处理。
+        """
+        if not backup_keys:
+            print(f"No backup files found for user {user_id}")
+            return False
+        seen = SeenMessages() if len(backup_keys) > 1 else None
+        for backup_key in backup_keys:
+            if stream_s3:
+                stats = self._stream_backup(user_id, backup_key, incremental, seen=seen)
+            else:
+                stats = self._download_backup(user_id, backup_key, incremental, decoder, seen)
+            if not stats:
+                return False
+        if seen is not None:
+            print(f"用户 {user_id} 的 {len(backup_keys)} 个备份共有 {len(seen)} 条不同的消息")
+            if seen.untracked:
+                print(f"去重集合已满（{seen.max_entries} 条），{seen.untracked} 条消息交给 ON CONFLICT 去重")
+        return True
+
+    def _download_backup(self, user_id: str, backup_key: str, incremental: bool, decoder: ParallelDecoder = None,
+                         seen: SeenMessages = None):
+        """下载备份到临时目录后导入，完成后清理临时目录；上次中断的文件只流式读取未完成的部分"""
+        checkpoint, size = self.load_backup_checkpoint(backup_key)
+        if checkpoint.done:
+            print(f"{backup_key} 已全部导入，跳过")
+            return LoadStats()
+        if checkpoint.resuming:
+            return self._stream_backup(user_id, backup_key, incremental, checkpoint, size, seen)
+
+        user_download_dir = os.path.join(self.download_base_dir, user_id)
+        os.makedirs(user_download_dir, exist_ok=True)
+        try:
+            download_path = os.path.join(user_download_dir, os.path.basename(backup_key))
+            print(f"Downloading {backup_key} to {download_path}")
+            self.download_file(backup_key, download_path)
+            with metrics.span('load'):
+                return self.db_manager.process_backup_file(
+                    download_path, user_id, incremental=incremental, decoder=decoder, checkpoint=checkpoint,
+                    seen=seen
                 )
+        finally:
+            shutil.rmtree(user_download_dir, ignore_errors=True)
 
-                # 处理备份文件
-                if self.db_manager.process_backup_file(download_path, user_id):
-                    # 处理成功后移动文件并标记用户
-                    self.move_user_directory(user_id, "processed-backups")
-                    self.db_manager.mark_user_as_processed(user_id)
-                    processed_count += 1
-                    print(f"用户 {user_id} 的备份处理完成")
-                else:
-                    print(f"用户 {user_id} 的备份处理失败")
+    def _stream_backup(self, user_id: str, backup_key: str, incremental: bool, checkpoint=None, size: int = None,
+                       seen: SeenMessages = None):
+        """边下载边解析备份，不落盘；上次中断的文件从检查点处继续"""
+        if checkpoint is None:
+            checkpoint, size = self.load_backup_checkpoint(backup_key)
+        if checkpoint.done:
+            print(f"{backup_key} 已全部导入，跳过")
+            return LoadStats()
+        print(f"Streaming s3://{self.bucket_name}/{backup_key}")
+        with S3BackupStream(self.s3_client, self.bucket_name, backup_key, size=size,
+                            offset=checkpoint.position.byte_offset) as backup, metrics.span('load'):
+            return self.db_manager.process_backup_stream(backup, user_id, incremental=incremental,
+                                                         checkpoint=checkpoint, seen=seen)
 
-                # 清理下载目录
-                shutil.rmtree(user_download_dir)
+    def download_file(self, backup_key: str, download_path: str):
+        """下载单个备份文件到本地，记录下载耗时与字节数"""
+        with metrics.span('download'), metrics.S3_DOWNLOAD_SECONDS.time():
+            self.s3_client.download_file(self.bucket_name, backup_key, download_path)
+        metrics.S3_DOWNLOAD_BYTES.inc(os.path.getsize(download_path))
 
-            except Exception as e:
-                print(f"处理用户备份时出错: {e}")
-                if os.path.exists(user_download_dir):
-                    shutil.rmtree(user_download_dir)
-                continue
+    def load_backup_checkpoint(self, backup_key: str) -> tuple:
+        """读取备份文件的导入检查点，ETag 与当前对象不同时从头开始
+
+        Returns:
+            (IngestCheckpoint, 对象大小)
+        """
+        head = self.s3_client.head_object(Bucket=self.bucket_name, Key=backup_key)
+        return self.db_manager.get_ingest_checkpoint(backup_key, head['ETag']), head['ContentLength']
 
     def list_user_backups(self, user_id: str) -> List[str]:
         prefix = f"{self.base_prefix}{user_id}/"
-        response = self.s3_client.list_objects_v2(
+        backup_files = []
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(
             Bucket=self.bucket_name,
             Prefix=prefix
-        )
-        
-        backup_files = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
+        ):
+            for obj in page.get('Contents', []):
                 if obj['Key'].endswith('.json'):
                     backup_files.append(obj['Key'])
         
@@ -125,84 +325,177 @@ class S3BackupManager:
             download_path = os.path.join(user_download_dir, file_name)
             
             print(f"Downloading {file_key} to {download_path}")
-            self.s3_client.download_file(
-                self.bucket_name,
-                file_key,
-                download_path
-            )
+            self.download_file(file_key, download_path)
 
         return user_download_dir
 
-    def move_user_directory(self, user_id: str, destination: str) -> bool:
+    def move_user_directory(self, user_id: str, destination: str, keys: List[str] = None) -> bool:
         """在 S3 上将用户的备份文件移动到新位置
+
+        服务端并发复制（大对象分段复制），再按 1000 个一批删除源文件；中断后重新调用会跳过已复制的文件。
         Args:
             user_id: 用户ID
             destination: 目标前缀，例如 'processed-backups'
+            keys: 只移动这些文件；为空时移动用户前缀下的全部备份
         """
-        source_prefix = f"{self.base_prefix}{user_id}/"
-        backup_files = self.list_user_backups(user_id)
-        
-        if not backup_files:
-            print(f"No files found for user {user_id}")
-            return False
-
         try:
-            for file_key in backup_files:
-                # 构建新的目标路径
-                file_name = os.path.basename(file_key)
-                new_key = f"{destination}/{user_id}/{file_name}"
-                
-                # 复制文件到新位置
-                print(f"Moving {file_key} to {new_key}")
-                self.s3_client.copy_object(
-                    Bucket=self.bucket_name,
-                    CopySource={'Bucket': self.bucket_name, 'Key': file_key},
-                    Key=new_key
+            if keys:
+                moved = self.archiver.move_keys(keys, f"{destination}/{user_id}/")
+            else:
+                moved = self.archiver.move_prefix(
+                    f"{self.base_prefix}{user_id}/",
+                    f"{destination}/{user_id}/",
+                    suffix='.json'
                 )
-                
-                # 删除原文件
-                self.s3_client.delete_object(
-                    Bucket=self.bucket_name,
-                    Key=file_key
-                )
-            
-            print(f"Successfully moved all files for user {user_id} to {destination}")
-            return True
-            
         except Exception as e:
             print(f"Error moving files in S3: {e}")
             return False
 
-    def list_user_ids(self) -> List[str]:
-        """列出所有存在备份的用户ID"""
-        response = self.s3_client.list_objects_v2(
-            Bucket=self.bucket_name,
-            Prefix=self.base_prefix,
-            Delimiter='/'
-        )
-        
-        user_ids = []
-        if 'CommonPrefixes' in response:
-            for prefix in response['CommonPrefixes']:
+        if not moved:
+            # 之前的移动可能已在删除源文件后中断，没有剩余文件即视为已完成
+            print(f"No files left to move for user {user_id}")
+        else:
+            print(f"Successfully moved {moved} files for user {user_id} to {destination}")
+        return True
+
+    def archive_user_directory(self, user_id: str, destination: str, keys: List[str]):
+        """把选中用户时列举到的备份文件加入归档队列，由后台归档线程异步移动，导入流程无需等待 S3
+
+        只移动 keys：列举之后才上传的备份留在用户前缀下，由下次导入处理。
+        """
+        self.db_manager.enqueue_user_archive(user_id, destination, keys)
+        self.archive_worker.start()
+        self.archive_worker.notify()
+
+    def list_user_ids(self, list_workers: int = LIST_WORKERS) -> List[str]:
+        """列出所有存在备份的用户ID（分页并按前缀区间并发列举）"""
+        return sorted(self._iter_concurrently(
+            [partial(self._list_user_id_shard, lower, upper) for lower, upper in self._user_id_shards(list_workers)],
+            list_workers
+        ))
+
+    def _user_id_shards(self, shards: int):
+        """将用户ID的键空间按首字符切分为 shards 个左闭右开区间，None 表示不设边界"""
+        shards = max(1, min(shards, len(USER_ID_SHARD_ALPHABET)))
+        step = len(USER_ID_SHARD_ALPHABET) / shards
+        bounds = [USER_ID_SHARD_ALPHABET[int(i * step)] for i in range(1, shards)]
+        return list(zip([None] + bounds, bounds + [None]))
+
+    def _list_user_id_shard(self, lower: str = None, upper: str = None):
+        """生成器：分页列举 [lower, upper) 区间内的用户ID"""
+        params = {
+            'Bucket': self.bucket_name,
+            'Prefix': self.base_prefix,
+            'Delimiter': '/'
+        }
+        if lower:
+            # StartAfter 之后的键都大于 base_prefix + lower，即用户ID >= lower
+            params['StartAfter'] = f"{self.base_prefix}{lower}"
+        upper_prefix = f"{self.base_prefix}{upper}" if upper else None
+
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(**params):
+            for prefix in page.get('CommonPrefixes', []):
+                if upper_prefix and prefix['Prefix'] >= upper_prefix:
+                    return
                 # 从路径中提取用户ID
-                user_id = prefix['Prefix'].replace(self.base_prefix, '').rstrip('/')
-                user_ids.append(user_id)
-        
-        return user_ids
+                yield prefix['Prefix'][len(self.base_prefix):].rstrip('/')
+
+    def _list_earliest_backups(self, lower: str = None, upper: str = None):
+        for user_id in self._list_user_id_shard(lower, upper):
+            backup_keys = self.user_backups_in_order(user_id)
+            if backup_keys:
+                yield user_id, backup_keys[0], backup_keys
+
+    def earliest_backup(self, user_id: str):
+        """用户前缀下最早的备份文件，没有备份时返回 None"""
+        backup_files = self.list_user_backups(user_id)
+        if not backup_files:
+            return None
+
+        # 通过文件名（时间戳）找出最早的备份
+        return min(backup_files, key=self._backup_timestamp)
+
+    def user_backups_in_order(self, user_id: str) -> List[str]:
+        """用户前缀下的全部备份文件，按文件名（时间戳）从早到晚排列"""
+        return sorted(self.list_user_backups(user_id), key=self._backup_timestamp)
+
+    @staticmethod
+    def _backup_timestamp(backup_key: str) -> int:
+        return int(os.path.basename(backup_key).replace('.json', ''))
+
+    @staticmethod
+    def _iter_concurrently(producers, max_workers: int):
+        """在线程池中并发运行多个生成器，每产生一个结果就立即返回给调用方
+
+        任一生成器抛出的异常会在调用方重新抛出；调用方提前结束迭代时通知其余生成器停止。
+        """
+        results = queue.Queue()
+        stop = threading.Event()
+        finished = object()
+
+        def run(producer):
+            try:
+                for item in producer():
+                    if stop.is_set():
+                        break
+                    results.put(item)
+            except Exception as e:
+                results.put(e)
+            finally:
+                results.put(finished)
+
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            for producer in producers:
+                executor.submit(run, producer)
+            remaining = len(producers)
+            while remaining:
+                item = results.get()
+                if item is finished:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
 
-    def backup_processor(self):
+    def pending_backups(self, use_inventory: bool = False, batch_size: int = USER_FILTER_BATCH_SIZE,
+                        sync: bool = False):
+        """生成器：在 backup_processor 的基础上过滤掉已处理的用户
+
+        每 batch_size 个用户只查询一次数据库，而不是每个用户一次。
+        sync 为 True 时不过滤：已处理用户的备份在处理后会被移走，仍留在前缀下的都是新备份。
+        yields: (user_id, earliest_backup_file, listed_keys)
+        """
+        if sync:
+            yield from self.backup_processor(use_inventory=use_inventory, include_processed_users=True)
+            return
+        for candidates in iter_batches(self.backup_processor(use_inventory=use_inventory), batch_size):
+            pending = set(self.db_manager.filter_unprocessed_users(user_id for user_id, *_ in candidates))
+            skipped = len(candidates) - len(pending)
+            if skipped:
+                print(f"跳过 {skipped} 个已经处理过的用户")
+            for candidate in candidates:
+                if candidate[0] in pending:
+                    yield candidate
+
+    def backup_processor(self, list_workers: int = LIST_WORKERS, use_inventory: bool = False,
+                         include_processed_users: bool = False):
         """生成器：逐个处理用户的最早备份文件
-        yields: (user_id, earliest_backup_file)
+
+        按用户ID前缀区间并发列举，找到一个用户就立即产出，不等待全部列举完成。
+        use_inventory 为 True 时先增量刷新本地清单，再从清单中一次查出所有待处理用户。
+        yields: (user_id, earliest_backup_file, 该用户的全部备份（按时间排列），成功后整体归档)
         """
-        user_ids = self.list_user_ids()
-        for user_id in user_ids:
-            backup_files = self.list_user_backups(user_id)
-            if not backup_files:
-                continue
-                
-            # 通过文件名（时间戳）找出最早的备份
-            earliest_backup = min(
-                backup_files,
-                key=lambda x: int(os.path.basename(x).replace('.json', ''))
-            )
-            yield user_id, earliest_backup
\ No newline at end of file
+        if use_inventory:
+            written = self.inventory.refresh()
+            print(f"S3 清单刷新完成，写入 {written} 个对象")
+            yield from self.inventory.pending_backups(include_processed_users=include_processed_users)
+            return
+
+        yield from self._iter_concurrently(
+            [partial(self._list_earliest_backups, lower, upper) for lower, upper in self._user_id_shards(list_workers)],
+            list_workers
+        )
@@ -0,0 +1,190 @@
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
+from json_stream import iter_batches
+
+# 单次 CopyObject 最大 5 GB；超过 multipart_threshold 的对象用 UploadPartCopy 分段并发复制
+ARCHIVE_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=256 * 1024 * 1024,
+    multipart_chunksize=256 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+# 并发复制的对象数
+ARCHIVE_COPY_WORKERS = 8
+# delete_objects 每次请求最多 1000 个 key
+DELETE_BATCH_SIZE = 1000
+
+
+class S3Archiver:
+    """在同一存储桶内服务端移动对象：并发复制（大对象分段复制），再批量删除源对象
+
+    移动可以安全地重复执行：目标已存在且大小相同的对象不再复制，只删除源对象，
+    因此中途中断后重新调用即可从断点继续。
+    """
+
+    def __init__(self, s3_client, bucket: str, copy_workers: int = ARCHIVE_COPY_WORKERS,
+                 transfer_config: TransferConfig = None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.copy_workers = copy_workers
+        self.transfer_config = transfer_config or ARCHIVE_TRANSFER_CONFIG
+
+    def move_prefix(self, source_prefix: str, destination_prefix: str, suffix: str = '') -> int:
+        """把 source_prefix 下（以 suffix 结尾）的对象移动到 destination_prefix 下，保留文件名
+
+        Returns:
+            移动的对象数
+        Raises:
+            任一对象复制或删除失败时抛出异常，已完成的部分下次调用时会被跳过
+        """
+        sources = {key: size for key, size in self._list(source_prefix) if key.endswith(suffix)}
+        return self._move(sources, destination_prefix)
+
+    def move_keys(self, keys, destination_prefix: str) -> int:
+        """把指定的对象移动到 destination_prefix 下，保留文件名；与之同目录的其他对象不动
+
+        已不存在的 key（上次移动中断前已删除）直接跳过。返回值与异常同 move_prefix。
+        """
+        keys = set(keys)
+        directories = {key.rsplit('/', 1)[0] + '/' for key in keys}
+        sources = {
+            key: size
+            for directory in directories
+            for key, size in self._list(directory)
+            if key in keys
+        }
+        return self._move(sources, destination_prefix)
+
+    def _move(self, sources: dict, destination_prefix: str) -> int:
+        """sources 为 {源 key: 大小}"""
+        if not sources:
+            return 0
+        existing = dict(self._list(destination_prefix))
+
+        pending = []
+        for key, size in sources.items():
+            new_key = f"{destination_prefix}{os.path.basename(key)}"
+            if existing.get(new_key) != size:
+                pending.append((key, new_key, size))
+        if pending:
+            print(f"Copying {len(pending)} objects to {destination_prefix}"
+                  f"（{len(sources) - len(pending)} 个已复制，跳过）")
+            with ThreadPoolExecutor(max_workers=self.copy_workers) as pool:
+                # list() 让任一复制失败的异常在删除之前抛出
+                list(pool.map(lambda item: self._copy(*item), pending))
+
+        self._delete(list(sources))
+        return len(sources)
+
+    def _list(self, prefix: str):
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key'], obj['Size']
+
+    def _copy(self, key: str, new_key: str, size: int):
+        if size < self.transfer_config.multipart_threshold:
+            # 列举时已知大小，小对象直接 CopyObject，省去 s3_client.copy 内部的 HEAD 请求
+            self.s3_client.copy_object(
+                Bucket=self.bucket,
+                CopySource={'Bucket': self.bucket, 'Key': key},
+                Key=new_key
+            )
+            return
+        self.s3_client.copy(
+            {'Bucket': self.bucket, 'Key': key},
+            self.bucket,
+            new_key,
+            Config=self.transfer_config
+        )
+
+    def _delete(self, keys):
+        for batch in iter_batches(keys, DELETE_BATCH_SIZE):
+            resp = self.s3_client.delete_objects(
+                Bucket=self.bucket,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+            )
+            errors = resp.get('Errors', [])
+            if errors:
+                raise RuntimeError(f"删除 {len(errors)} 个对象失败，例如 {errors[0]['Key']}: {errors[0].get('Message')}")
+
+
+class ArchiveWorker:
+    """后台归档线程：从数据库归档队列认领用户并移动其备份，不占用导入的关键路径
+
+    队列保存在数据库中，进程退出时未完成的认领在租约过期后被重新认领，
+    S3Archiver 会跳过已复制的对象，从断点继续。
+    """
+
+    def __init__(self, manager, take: int = 10, poll_interval: float = 30, lease_seconds: int = 3600):
+        """
+        Args:
+            manager: S3BackupManager，提供 archiver、db_manager 和用户前缀
+            take: 每次认领的用户数
+            poll_interval: 队列为空时轮询间隔（秒），notify() 可提前唤醒
+            lease_seconds: 认领租约，应大于归档单个用户所需的最长时间
+        """
+        self.manager = manager
+        self.db_manager = manager.db_manager
+        self.take = take
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}-archive"
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._drain = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            self._drain = False
+            self._thread = threading.Thread(target=self._run, name='archive-worker', daemon=True)
+            self._thread.start()
+
+    def notify(self):
+        """有新用户入队时唤醒归档线程"""
+        self._wake.set()
+
+    def stop(self, drain: bool = True):
+        """停止归档线程；drain 为 True 时先处理完队列中剩余的用户"""
+        if self._thread is None:
+            return
+        self._drain = drain
+        self._stopped.set()
+        self._wake.set()
+        self._thread.join()
+        self._thread = None
+
+    def run_once(self) -> int:
+        """认领并归档队列中的用户直到队列为空，返回成功归档的用户数"""
+        archived = 0
+        while True:
+            claimed = self.db_manager.claim_archive_users(self.take, self.worker_id, self.lease_seconds)
+            if not claimed:
+                return archived
+            for user_id, destination in claimed:
+                keys = self.db_manager.get_archive_keys(user_id)
+                success = self.manager.move_user_directory(user_id, destination, keys or None)
+                self.db_manager.complete_user_archive(user_id, success, keys)
+                archived += success
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._run_safely()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+        if self._drain:
+            self._run_safely()
+
+    def _run_safely(self):
+        try:
+            # 上一轮失败的用户每轮重试一次
+            self.db_manager.retry_failed_archives()
+            archived = self.run_once()
+            if archived:
+                print(f"后台归档完成 {archived} 个用户")
+        except Exception as e:
+            print(f"后台归档时出错: {e}")
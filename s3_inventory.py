@@ -0,0 +1,243 @@
+import csv
+import gzip
+import json
+import os
+from datetime import datetime
+from itertools import groupby
+from typing import Iterator, List, Tuple
+from urllib.parse import unquote_plus
+from sqlalchemy import case, delete, update
+from models import S3InventoryObject, S3InventoryState, ProcessedUser
+from message_loader import dialect_insert
+from db_manager import USER_ID_CHUNK_SIZE
+
+STATE_NAME = 'default'
+
+
+class S3Inventory:
+    """S3 备份文件的本地清单
+
+    refresh() 增量同步清单：配置了 S3 Inventory 时只在出现新的 manifest 时导入 CSV，
+    否则分页平铺列举整个前缀（每次请求 1000 个键），中断后用 StartAfter 从上次的键继续。
+    pending_backups() 一次查询即可得到所有待处理用户的最早备份，无需逐个用户列举。
+    """
+
+    def __init__(self, s3_client, bucket_name: str, base_prefix: str, db_manager, manifest_prefix: str = None):
+        """
+        Args:
+            manifest_prefix: S3 Inventory 报告所在位置，格式为 's3://bucket/prefix' 或同桶内的 'prefix'
+        """
+        self.s3_client = s3_client
+        self.bucket_name = bucket_name
+        self.base_prefix = base_prefix
+        self.db_manager = db_manager
+        self.manifest_prefix = manifest_prefix
+
+    def refresh(self) -> int:
+        """同步 S3 上的备份文件到本地清单，返回本次写入的对象数"""
+        if self.manifest_prefix:
+            return self._refresh_from_manifest()
+        return self._refresh_from_listing()
+
+    def pending_backups(self, include_processed_users: bool = False) -> Iterator[Tuple[str, str, List[str]]]:
+        """生成器：未处理用户的最早备份
+
+        include_processed_users 为 True 时，已处理用户之后新出现的备份也会产出。
+        yields: (user_id, earliest_backup_key, 清单中该用户的全部备份（按时间排列）)
+        """
+        session = self.db_manager.Session()
+        try:
+            query = session.query(S3InventoryObject.user_id, S3InventoryObject.key)\
+                .filter(S3InventoryObject.processed == False)
+            if not include_processed_users:
+                query = query.outerjoin(ProcessedUser, ProcessedUser.user_id == S3InventoryObject.user_id)\
+                    .filter(ProcessedUser.user_id == None)
+            rows = query.order_by(S3InventoryObject.user_id, S3InventoryObject.backup_ts).all()
+        finally:
+            session.close()
+
+        for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+            keys = [key for _, key in user_rows]
+            yield user_id, keys[0], keys
+
+    def mark_user_processed(self, user_id: str):
+        self.mark_users_processed([user_id])
+
+    def mark_users_processed(self, user_ids: List[str]):
+        """把这些用户在清单中的备份标记为已处理，每 USER_ID_CHUNK_SIZE 个用户一条 UPDATE"""
+        if not user_ids:
+            return
+        session = self.db_manager.Session()
+        try:
+            for i in range(0, len(user_ids), USER_ID_CHUNK_SIZE):
+                session.execute(
+                    update(S3InventoryObject)
+                    .where(S3InventoryObject.user_id.in_(user_ids[i:i + USER_ID_CHUNK_SIZE]))
+                    .values(processed=True)
+                )
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _refresh_from_listing(self) -> int:
+        state = self._load_state()
+        params = {'Bucket': self.bucket_name, 'Prefix': self.base_prefix}
+        if state.last_key:
+            # 上次全量列举中断，从最后写入的键之后继续
+            params['StartAfter'] = state.last_key
+            walk_started_at = state.walk_started_at
+        else:
+            walk_started_at = datetime.utcnow()
+
+        written = 0
+        for page in self.s3_client.get_paginator('list_objects_v2').paginate(**params):
+            contents = page.get('Contents', [])
+            if not contents:
+                continue
+            written += self._upsert(
+                [(obj['Key'], obj['ETag'], obj['Size'], obj['LastModified']) for obj in contents],
+                walk_started_at,
+                last_key=contents[-1]['Key']
+            )
+
+        self._finish_walk(walk_started_at)
+        return written
+
+    def _refresh_from_manifest(self) -> int:
+        manifest_bucket, prefix = self._parse_location(self.manifest_prefix)
+        manifest_keys = [
+            obj['Key']
+            for page in self.s3_client.get_paginator('list_objects_v2').paginate(Bucket=manifest_bucket, Prefix=prefix)
+            for obj in page.get('Contents', [])
+            if obj['Key'].endswith('/manifest.json')
+        ]
+        if not manifest_keys:
+            print(f"未找到 S3 Inventory manifest，回退到列举: {self.manifest_prefix}")
+            return self._refresh_from_listing()
+
+        # manifest 路径中包含 ISO 格式的生成时间，字典序最大即最新
+        latest = max(manifest_keys)
+        state = self._load_state()
+        if state.manifest_key == latest:
+            return 0
+
+        manifest = json.loads(self.s3_client.get_object(Bucket=manifest_bucket, Key=latest)['Body'].read())
+        if manifest.get('fileFormat', 'CSV') != 'CSV':
+            raise ValueError(f"不支持的 S3 Inventory 格式: {manifest.get('fileFormat')}")
+        schema = [column.strip() for column in manifest['fileSchema'].split(',')]
+        data_bucket = manifest.get('destinationBucket', manifest_bucket).split(':::')[-1]
+
+        walk_started_at = datetime.utcnow()
+        written = 0
+        for data_file in manifest['files']:
+            body = self.s3_client.get_object(Bucket=data_bucket, Key=data_file['key'])['Body']
+            with gzip.open(body, 'rt', encoding='utf-8', newline='') as f:
+                objects = []
+                for record in csv.reader(f):
+                    row = dict(zip(schema, record))
+                    key = unquote_plus(row['Key'])
+                    if key.startswith(self.base_prefix):
+                        objects.append((key, row.get('ETag'), int(row['Size']) if row.get('Size') else None,
+                                        self._parse_timestamp(row.get('LastModifiedDate'))))
+                    if len(objects) >= 1000:
+                        written += self._upsert(objects, walk_started_at)
+                        objects = []
+                written += self._upsert(objects, walk_started_at)
+
+        self._finish_walk(walk_started_at, manifest_key=latest)
+        return written
+
+    def _upsert(self, objects: List[Tuple], seen_at: datetime, last_key: str = None) -> int:
+        """写入一页对象，并在同一事务中记录列举进度"""
+        values = []
+        for key, etag, size, last_modified in objects:
+            if not key.endswith('.json'):
+                continue
+            user_id = key[len(self.base_prefix):].split('/', 1)[0]
+            name = os.path.basename(key).replace('.json', '')
+            values.append({
+                'key': key,
+                'user_id': user_id,
+                'backup_ts': int(name) if name.isdigit() else None,
+                'etag': etag.strip('"') if etag else etag,
+                'size': size,
+                'last_modified': last_modified,
+                'processed': False,
+                'seen_at': seen_at
+            })
+
+        session = self.db_manager.Session()
+        try:
+            if values:
+                table = S3InventoryObject.__table__
+                stmt = dialect_insert(self.db_manager.engine.dialect.name)(table)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['key'],
+                    set_={
+                        'etag': stmt.excluded.etag,
+                        'size': stmt.excluded.size,
+                        'last_modified': stmt.excluded.last_modified,
+                        'seen_at': stmt.excluded.seen_at,
+                        # 同名文件被重新上传（ETag 变化）时需要重新处理
+                        'processed': case((table.c.etag != stmt.excluded.etag, False), else_=table.c.processed)
+                    }
+                )
+                session.execute(stmt, values)
+            if last_key:
+                session.execute(
+                    update(S3InventoryState)
+                    .where(S3InventoryState.name == STATE_NAME)
+                    .values(last_key=last_key, walk_started_at=seen_at)
+                )
+            session.commit()
+            return len(values)
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _finish_walk(self, walk_started_at: datetime, manifest_key: str = None):
+        """一次完整列举结束：删除本轮未再出现的对象（已被移走或删除），清除续传位置"""
+        session = self.db_manager.Session()
+        try:
+            session.execute(delete(S3InventoryObject).where(S3InventoryObject.seen_at < walk_started_at))
+            values = {'last_key': None, 'walk_started_at': None}
+            if manifest_key:
+                values['manifest_key'] = manifest_key
+            session.execute(update(S3InventoryState).where(S3InventoryState.name == STATE_NAME).values(**values))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _load_state(self) -> S3InventoryState:
+        session = self.db_manager.Session()
+        try:
+            state = session.get(S3InventoryState, STATE_NAME)
+            if state is None:
+                state = S3InventoryState(name=STATE_NAME)
+                session.add(state)
+                session.commit()
+                state = session.get(S3InventoryState, STATE_NAME)
+            session.expunge(state)
+            return state
+        finally:
+            session.close()
+
+    def _parse_location(self, location: str) -> Tuple[str, str]:
+        if location.startswith('s3://'):
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            return bucket, prefix
+        return self.bucket_name, location
+
+    @staticmethod
+    def _parse_timestamp(value: str):
+        if not value:
+            return None
+        return datetime.fromisoformat(value.replace('Z', '+00:00'))
@@ -0,0 +1,251 @@
+import io
+import os
+import gzip
+import queue
+import threading
+from boto3.s3.transfer import TransferConfig
+
+# 大于 multipart_threshold 的对象拆成 multipart_chunksize 的分段并发 Range GET，
+# 分段按顺序交给解析器；io_chunksize 决定每次写入缓冲区的块大小
+STREAM_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=16 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=8,
+    io_chunksize=1024 * 1024,
+    use_threads=True
+)
+# 下载线程与解析之间最多缓冲的块数（每块 io_chunksize）
+STREAM_BUFFER_CHUNKS = 16
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+class _StreamClosed(Exception):
+    """读取方已关闭，终止后台下载"""
+
+
+class _ChunkPipe(io.RawIOBase):
+    """后台线程写入、解析线程读取的有界字节管道
+
+    写入端交给 s3transfer 的 download_fileobj：不可 seek 的目标会按偏移顺序写入，
+    多个分段并发下载、顺序交付。缓冲区满时写入阻塞，下载随之减速。
+    """
+
+    def __init__(self, max_chunks: int = STREAM_BUFFER_CHUNKS):
+        super().__init__()
+        self._chunks = queue.Queue(maxsize=max_chunks)
+        self._current = b''
+        self._offset = 0
+        self._eof = False
+        self._closed_by_reader = threading.Event()
+        self.bytes_read = 0
+
+    # 写入端
+    def write_chunk(self, data: bytes):
+        while True:
+            if self._closed_by_reader.is_set():
+                raise _StreamClosed()
+            try:
+                self._chunks.put(bytes(data), timeout=0.5)
+                return len(data)
+            except queue.Full:
+                continue
+
+    def finish(self, error: Exception = None):
+        while not self._closed_by_reader.is_set():
+            try:
+                self._chunks.put(error, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    # 读取端
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self._offset >= len(self._current):
+            if self._eof:
+                return 0
+            item = self._chunks.get()
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                self._eof = True
+                raise item
+            self._current, self._offset = item, 0
+        size = min(len(buffer), len(self._current) - self._offset)
+        buffer[:size] = self._current[self._offset:self._offset + size]
+        self._offset += size
+        self.bytes_read += size
+        return size
+
+    def close(self):
+        self._closed_by_reader.set()
+        super().close()
+
+
+class _PipeWriter:
+    """交给 download_fileobj 的写入对象，不可 seek"""
+
+    def __init__(self, pipe: _ChunkPipe):
+        self._pipe = pipe
+
+    def write(self, data):
+        return self._pipe.write_chunk(data)
+
+    def seekable(self):
+        return False
+
+
+class S3BackupStream:
+    """以文本流的形式读取 S3 上的备份对象，不落盘
+
+    后台线程用 download_fileobj 按 STREAM_TRANSFER_CONFIG 下载（大对象分段并发 Range GET），
+    解析线程从有界管道读取。gzip / zstd 压缩的备份按文件头自动解压（zstd 需要 zstandard 包）。
+    用法：
+
+        with S3BackupStream(s3_client, bucket, key) as stream:
+            for message in iter_json_array(stream.text):
+                ...
+    """
+
+    def __init__(self, s3_client, bucket: str, key: str, transfer_config: TransferConfig = None, size: int = None,
+                 offset: int = 0):
+        """
+        Args:
+            size: 对象大小（字节），已知时（如来自 S3 清单）传入可省去一次 HEAD 请求，仅用于显示进度
+            offset: 从解压后文本的该字节偏移处开始读取（断点续传）。未压缩的对象只用 Range GET
+                下载 offset 之后的部分；压缩的对象仍需从头下载解压，但跳过的部分不再解析
+        """
+        self.name = f"s3://{bucket}/{key}"
+        if size is None:
+            size = s3_client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self.total_bytes = size
+        ranged = False
+        if offset:
+            head = s3_client.get_object(Bucket=bucket, Key=key, Range='bytes=0-3')['Body'].read()
+            ranged = _detect_compression(head) == 'none'
+        self._base_offset = offset if ranged else 0
+        self._pipe = _ChunkPipe()
+        self._thread = threading.Thread(
+            target=self._download,
+            args=(s3_client, bucket, key, transfer_config or STREAM_TRANSFER_CONFIG, self._base_offset),
+            name=f"s3-stream-{key}",
+            daemon=True
+        )
+        self._thread.start()
+        try:
+            raw = io.BufferedReader(self._pipe, buffer_size=1024 * 1024)
+            if ranged:
+                self.compression = 'none'
+                stream = raw
+            else:
+                self.compression = _detect_compression(raw.peek(4)[:4])
+                stream = _decompress(raw, self.compression)
+                _skip_bytes(stream, offset)
+            self.text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        except BaseException:
+            # 没有返回给调用方就不会有人关闭：关闭管道让下载线程退出并释放 S3 响应体
+            self._pipe.close()
+            raise
+
+    def _download(self, s3_client, bucket, key, transfer_config, offset):
+        try:
+            if offset:
+                # download_fileobj 不支持 Range，续传时用单个 Range GET 顺序读取剩余部分
+                body = s3_client.get_object(Bucket=bucket, Key=key, Range=f'bytes={offset}-')['Body']
+                for chunk in body.iter_chunks(transfer_config.io_chunksize):
+                    self._pipe.write_chunk(chunk)
+            else:
+                s3_client.download_fileobj(bucket, key, _PipeWriter(self._pipe), Config=transfer_config)
+        except _StreamClosed:
+            return
+        except Exception as e:
+            self._pipe.finish(e)
+            return
+        self._pipe.finish()
+
+    @property
+    def bytes_read(self) -> int:
+        """已从 S3 读取到的（压缩后）对象偏移"""
+        return self._base_offset + self._pipe.bytes_read
+
+    def close(self):
+        self.text.close()
+        self._pipe.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _detect_compression(head: bytes) -> str:
+    if head.startswith(_GZIP_MAGIC):
+        return 'gzip'
+    if head.startswith(_ZSTD_MAGIC):
+        return 'zstd'
+    return 'none'
+
+
+def _decompress(raw, compression: str):
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError as e:
+            raise RuntimeError("读取 zstd 压缩的备份需要安装 zstandard 包") from e
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True))
+    return raw
+
+
+def _skip_bytes(stream, count: int):
+    """从二进制流中读取并丢弃 count 个字节"""
+    while count > 0:
+        data = stream.read(min(count, 1024 * 1024))
+        if not data:
+            raise ValueError("续传偏移超出了备份文件的长度")
+        count -= len(data)
+
+
+class LocalBackupFile:
+    """与 S3BackupStream 接口相同的本地备份文件，gzip / zstd 压缩的文件自动解压"""
+
+    def __init__(self, file_path: str, offset: int = 0):
+        """
+        Args:
+            offset: 从解压后文本的该字节偏移处开始读取（断点续传）；未压缩的文件直接 seek
+        """
+        self.name = file_path
+        self.total_bytes = os.path.getsize(file_path)
+        self._raw = open(file_path, 'rb')
+        try:
+            self.compression = _detect_compression(self._raw.peek(4)[:4])
+            stream = _decompress(self._raw, self.compression)
+            if self.compression == 'none':
+                self._raw.seek(offset)
+            else:
+                _skip_bytes(stream, offset)
+            self.text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        except BaseException:
+            self._raw.close()
+            raise
+
+    @property
+    def bytes_read(self) -> int:
+        return self._raw.raw.tell()
+
+    def close(self):
+        self.text.close()
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
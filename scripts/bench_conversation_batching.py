@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+import argparse
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversation import ConversationAPI
+from stub_gateway import StubGateway
+from bench_conversation_clients import synthetic_conversations
+from json_stream import iter_batches
+
+
+def run_per_conversation(api: ConversationAPI, conversations):
+    """改造前：每个会话一次 /info、一次 /update"""
+    for conversation in conversations:
+        resp = api.get_conversation_info(conversation["conversationId"])
+        if not resp.get('messages'):
+            api.update_conversation(conversation["conversationId"], conversation["messages"])
+
+
+def run_batched(api: ConversationAPI, conversations, group_size: int):
+    """与 migrate.process_conversations 相同：每组一次 /batchInfo，再装箱成 /batchUpdate"""
+    for group in iter_batches(conversations, group_size):
+        infos = api.get_conversations_info([conversation["conversationId"] for conversation in group])
+        api.update_conversations([
+            (conversation["conversationId"], conversation["messages"])
+            for conversation in group
+            if not infos[conversation["conversationId"]].get('messages')
+        ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="逐个会话请求与批量 + gzip 请求的请求数、线上字节数对比")
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=3, help="每个会话的消息数")
+    parser.add_argument('--group-size', type=int, default=100)
+    parser.add_argument('--max-bytes', type=int, default=1 << 20)
+    parser.add_argument('--max-messages', type=int, default=1000)
+    args = parser.parse_args()
+
+    conversations = synthetic_conversations(args.conversations, args.messages)
+    variants = [
+        ('per conversation', dict(batch=False), dict(compress=False), False),
+        ('batched + gzip', dict(batch=True), dict(), True),
+        ('batched, no batch API', dict(batch=False), dict(), True),
+        ('batched, no gzip support', dict(batch=True, accept_gzip=False), dict(), True),
+    ]
+
+    print(f"{'variant':>26} {'seconds':>8} {'requests':>9} {'wire MB':>8} {'messages':>9}")
+    for name, stub_options, api_options, batched in variants:
+        with StubGateway(**stub_options) as gateway:
+            api = ConversationAPI(gateway.base_url, batch_max_bytes=args.max_bytes,
+                                  batch_max_messages=args.max_messages, **api_options)
+            start = time.perf_counter()
+            if batched:
+                run_batched(api, conversations, args.group_size)
+            else:
+                run_per_conversation(api, conversations)
+            elapsed = time.perf_counter() - start
+            requests = sum(gateway.requests.values())
+            print(f"{name:>26} {elapsed:>8.2f} {requests:>9} {gateway.bytes_received / 1e6:>8.2f} "
+                  f"{gateway.messages_received:>9}")
+
+
+if __name__ == "__main__":
+    main()
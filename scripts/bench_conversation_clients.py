@@ -0,0 +1,80 @@
+import sys
+import os
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversation import ConversationAPI
+from async_conversation import AsyncConversationAPI
+from stub_gateway import StubGateway
+from message_record import MessageRecord
+
+
+def synthetic_conversations(count: int, messages_per_conversation: int):
+    return [
+        {
+            "conversationId": f"bench-conv-{i}",
+            "messages": [
+                MessageRecord(f"bench-{i}-{j}", None, "x" * 200, None, None, None, f"bench-conv-{i}")
+                for j in range(messages_per_conversation)
+            ]
+        }
+        for i in range(count)
+    ]
+
+
+def run_threaded(base_url: str, conversations, user_workers: int, conv_workers: int) -> float:
+    """与 migrate.py 相同的 user_workers × conv_workers 线程模型，共享一个 requests 会话"""
+    api = ConversationAPI(base_url)
+
+    def process(conversation):
+        resp = api.get_conversation_info(conversation["conversationId"])
+        if not resp.get('messages'):
+            api.update_conversation(conversation["conversationId"], conversation["messages"])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=user_workers * conv_workers) as executor:
+        list(executor.map(process, conversations))
+    return time.perf_counter() - start
+
+
+async def run_async(base_url: str, conversations, concurrency: int, max_connections: int, http2: bool) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncConversationAPI(base_url, max_connections=max_connections, http2=http2) as api:
+        async def process(conversation):
+            async with semaphore:
+                resp = await api.get_conversation_info(conversation["conversationId"])
+                if not resp.get('messages'):
+                    await api.update_conversation(conversation["conversationId"], conversation["messages"])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(process(conversation) for conversation in conversations))
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="线程池 + requests 与 asyncio 客户端在本地网关替身上的对比")
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=5, help="每个会话的消息数")
+    parser.add_argument('--latency', type=float, default=0.02, help="网关替身每个请求的延迟（秒）")
+    parser.add_argument('--concurrency', type=int, default=200, help="asyncio 客户端的全局并发数")
+    parser.add_argument('--max-connections', type=int, default=200)
+    args = parser.parse_args()
+
+    conversations = synthetic_conversations(args.conversations, args.messages)
+    print(f"{'client':>24} {'seconds':>9} {'conversations/sec':>18}")
+    with StubGateway(latency=args.latency) as gateway:
+        elapsed = run_threaded(gateway.base_url, conversations, 10, 5)
+        print(f"{'threads 10x5 + requests':>24} {elapsed:>9.2f} {len(conversations) / elapsed:>18.0f}")
+        # 网关替身只支持 HTTP/1.1，httpx 会退回 HTTP/1.1，此行仅反映 httpx 连接池本身的开销
+        for name, http2 in (('asyncio + aiohttp', False), ('asyncio + httpx', True)):
+            elapsed = asyncio.run(run_async(gateway.base_url, conversations, args.concurrency, args.max_connections, http2))
+            print(f"{name:>24} {elapsed:>9.2f} {len(conversations) / elapsed:>18.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+import sys
+import os
+import json
+import time
+import uuid
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+from contextlib import nullcontext
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_gateway import StubGateway
+
+# S3BackupManager 中写死的桶名与用户前缀
+BUCKET = 'flow-app-uploads-temp'
+BASE_PREFIX = 'app-user-messages/'
+
+# 与基线比较的指标：(阶段, 指标, 越大越好)；超出容差即视为退化
+CHECKS = (
+    ('ingest', 'rows_per_sec', True),
+    ('ingest', 'users_per_hour', True),
+    ('ingest', 'p99_user_s', False),
+    ('ingest', 'p99_commit_s', False),
+    ('migration', 'rows_per_sec', True),
+    ('migration', 'users_per_hour', True),
+    ('migration', 'p99_user_s', False),
+    ('migration', 'p99_request_s', False),
+    ('process', 'peak_rss_mb', False),
+)
+
+
+def user_message_counts(users: int, messages: int, skew: float, rng: random.Random) -> list:
+    """把 messages 条消息按 Zipf 分布分给 users 个用户：skew 为 0 时平均分配，越大越集中在少数用户上"""
+    weights = [1 / (rank + 1) ** skew for rank in range(users)]
+    rng.shuffle(weights)
+    total = sum(weights)
+    return [max(1, round(messages * weight / total)) for weight in weights]
+
+
+def synthetic_backup(user_id: str, count: int, conversations: int, content_size: int, rng: random.Random) -> bytes:
+    """一个用户的合成备份：count 条消息轮流分到 conversations 个会话，内容长度在 content_size 的 0.5~1.5 倍之间"""
+    conversations = max(1, min(conversations, count))
+    messages = [
+        {
+            'id': f'{user_id}-msg-{i}',
+            'promptId': 'bench-prompt',
+            'content': 'x' * rng.randint(content_size // 2, content_size * 3 // 2),
+            'createdAt': f'2024-01-{1 + i // 86400 % 28:02d}T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000Z',
+            'role': 'user' if i % 2 else 'assistant',
+            'type': 'text',
+            'conversationId': f'{user_id}-conv-{i % conversations}',
+        }
+        for i in range(count)
+    ]
+    return json.dumps(messages, separators=(',', ':')).encode()
+
+
+def upload_backups(s3_client, prefix: str, args) -> tuple:
+    """生成并上传所有用户的备份，返回 (用户ID列表, 消息总数)"""
+    rng = random.Random(args.seed)
+    counts = user_message_counts(args.users, args.messages, args.skew, rng)
+    user_ids = [f'{prefix}{index:05d}' for index in range(args.users)]
+    for user_id, count in zip(user_ids, counts):
+        body = synthetic_backup(user_id, count, args.conversations, args.content_size, rng)
+        s3_client.put_object(Bucket=BUCKET, Key=f'{BASE_PREFIX}{user_id}/1700000000.json', Body=body)
+    return user_ids, sum(counts)
+
+
+def quantiles(histogram, **labels) -> tuple:
+    return histogram.quantile(0.5, **labels), histogram.quantile(0.99, **labels)
+
+
+def run_ingest(args, expected_rows: int, prefix: str, download_dir: str) -> dict:
+    import metrics
+    from sqlalchemy import func, select
+    from models import Message
+    from s3Util import S3BackupManager
+
+    manager = S3BackupManager()
+    manager.download_base_dir = download_dir
+    messages_before = metrics.INGEST_MESSAGES.value(result='loaded')
+    start = time.perf_counter()
+    users = manager.process_all_backups(
+        pipeline=args.pipeline, stream_s3=args.stream_s3, parse_workers=args.parse_workers or None
+    )
+    elapsed = time.perf_counter() - start
+    archive_start = time.perf_counter()
+    manager.archive_worker.stop()
+    archive_elapsed = time.perf_counter() - archive_start
+
+    session = manager.db_manager.Session()
+    try:
+        stored = session.execute(
+            select(func.count()).select_from(Message).where(Message.userId.startswith(prefix))
+        ).scalar()
+    finally:
+        session.close()
+    p50_user, p99_user = quantiles(metrics.STAGE_SECONDS, stage='ingest')
+    p50_commit, p99_commit = quantiles(metrics.DB_BATCH_COMMIT_SECONDS)
+    p50_s3, p99_s3 = quantiles(metrics.S3_REQUEST_SECONDS)
+    return {
+        'users': users,
+        'rows': metrics.INGEST_MESSAGES.value(result='loaded') - messages_before,
+        'stored_rows': stored,
+        'expected_rows': expected_rows,
+        'seconds': elapsed,
+        'archive_drain_seconds': archive_elapsed,
+        'users_per_hour': users / elapsed * 3600,
+        'rows_per_sec': stored / elapsed,
+        # 串行模式下才有逐用户的耗时，流水线模式只统计批次与 S3 请求
+        'p50_user_s': p50_user,
+        'p99_user_s': p99_user,
+        'p50_commit_s': p50_commit,
+        'p99_commit_s': p99_commit,
+        'p50_s3_request_s': p50_s3,
+        'p99_s3_request_s': p99_s3,
+    }
+
+
+async def run_migration(args, gateway: StubGateway, user_ids: list, expected_rows: int) -> dict:
+    """用 AsyncMigrator 迁移本次生成的用户；不经过迁移队列，库中其他未迁移的用户不受影响"""
+    import metrics
+    from db_manager import DatabaseManager
+    from async_migrate import AsyncMigrator, required_connections
+    from async_conversation import AsyncConversationAPI
+    from gateway_limiter import AsyncAdaptiveLimiter, RetryPolicy
+
+    db = DatabaseManager(pool_size=required_connections(args.user_concurrency))
+    limiter = AsyncAdaptiveLimiter(rate=args.rate, concurrency=10, max_concurrency=args.max_connections) \
+        if args.rate else None
+    start = time.perf_counter()
+    async with AsyncConversationAPI(gateway.base_url, max_connections=args.max_connections, limiter=limiter,
+                                    retry_policy=RetryPolicy(retries=8, base_delay=0.05)) as api:
+        migrator = AsyncMigrator(db, api, concurrency=args.concurrency, user_concurrency=args.user_concurrency)
+        user_slots = asyncio.Semaphore(migrator.user_concurrency)
+
+        async def migrate(user_id):
+            async with user_slots:
+                with metrics.span('migrate_user'):
+                    await migrator.migrate_one_user(user_id)
+
+        outcomes = await asyncio.gather(*(migrate(user_id) for user_id in user_ids), return_exceptions=True)
+    elapsed = time.perf_counter() - start
+    users = sum(not isinstance(outcome, Exception) for outcome in outcomes)
+
+    p50_user, p99_user = quantiles(metrics.STAGE_SECONDS, stage='migrate_user')
+    p50_request, p99_request = quantiles(metrics.GATEWAY_REQUEST_SECONDS)
+    return {
+        'users': users,
+        'rows': gateway.messages_received,
+        'expected_rows': expected_rows,
+        'seconds': elapsed,
+        'requests': dict(gateway.requests),
+        'statuses': {str(status): count for status, count in gateway.statuses.items()},
+        'users_per_hour': users / elapsed * 3600,
+        'rows_per_sec': gateway.messages_received / elapsed,
+        'p50_user_s': p50_user,
+        'p99_user_s': p99_user,
+        'p50_request_s': p50_request,
+        'p99_request_s': p99_request,
+    }
+
+
+def peak_rss() -> dict:
+    """ru_maxrss 在 Linux 上以 KB 为单位；子进程只统计已结束的解析进程"""
+    return {
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'children_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """返回超出容差的退化项说明"""
+    regressions = []
+    for phase, name, higher_is_better in CHECKS:
+        current = results[phase].get(name)
+        expected = baseline[phase].get(name)
+        if current is None or not expected:
+            continue
+        change = (current - expected) / expected
+        if (change < -tolerance) if higher_is_better else (change > tolerance):
+            regressions.append(f"{phase}.{name}: {current:.4g}（基线 {expected:.4g}，{change:+.1%}）")
+    return regressions
+
+
+def format_value(value) -> str:
+    if value is None:
+        return '-'
+    return f'{value:.4g}' if isinstance(value, float) else str(value)
+
+
+def print_results(results: dict):
+    for phase in ('ingest', 'migration', 'process'):
+        print(f"[{phase}]")
+        for name, value in results[phase].items():
+            print(f"  {name:>22}: {format_value(value)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="端到端基准：合成备份 → S3（moto，设置 AWS_ENDPOINT_URL 时使用 MinIO 等真实端点）→ 导入数据库 "
+                    "（DB_URL，默认临时 SQLite；指定时请使用测试库）→ 迁移到本地网关替身；与基线比较，退化时以非零状态退出"
+    )
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=100000, help="所有用户的消息总数")
+    parser.add_argument('--conversations', type=int, default=20, help="每个用户的会话数")
+    parser.add_argument('--content-size', type=int, default=200, help="消息内容的平均长度（字节）")
+    parser.add_argument('--skew', type=float, default=1.0, help="消息数在用户间的 Zipf 指数，0 为平均分配")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--pipeline', action='store_true', help="使用 BackupPipeline 导入")
+    parser.add_argument('--stream-s3', action='store_true',
+                        help="从 S3 流式解析；与 --pipeline 同用时解析进程自建 S3 客户端，只能配合真实端点")
+    parser.add_argument('--parse-workers', type=int, default=0)
+    parser.add_argument('--gateway-latency', type=float, default=0.005, help="网关替身每个请求的延迟（秒）")
+    parser.add_argument('--gateway-error-rate', type=float, default=0.0, help="网关替身随机返回 503 的概率")
+    parser.add_argument('--gateway-batch', action='store_true', help="网关替身提供批量接口")
+    parser.add_argument('--concurrency', type=int, default=20, help="迁移时全局同时处理的会话组数")
+    parser.add_argument('--user-concurrency', type=int, default=10, help="同时迁移的用户数")
+    parser.add_argument('--max-connections', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0, help="网关限流器的初始速率，0 表示不限流")
+    parser.add_argument('--baseline', help="基线文件：不存在时写入本次结果，存在时与之比较")
+    parser.add_argument('--update-baseline', action='store_true', help="用本次结果覆盖基线")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="允许的相对退化幅度")
+    parser.add_argument('--output', help="把本次结果写入 JSON 文件")
+    args = parser.parse_args()
+    real_s3 = os.getenv('AWS_ENDPOINT_URL') or os.getenv('AWS_ENDPOINT_URL_S3')
+    if args.pipeline and args.stream_s3 and not real_s3:
+        parser.error("--pipeline 与 --stream-s3 同用时需要通过 AWS_ENDPOINT_URL 指定真实的 S3 端点")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # DatabaseManager 在创建时读取 DB_URL，须在导入项目模块前设置
+        os.environ.setdefault('DB_URL', f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        if not real_s3:
+            os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+            os.environ.setdefault('AWS_ACCESS_KEY_ID', 'bench')
+            os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'bench')
+            from moto import mock_aws
+        import boto3
+
+        # 用户ID带上本次运行的前缀，同一个数据库上多次运行互不影响
+        prefix = f'bench-{uuid.uuid4().hex[:8]}-'
+        with nullcontext() if real_s3 else mock_aws():
+            s3_client = boto3.client('s3')
+            try:
+                s3_client.create_bucket(Bucket=BUCKET)
+            except s3_client.exceptions.BucketAlreadyOwnedByYou:
+                pass
+            generate_start = time.perf_counter()
+            user_ids, expected_rows = upload_backups(s3_client, prefix, args)
+            print(f"生成并上传 {args.users} 个用户的备份，{expected_rows} 条消息，"
+                  f"{time.perf_counter() - generate_start:.1f}s")
+
+            results = {'config': vars(args).copy()}
+            for key in ('baseline', 'update_baseline', 'tolerance', 'output'):
+                results['config'].pop(key)
+            results['config']['db'] = os.environ['DB_URL'].split(':', 1)[0]
+            results['config']['s3'] = 'endpoint' if real_s3 else 'moto'
+            results['ingest'] = run_ingest(args, expected_rows, prefix, os.path.join(tmp, 'downloads'))
+
+        with StubGateway(latency=args.gateway_latency, error_rate=args.gateway_error_rate,
+                         batch=args.gateway_batch) as gateway:
+            results['migration'] = asyncio.run(run_migration(args, gateway, user_ids, expected_rows))
+        results['process'] = peak_rss()
+
+    print_results(results)
+    failures = []
+    for phase in ('ingest', 'migration'):
+        if results[phase]['expected_rows'] != results[phase].get('stored_rows', results[phase]['rows']):
+            failures.append(f"{phase} 的行数与生成的消息数不一致")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        if args.update_baseline or not os.path.exists(args.baseline):
+            with open(args.baseline, 'w', encoding='utf-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+            print(f"已写入基线 {args.baseline}")
+        else:
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+            if baseline['config'] != results['config']:
+                failures.append(f"基线的配置与本次不同，无法比较: {baseline['config']}")
+            else:
+                failures.extend(f"退化 {regression}" for regression in compare(results, baseline, args.tolerance))
+
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print("通过")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import sys
+import os
+import time
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from conversation import ConversationAPI
+from async_conversation import AsyncConversationAPI
+from gateway_limiter import AdaptiveLimiter, AsyncAdaptiveLimiter, RetryPolicy
+from stub_gateway import StubGateway
+from bench_conversation_clients import synthetic_conversations
+
+
+def run_threaded(base_url: str, conversations, workers: int, limiter):
+    api = ConversationAPI(base_url, pool_maxsize=workers, limiter=limiter, retry_policy=RetryPolicy(retries=8))
+
+    def process(conversation):
+        try:
+            resp = api.get_conversation_info(conversation["conversationId"])
+            if not resp.get('messages'):
+                api.update_conversation(conversation["conversationId"], conversation["messages"])
+            return True
+        except Exception:
+            return False
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return sum(executor.map(process, conversations))
+
+
+async def run_async(base_url: str, conversations, concurrency: int, limiter):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with AsyncConversationAPI(base_url, max_connections=concurrency, limiter=limiter,
+                                    retry_policy=RetryPolicy(retries=8)) as api:
+        async def process(conversation):
+            async with semaphore:
+                try:
+                    resp = await api.get_conversation_info(conversation["conversationId"])
+                    if not resp.get('messages'):
+                        await api.update_conversation(conversation["conversationId"], conversation["messages"])
+                    return True
+                except Exception:
+                    return False
+
+        return sum(await asyncio.gather(*(process(conversation) for conversation in conversations)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="自适应限流与重试在故障注入网关替身上的表现")
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--capacity', type=int, default=40, help="网关替身的并发容量，超过即返回 429")
+    parser.add_argument('--error-rate', type=float, default=0.02, help="网关替身随机返回 503 的概率")
+    parser.add_argument('--concurrency', type=int, default=200, help="客户端并发（线程数或协程数）")
+    args = parser.parse_args()
+
+    conversations = synthetic_conversations(args.conversations, 5)
+    variants = [
+        ('threads, retry only', False, None),
+        ('threads, AIMD + retry', False, AdaptiveLimiter(rate=50, concurrency=10, max_concurrency=50)),
+        ('asyncio, retry only', True, None),
+        ('asyncio, AIMD + retry', True, AsyncAdaptiveLimiter(rate=50, concurrency=10, max_concurrency=args.concurrency)),
+    ]
+
+    print(f"{'variant':>24} {'seconds':>8} {'conv/s':>7} {'ok':>6} {'429s':>6} {'503s':>5} "
+          f"{'peak':>5} {'dedup':>6} {'limit':>6}")
+    ok_all = True
+    for name, use_async, limiter in variants:
+        with StubGateway(latency=args.latency, capacity=args.capacity, error_rate=args.error_rate) as gateway:
+            start = time.perf_counter()
+            if use_async:
+                succeeded = asyncio.run(run_async(gateway.base_url, conversations, args.concurrency, limiter))
+            else:
+                succeeded = run_threaded(gateway.base_url, conversations, 50, limiter)
+            elapsed = time.perf_counter() - start
+            limit = limiter.snapshot()['concurrency'] if limiter else '-'
+            print(f"{name:>24} {elapsed:>8.2f} {succeeded / elapsed:>7.0f} {succeeded:>6} "
+                  f"{gateway.statuses[429]:>6} {gateway.statuses[503]:>5} {gateway.peak_in_flight:>5} "
+                  f"{gateway.deduplicated:>6} {limit:>6}")
+            # 每个成功的会话在网关上只应写入一次（重试由幂等键去重）
+            ok_all &= len(gateway.applied) >= succeeded
+
+    sys.exit(0 if ok_all else 1)
+
+
+if __name__ == "__main__":
+    main()
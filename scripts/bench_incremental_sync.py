@@ -0,0 +1,98 @@
+import sys
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from sqlalchemy import delete
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from models import Message, MigrationLedger, MigrationQueueUser, MigratedUser
+from async_conversation import AsyncConversationAPI
+from async_migrate import AsyncMigrator
+from stub_gateway import StubGateway
+
+BENCH_USER = 'bench-sync-user'
+
+
+def backup_messages(conversations: int, messages_per_conversation: int, day: int):
+    """第 day 天的完整备份：每个会话前 day 天每天 messages_per_conversation 条消息"""
+    return [
+        {
+            'id': f'bench-sync-{i}-{d}-{j}', 'promptId': 'p', 'content': 'x' * 200,
+            'createdAt': f'2024-01-{d + 1:02d}T00:00:{j:02d}Z', 'role': 'user', 'type': 'text',
+            'conversationId': f'bench-sync-conv-{i}'
+        }
+        for i in range(conversations) for d in range(day) for j in range(messages_per_conversation)
+    ]
+
+
+def cleanup(db: DatabaseManager):
+    with db.engine.begin() as conn:
+        conn.execute(delete(Message).where(Message.userId == BENCH_USER))
+        conn.execute(delete(MigrationLedger).where(MigrationLedger.user_id == BENCH_USER))
+        conn.execute(delete(MigrationQueueUser).where(MigrationQueueUser.user_id == BENCH_USER))
+        conn.execute(delete(MigratedUser).where(MigratedUser.user_id == BENCH_USER))
+
+
+def ingest(db: DatabaseManager, messages, incremental: bool):
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(messages, f)
+    try:
+        start = time.perf_counter()
+        stats = db.process_backup_file(f.name, BENCH_USER, incremental=incremental)
+        return time.perf_counter() - start, stats
+    finally:
+        os.unlink(f.name)
+
+
+async def migrate(db: DatabaseManager, base_url: str):
+    async with AsyncConversationAPI(base_url) as api:
+        start = time.perf_counter()
+        await AsyncMigrator(db, api).migrate_one_user(BENCH_USER)
+        db.complete_user_migration(BENCH_USER)
+        return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="每天一份新备份时，增量导入与增量迁移的开销（请使用测试库）")
+    parser.add_argument('--conversations', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=5, help="每个会话每天新增的消息数")
+    parser.add_argument('--days', type=int, default=5)
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    cleanup(db)
+    print(f"{'day':>4} {'ingest':>10} {'ingest s':>9} {'written':>8} {'skipped':>8} "
+          f"{'migrate s':>10} {'requests':>9} {'messages sent':>14} {'requeued':>9}")
+    with StubGateway(batch=True) as gateway:
+        for day in range(1, args.days + 1):
+            for incremental in ((False, True) if day > 1 else (False,)):
+                label = 'increment' if incremental else 'full'
+                if day > 1 and not incremental:
+                    # 对照组：完整重新导入，写库量随历史增长；之后删除今天的新消息，交给增量导入
+                    elapsed, stats = ingest(db, backup_messages(args.conversations, args.messages, day), False)
+                    print(f"{day:>4} {label:>10} {elapsed:>9.2f} {stats.inserted + stats.updated:>8} {stats.skipped:>8}")
+                    with db.engine.begin() as conn:
+                        conn.execute(delete(Message).where(
+                            Message.userId == BENCH_USER, Message.createdAt >= f'2024-01-{day:02d}'
+                        ))
+                    continue
+
+                elapsed, stats = ingest(db, backup_messages(args.conversations, args.messages, day), incremental)
+                requeued = db.enqueue_users_for_migration()
+                gateway.requests.clear()
+                messages_before = gateway.messages_received
+                migrate_elapsed = asyncio.run(migrate(db, gateway.base_url))
+                print(f"{day:>4} {label:>10} {elapsed:>9.2f} {stats.inserted + stats.updated:>8} {stats.skipped:>8} "
+                      f"{migrate_elapsed:>10.2f} {sum(gateway.requests.values()):>9} "
+                      f"{gateway.messages_received - messages_before:>14} {requeued:>9}")
+    cleanup(db)
+
+
+if __name__ == "__main__":
+    main()
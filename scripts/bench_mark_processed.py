@@ -0,0 +1,122 @@
+import sys
+import os
+import time
+import random
+import argparse
+from sqlalchemy import text
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from models import Message
+
+BENCH_USER_PREFIX = 'bench-mark-'
+
+
+def populate(db: DatabaseManager, rows: int, messages_per_conversation: int, conversations_per_user: int):
+    """用 generate_series 在服务端生成合成消息（仅 PostgreSQL），已存在则跳过"""
+    with db.engine.begin() as conn:
+        existing = conn.execute(
+            text('SELECT count(*) FROM messages WHERE "userId" LIKE :prefix'),
+            {'prefix': f'{BENCH_USER_PREFIX}%'}
+        ).scalar()
+        if existing >= rows:
+            print(f"已存在 {existing} 条合成消息，跳过生成")
+            return
+        print(f"生成 {rows} 条合成消息...")
+        conn.execute(text(
+            'INSERT INTO messages (id, "promptId", content, "createdAt", role, type, "conversationId", "userId", processed) '
+            "SELECT 'bench-mark-msg-' || g, 'p', 'x', lpad(g::text, 12, '0'), 'user', 'text', "
+            "'bench-mark-conv-' || (g / :mpc), :prefix || (g / (:mpc * :cpu)), false "
+            'FROM generate_series(1, :rows) AS g ON CONFLICT DO NOTHING'
+        ), {'rows': rows, 'mpc': messages_per_conversation, 'cpu': conversations_per_user, 'prefix': BENCH_USER_PREFIX})
+        conn.execute(text('ANALYZE messages'))
+
+
+def set_index(db: DatabaseManager, enabled: bool):
+    with db.engine.begin() as conn:
+        if enabled:
+            conn.execute(text('CREATE INDEX IF NOT EXISTS idx_conversation ON messages ("conversationId")'))
+        else:
+            conn.execute(text('DROP INDEX IF EXISTS idx_conversation'))
+
+
+def reset(db: DatabaseManager, conversation_ids):
+    with db.engine.begin() as conn:
+        conn.execute(
+            text('UPDATE messages SET processed = false WHERE "conversationId" = ANY(:ids)'),
+            {'ids': conversation_ids}
+        )
+
+
+def mark_row_by_row(db: DatabaseManager, conversation_id: str):
+    """改造前的实现：加载全部 ORM 对象后逐个修改"""
+    session = db.Session()
+    try:
+        for message in session.query(Message).filter(Message.conversationId == conversation_id).all():
+            message.processed = True
+        session.commit()
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="mark_conversation_as_processed 改造前后耗时对比（仅 PostgreSQL，请使用测试库）")
+    parser.add_argument('--rows', type=int, default=100_000_000)
+    parser.add_argument('--messages-per-conversation', type=int, default=20)
+    parser.add_argument('--conversations-per-user', type=int, default=50)
+    parser.add_argument('--sample', type=int, default=200, help="参与计时的会话数")
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    if db.engine.dialect.name != 'postgresql':
+        print("该基准测试仅支持 PostgreSQL")
+        sys.exit(1)
+
+    populate(db, args.rows, args.messages_per_conversation, args.conversations_per_user)
+    total_conversations = args.rows // args.messages_per_conversation
+    conversation_ids = [f'bench-mark-conv-{random.randrange(total_conversations)}' for _ in range(args.sample)]
+
+    # 分区表上按用户调用：只更新一个分区并使用 (userId, conversationId) 索引
+    by_user = {}
+    for conversation_id in conversation_ids:
+        conversation = int(conversation_id.rsplit('-', 1)[1])
+        by_user.setdefault(f'{BENCH_USER_PREFIX}{conversation // args.conversations_per_user}', []).append(conversation_id)
+    user_of = {conversation_id: user_id for user_id, ids in by_user.items() for conversation_id in ids}
+
+    print(f"{'variant':>28} {'seconds':>10} {'ms/conversation':>16}")
+
+    set_index(db, False)
+    reset(db, conversation_ids)
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        mark_row_by_row(db, conversation_id)
+    elapsed = time.perf_counter() - start
+    print(f"{'before: ORM, no index':>28} {elapsed:>10.2f} {elapsed * 1000 / len(conversation_ids):>16.2f}")
+
+    set_index(db, True)
+    reset(db, conversation_ids)
+    start = time.perf_counter()
+    for conversation_id in conversation_ids:
+        db.mark_conversation_as_processed(conversation_id, user_of[conversation_id])
+    elapsed = time.perf_counter() - start
+    print(f"{'after: UPDATE per conv':>28} {elapsed:>10.2f} {elapsed * 1000 / len(conversation_ids):>16.2f}")
+
+    reset(db, conversation_ids)
+    start = time.perf_counter()
+    for user_id, ids in by_user.items():
+        db.mark_conversations_as_processed(ids, user_id)
+    elapsed = time.perf_counter() - start
+    print(f"{'after: UPDATE ANY(ids)/user':>28} {elapsed:>10.2f} {elapsed * 1000 / len(conversation_ids):>16.2f}")
+
+    # 分区表上去掉了 idx_conversation，只靠 (userId, conversationId) 索引
+    set_index(db, False)
+    reset(db, conversation_ids)
+    start = time.perf_counter()
+    for user_id, ids in by_user.items():
+        db.mark_conversations_as_processed(ids, user_id)
+    elapsed = time.perf_counter() - start
+    print(f"{'partitioned: no idx':>28} {elapsed:>10.2f} {elapsed * 1000 / len(conversation_ids):>16.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+import sys
+import os
+import time
+import uuid
+import argparse
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from message_loader import create_message_loader
+
+
+def synthetic_rows(count: int, user_id: str, content_size: int):
+    content = 'x' * content_size
+    return [
+        (str(uuid.uuid4()), 'bench-prompt', content, f'2024-01-01T00:00:{i % 60:02d}.000Z',
+         'user', 'text', f'bench-conv-{i // 50}', user_id)
+        for i in range(count)
+    ]
+
+
+def run_loader(db: DatabaseManager, name: str, rows, batch_size: int) -> float:
+    message_loader = create_message_loader(db.engine, name)
+    session = db.Session()
+    try:
+        start = time.perf_counter()
+        for i in range(0, len(rows), batch_size):
+            message_loader.load(session, rows[i:i + batch_size])
+            session.commit()
+        return time.perf_counter() - start
+    finally:
+        session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="INSERT ... ON CONFLICT 与 COPY 写入方式的吞吐对比（连接配置同 DatabaseManager）")
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--content-size', type=int, default=200)
+    parser.add_argument('--loaders', default=None, help="逗号分隔，默认 PostgreSQL 上为 upsert,copy，其余为 upsert")
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    loaders = args.loaders or ('upsert,copy' if db.engine.dialect.name == 'postgresql' else 'upsert')
+
+    print(f"{'loader':>8} {'rows':>10} {'seconds':>9} {'rows/sec':>12}")
+    for name in loaders.split(','):
+        # 每种方式写入不同用户的新数据，避免互相命中主键冲突
+        rows = synthetic_rows(args.rows, f'bench-{name}-{uuid.uuid4()}', args.content_size)
+        elapsed = run_loader(db, name, rows, args.batch_size)
+        print(f"{name:>8} {len(rows):>10} {elapsed:>9.2f} {len(rows) / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+import sys
+import os
+import gc
+import json
+import time
+import hashlib
+import argparse
+import tracemalloc
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from message_record import MessageRecord
+from conversation import content_hash
+
+FIELDS = ('id', 'promptId', 'content', 'createdAt', 'role', 'type', 'conversationId')
+
+
+def source_rows(count: int):
+    """数据库读出的行；字段字符串预先生成，下面只统计每条消息外层容器的开销"""
+    return [
+        (f'msg-{i}', 'prompt', f'content-{i}', f'2024-01-01T00:00:{i % 60:02d}Z', 'user', 'text', f'conv-{i // 20}', 'u')
+        for i in range(count)
+    ]
+
+
+def build_dicts(rows):
+    """改造前：dict(row._mapping)，再由 convert_format 包一层 {"messageId", "messageData"}"""
+    return [{"messageId": row[0], "messageData": dict(zip(FIELDS, row))} for row in rows]
+
+
+def build_records(rows):
+    return [MessageRecord._make(row) for row in rows]
+
+
+def measure(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    messages = build(rows)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return messages, current, elapsed
+
+
+def content_hash_dicts(messages):
+    """改造前的 content_hash：直接序列化网关格式的 dict"""
+    digest = hashlib.sha1(b'')
+    digest.update(json.dumps(messages, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode())
+    return digest.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="迁移热路径上每百万条消息的内存占用：dict 包装与 MessageRecord 对比")
+    parser.add_argument('--count', type=int, default=1000000)
+    args = parser.parse_args()
+
+    rows = source_rows(args.count)
+    scale = 1e6 / args.count
+    print(f"{'representation':>16} {'MB / 1M msgs':>13} {'bytes/msg':>10} {'build s':>8}")
+    hashes = []
+    for name, build, hash_messages in (('dict + wrapper', build_dicts, content_hash_dicts),
+                                       ('MessageRecord', build_records, content_hash)):
+        messages, allocated, elapsed = measure(build, rows)
+        print(f"{name:>16} {allocated * scale / 1e6:>13.1f} {allocated / args.count:>10.0f} {elapsed:>8.2f}")
+        hashes.append(hash_messages(messages[:10000]))
+        del messages
+    # 台账中已有的链式哈希必须延续，两种表示算出的哈希应相同
+    print(f"content_hash 与改造前一致: {hashes[0] == hashes[1]}")
+
+
+if __name__ == "__main__":
+    main()
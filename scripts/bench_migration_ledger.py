@@ -0,0 +1,104 @@
+import sys
+import json
+import os
+import asyncio
+import argparse
+from sqlalchemy import delete, text
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from models import Message, MigrationLedger
+from async_conversation import AsyncConversationAPI
+from async_migrate import AsyncMigrator
+from stub_gateway import StubGateway
+
+BENCH_USER = 'bench-ledger-user'
+
+
+class _ExistingAwareGateway(StubGateway):
+    """/info 与 /batchInfo 对已写入过的会话返回非空消息，模拟真实网关"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stored = set()
+
+    def handle(self, path, body, key=None):
+        payload = json.loads(body)
+        if path.endswith('/info'):
+            return 200, {"messages": [{}] if payload["businessId"] in self.stored else []}
+        if path.endswith('/batchInfo') and self.batch:
+            return 200, {"results": {
+                business_id: {"messages": [{}] if business_id in self.stored else []}
+                for business_id in payload["businessIds"]
+            }}
+        status, result = super().handle(path, body, key)
+        if status == 200:
+            with self._lock:
+                for conversation in payload.get("conversations", [payload]):
+                    self.stored.add(conversation["businessId"])
+        return status, result
+
+
+def populate(db: DatabaseManager, conversations: int, messages_per_conversation: int):
+    with db.engine.begin() as conn:
+        conn.execute(delete(Message).where(Message.userId == BENCH_USER))
+        conn.execute(delete(MigrationLedger).where(MigrationLedger.user_id == BENCH_USER))
+        conn.execute(Message.__table__.insert(), [
+            {
+                'id': f'bench-ledger-{i}-{j}', 'promptId': 'p', 'content': 'x' * 100, 'createdAt': f'{j:06d}',
+                'role': 'user', 'type': 'text', 'conversationId': f'bench-ledger-conv-{i}', 'userId': BENCH_USER,
+                'processed': False
+            }
+            for i in range(conversations) for j in range(messages_per_conversation)
+        ])
+
+
+def reset_processed(db: DatabaseManager):
+    """模拟崩溃：会话已推送但尚未来得及标记为已处理"""
+    with db.engine.begin() as conn:
+        conn.execute(text('UPDATE messages SET processed = false WHERE "userId" = :user_id'), {'user_id': BENCH_USER})
+
+
+async def migrate(db: DatabaseManager, base_url: str, batch_api: bool):
+    async with AsyncConversationAPI(base_url) as api:
+        if not batch_api:
+            api.batch_supported = False
+        await AsyncMigrator(db, api).migrate_one_user(BENCH_USER)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="崩溃后重跑时，有无迁移台账的网关请求数对比（请使用测试库）")
+    parser.add_argument('--conversations', type=int, default=5000)
+    parser.add_argument('--messages', type=int, default=3, help="每个会话的消息数")
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    populate(db, args.conversations, args.messages)
+
+    print(f"{'gateway API':>16} {'rerun':>14} {'requests':>9} {'wire MB':>8}")
+    for batch_api in (False, True):
+        with _ExistingAwareGateway(batch=batch_api) as gateway:
+            with db.engine.begin() as conn:
+                conn.execute(delete(MigrationLedger).where(MigrationLedger.user_id == BENCH_USER))
+            asyncio.run(migrate(db, gateway.base_url, batch_api))
+
+            for variant, keep_ledger in (('with ledger', True), ('without ledger', False)):
+                reset_processed(db)
+                if not keep_ledger:
+                    with db.engine.begin() as conn:
+                        conn.execute(delete(MigrationLedger).where(MigrationLedger.user_id == BENCH_USER))
+                gateway.requests.clear()
+                gateway.bytes_received = 0
+                asyncio.run(migrate(db, gateway.base_url, batch_api))
+                print(f"{'batch' if batch_api else 'per conversation':>16} {variant:>14} "
+                      f"{sum(gateway.requests.values()):>9} {gateway.bytes_received / 1e6:>8.2f}")
+
+    with db.engine.begin() as conn:
+        conn.execute(delete(Message).where(Message.userId == BENCH_USER))
+        conn.execute(delete(MigrationLedger).where(MigrationLedger.user_id == BENCH_USER))
+
+
+if __name__ == "__main__":
+    main()
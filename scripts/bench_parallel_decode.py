@@ -0,0 +1,85 @@
+import sys
+import os
+import time
+import argparse
+import tempfile
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_streaming_ingest import generate_backup
+from json_stream import iter_json_array, iter_batches
+from message_loader import message_row, to_copy_text
+from parallel_decode import ParallelDecoder, orjson
+from db_manager import DatabaseManager
+
+BENCH_USER = 'bench-decode-user'
+
+
+def decode_single(path: str, batch_size: int, copy_text: bool) -> int:
+    """改造前：当前线程内 iter_json_array + message_row（+ COPY 序列化）"""
+    rows = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for batch in iter_batches(iter_json_array(f), batch_size):
+            batch_rows = [message_row(message, BENCH_USER) for message in batch]
+            if copy_text:
+                to_copy_text(batch_rows)
+            rows += len(batch_rows)
+    return rows
+
+
+def decode_parallel(decoder: ParallelDecoder, path: str, batch_size: int, copy_text: bool) -> int:
+    return sum(len(batch) for batch, _, _, _ in decoder.iter_batches(path, BENCH_USER, batch_size, copy_text=copy_text))
+
+
+def ingest(path: str, decoder: ParallelDecoder = None) -> float:
+    db = DatabaseManager()
+    start = time.perf_counter()
+    db.process_backup_file(path, BENCH_USER, decoder=decoder)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="单线程解析与进程池分块解析（orjson）的吞吐对比")
+    parser.add_argument('--count', type=int, default=500000)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--chunk-mb', type=int, default=8)
+    parser.add_argument('--copy-text', action='store_true', help="同时序列化为 COPY 文本（PostgreSQL 写入路径）")
+    parser.add_argument('--db', action='store_true', help="再对比完整的 process_backup_file 写库耗时（请使用测试库）")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'backup.json')
+        generate_backup(path, args.count)
+        size_mb = os.path.getsize(path) / 1e6
+        print(f"备份 {args.count} 条消息, {size_mb:.1f} MB, CPU 核数 {os.cpu_count()}, "
+              f"解析器 {'orjson' if orjson else 'json'}")
+        # main cpu：主进程自身的 CPU 时间。多核机器上解析进程并行运行，主进程的 CPU 时间决定吞吐上限
+        print(f"{'mode':>12} {'seconds':>8} {'MB/s':>8} {'rows/s':>10} {'main cpu':>9}")
+
+        start, cpu_start = time.perf_counter(), time.process_time()
+        rows = decode_single(path, 5000, args.copy_text)
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        print(f"{'single':>12} {elapsed:>8.2f} {size_mb / elapsed:>8.1f} {rows / elapsed:>10.0f} {cpu:>9.2f}")
+
+        for workers in args.workers:
+            with ParallelDecoder(workers, args.chunk_mb << 20) as decoder:
+                decode_parallel(decoder, path, 5000, args.copy_text)  # 预热：启动进程池
+                start, cpu_start = time.perf_counter(), time.process_time()
+                rows = decode_parallel(decoder, path, 5000, args.copy_text)
+                elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+            print(f"{f'pool x{workers}':>12} {elapsed:>8.2f} {size_mb / elapsed:>8.1f} {rows / elapsed:>10.0f} "
+                  f"{cpu:>9.2f}")
+
+        if args.db:
+            # 每次导入同一批 id：第一次为新增，之后都是“重复”路径，因此先跑一次预热
+            print(f"{'ingest':>12} {'seconds':>8}")
+            ingest(path)
+            print(f"{'single':>12} {ingest(path):>8.2f}")
+            with ParallelDecoder(args.workers[-1], args.chunk_mb << 20) as decoder:
+                decode_parallel(decoder, path, 5000, False)  # 预热：启动进程池
+                print(f"{f'pool x{args.workers[-1]}':>12} {ingest(path, decoder):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+import sys
+import os
+import time
+import uuid
+import argparse
+import tempfile
+import multiprocessing
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench_streaming_ingest import generate_backup
+from db_manager import DatabaseManager
+
+
+def _ingest(path: str, user_id: str, key: str, batch_size: int):
+    db = DatabaseManager()
+    db.process_backup_file(path, user_id, batch_size=batch_size, checkpoint=db.get_ingest_checkpoint(key))
+
+
+def interrupt(path: str, user_id: str, key: str, batch_size: int, count: int, fraction: float) -> int:
+    """在子进程中导入，检查点达到 fraction 后直接杀掉子进程，模拟 pod 重启；返回已提交的消息数"""
+    db = DatabaseManager()
+    proc = multiprocessing.Process(target=_ingest, args=(path, user_id, key, batch_size))
+    proc.start()
+    try:
+        while proc.is_alive():
+            records = db.get_ingest_checkpoint(key).position.records
+            if records >= count * fraction:
+                break
+            time.sleep(0.05)
+    finally:
+        proc.kill()
+        proc.join()
+    return db.get_ingest_checkpoint(key).position.records
+
+
+def timed(fn) -> float:
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="导入中途中断后的恢复耗时：从检查点续做与从头重新导入对比（请使用测试库）")
+    parser.add_argument('--count', type=int, default=500000)
+    parser.add_argument('--fractions', type=float, nargs='+', default=[0.5, 0.9])
+    parser.add_argument('--batch-size', type=int, default=5000)
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'backup.json')
+        generate_backup(path, args.count)
+        print(f"备份 {args.count} 条消息, {os.path.getsize(path) / 1e6:.1f} MB")
+        print(f"{'interrupted at':>15} {'committed':>10} {'restart s':>10} {'resume s':>9}")
+        for fraction in args.fractions:
+            user_id = f'bench-resume-{uuid.uuid4()}'
+            key = f'bench/{user_id}.json'
+            committed = interrupt(path, user_id, key, args.batch_size, args.count, fraction)
+            # 改造前：没有检查点，重启后从第 1 条消息重新导入（已提交的部分全部走重复路径）
+            restart = timed(lambda: db.process_backup_file(path, user_id, batch_size=args.batch_size))
+            # 改造后：另一个用户同样中断后从检查点续做，只导入剩余部分
+            user_id = f'bench-resume-{uuid.uuid4()}'
+            key = f'bench/{user_id}.json'
+            committed = interrupt(path, user_id, key, args.batch_size, args.count, fraction)
+            resume = timed(lambda: db.process_backup_file(
+                path, user_id, batch_size=args.batch_size, checkpoint=db.get_ingest_checkpoint(key)
+            ))
+            print(f"{fraction:>15.0%} {committed:>10} {restart:>10.2f} {resume:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
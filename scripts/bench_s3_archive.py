@@ -0,0 +1,100 @@
+import sys
+import os
+import time
+import argparse
+import boto3
+from moto import mock_aws
+from boto3.s3.transfer import TransferConfig
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from s3_archiver import S3Archiver
+
+BENCH_BUCKET = 'bench-archive'
+SOURCE_PREFIX = 'app-user-messages/bench-user/'
+DESTINATION_PREFIX = 'processed-backups/bench-user/'
+
+
+def move_serial(s3_client, keys):
+    """改造前的 move_user_directory：逐个 copy_object + delete_object"""
+    for key in keys:
+        s3_client.copy_object(
+            Bucket=BENCH_BUCKET,
+            CopySource={'Bucket': BENCH_BUCKET, 'Key': key},
+            Key=f"{DESTINATION_PREFIX}{os.path.basename(key)}"
+        )
+        s3_client.delete_object(Bucket=BENCH_BUCKET, Key=key)
+
+
+def reset(s3_client, files: int, size: int):
+    for prefix in (SOURCE_PREFIX, DESTINATION_PREFIX):
+        keys = [obj['Key'] for obj in s3_client.list_objects_v2(Bucket=BENCH_BUCKET, Prefix=prefix).get('Contents', [])]
+        for key in keys:
+            s3_client.delete_object(Bucket=BENCH_BUCKET, Key=key)
+    body = b'x' * size
+    keys = [f"{SOURCE_PREFIX}{1700000000 + i}.json" for i in range(files)]
+    for key in keys:
+        s3_client.put_object(Bucket=BENCH_BUCKET, Key=key, Body=body)
+    return keys
+
+
+def count(s3_client, prefix: str) -> int:
+    return s3_client.list_objects_v2(Bucket=BENCH_BUCKET, Prefix=prefix).get('KeyCount', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="逐个复制删除与并发复制 + 批量删除的 S3 移动耗时对比（moto 模拟 S3）")
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=64 * 1024, help="每个文件的字节数")
+    parser.add_argument('--latency', type=float, default=0.02, help="模拟每个 S3 请求的往返延迟（秒）")
+    parser.add_argument('--large-mb', type=int, default=12, help="分段复制验证用的大对象大小（MB）")
+    args = parser.parse_args()
+
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BENCH_BUCKET)
+        requests = []
+
+        def on_call(**kwargs):
+            requests.append(kwargs['model'].name)
+            time.sleep(args.latency)
+        s3_client.meta.events.register('before-call.s3', on_call)
+
+        print(f"{'mode':>10} {'seconds':>8} {'requests':>9} {'moved':>6} {'left':>5}")
+        for mode in ('serial', 'archiver'):
+            keys = reset(s3_client, args.files, args.size)
+            requests.clear()
+            start = time.perf_counter()
+            if mode == 'serial':
+                move_serial(s3_client, keys)
+            else:
+                S3Archiver(s3_client, BENCH_BUCKET).move_prefix(SOURCE_PREFIX, DESTINATION_PREFIX)
+            elapsed = time.perf_counter() - start
+            print(f"{mode:>10} {elapsed:>8.2f} {len(requests):>9} {count(s3_client, DESTINATION_PREFIX):>6} "
+                  f"{count(s3_client, SOURCE_PREFIX):>5}")
+
+        # 中断续做：一半文件已复制、其中一部分源文件也已删除
+        keys = reset(s3_client, args.files, args.size)
+        for key in keys[:args.files // 2]:
+            s3_client.copy_object(Bucket=BENCH_BUCKET, CopySource={'Bucket': BENCH_BUCKET, 'Key': key},
+                                  Key=f"{DESTINATION_PREFIX}{os.path.basename(key)}")
+        for key in keys[:args.files // 4]:
+            s3_client.delete_object(Bucket=BENCH_BUCKET, Key=key)
+        requests.clear()
+        moved = S3Archiver(s3_client, BENCH_BUCKET).move_prefix(SOURCE_PREFIX, DESTINATION_PREFIX)
+        print(f"resume: 剩余 {moved} 个源文件, 复制请求 {requests.count('CopyObject')} 次, "
+              f"目标 {count(s3_client, DESTINATION_PREFIX)} 个, 源 {count(s3_client, SOURCE_PREFIX)} 个")
+
+        # 分段复制：阈值调小到 5 MB，模拟超过 5 GB 单次复制上限的对象
+        reset(s3_client, 0, 0)
+        s3_client.put_object(Bucket=BENCH_BUCKET, Key=f"{SOURCE_PREFIX}large.json", Body=b'y' * (args.large_mb << 20))
+        requests.clear()
+        config = TransferConfig(multipart_threshold=5 << 20, multipart_chunksize=5 << 20)
+        S3Archiver(s3_client, BENCH_BUCKET, transfer_config=config).move_prefix(SOURCE_PREFIX, DESTINATION_PREFIX)
+        head = s3_client.head_object(Bucket=BENCH_BUCKET, Key=f"{DESTINATION_PREFIX}large.json")
+        print(f"multipart: UploadPartCopy {requests.count('UploadPartCopy')} 次, "
+              f"目标大小 {head['ContentLength']} 字节, 源 {count(s3_client, SOURCE_PREFIX)} 个")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import sys
+import os
+import gzip
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import boto3
+from moto import mock_aws
+from sqlalchemy import delete
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db_manager import DatabaseManager
+from models import Message
+from s3_stream import S3BackupStream
+
+BENCH_BUCKET = 'bench-backups'
+BENCH_USER = 'bench-stream-user'
+
+
+def backup_body(messages: int) -> bytes:
+    return json.dumps([
+        {
+            'id': f'bench-stream-{i}', 'promptId': 'p', 'content': 'x' * 200,
+            'createdAt': f'2024-01-01T00:00:{i % 60:02d}Z', 'role': 'user', 'type': 'text',
+            'conversationId': f'bench-stream-conv-{i // 20}'
+        }
+        for i in range(messages)
+    ]).encode('utf-8')
+
+
+def cleanup(db: DatabaseManager):
+    with db.engine.begin() as conn:
+        conn.execute(delete(Message).where(Message.userId == BENCH_USER))
+
+
+def run_download(db: DatabaseManager, s3_client, key: str):
+    """改造前：download_file 到临时目录，解析后删除"""
+    download_dir = tempfile.mkdtemp(prefix='bench-stream-')
+    try:
+        download_path = os.path.join(download_dir, os.path.basename(key))
+        s3_client.download_file(BENCH_BUCKET, key, download_path)
+        disk_bytes = os.path.getsize(download_path)
+        return db.process_backup_file(download_path, BENCH_USER), disk_bytes
+    finally:
+        shutil.rmtree(download_dir)
+
+
+def run_stream(db: DatabaseManager, s3_client, key: str):
+    """S3BackupStream：分段并发下载，边下载边解析"""
+    with S3BackupStream(s3_client, BENCH_BUCKET, key) as backup:
+        return db.process_backup_stream(backup, BENCH_USER), 0
+
+
+def measure(run, db, s3_client, key):
+    cleanup(db)
+    tracemalloc.start()
+    start = time.perf_counter()
+    stats, disk_bytes = run(db, s3_client, key)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, disk_bytes, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="下载到临时文件再解析与直接从 S3 流式解析的耗时、内存、磁盘占用对比"
+                                                 "（moto 模拟 S3，请使用测试库）")
+    parser.add_argument('--messages', type=int, default=100000)
+    args = parser.parse_args()
+
+    db = DatabaseManager()
+    body = backup_body(args.messages)
+    objects = {'plain': ('backup.json', body), 'gzip': ('backup.json.gz', gzip.compress(body))}
+
+    with mock_aws():
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BENCH_BUCKET)
+        for key, data in objects.values():
+            s3_client.put_object(Bucket=BENCH_BUCKET, Key=key, Body=data)
+
+        # gzip 对象的 download 模式同样由 LocalBackupFile 解压
+        results = []
+        for label, (key, data) in objects.items():
+            for mode, run in (('download', run_download), ('stream', run_stream)):
+                results.append((label, len(data), mode) + measure(run, db, s3_client, key))
+
+    cleanup(db)
+    print(f"{'object':>7} {'size MB':>8} {'mode':>9} {'seconds':>8} {'peak MB':>8} {'disk MB':>8} {'written':>8}")
+    for label, size, mode, elapsed, peak, disk_bytes, stats in results:
+        written = stats.inserted + stats.updated if stats else 'failed'
+        print(f"{label:>7} {size / 1e6:>8.2f} {mode:>9} {elapsed:>8.2f} {peak / 1e6:>8.1f} "
+              f"{disk_bytes / 1e6:>8.2f} {written:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import sys
+import os
+import json
+import time
+import uuid
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+# 添加父目录到Python路径以导入项目模块
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from json_stream import iter_json_array, iter_batches
+
+
+def generate_backup(path: str, count: int, content_size: int = 200):
+    """生成包含 count 条消息的合成备份文件（逐条写出，不占用大量内存）"""
+    content = 'x' * content_size
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('[')
+        for i in range(count):
+            if i:
+                f.write(',')
+            json.dump({
+                'id': str(uuid.uuid4()),
+                'promptId': 'bench-prompt',
+                'content': content,
+                'createdAt': f'2024-01-01T00:00:{i % 60:02d}.000Z',
+                'role': 'user' if i % 2 else 'assistant',
+                'type': 'text',
+                'conversationId': f'bench-conv-{i // 50}',
+            }, f)
+        f.write(']')
+
+
+def _run(mode: str, path: str, count: int, batch_size: int, result):
+    start = time.perf_counter()
+    rows = 0
+    if mode == 'db':
+        from db_manager import DatabaseManager
+        db = DatabaseManager()
+        db.process_backup_file(path, f'bench-{uuid.uuid4()}', batch_size=batch_size)
+        rows = count
+    else:
+        with open(path, 'r', encoding='utf-8') as f:
+            messages = iter_json_array(f) if mode == 'stream' else json.load(f)
+            for batch in iter_batches(messages, batch_size):
+                rows += len(batch)
+    elapsed = time.perf_counter() - start
+    # Linux 下 ru_maxrss 单位为 KB
+    result.put((rows, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(mode: str, path: str, count: int, batch_size: int):
+    """在独立子进程中运行，保证峰值 RSS 互不影响"""
+    result = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run, args=(mode, path, count, batch_size, result))
+    proc.start()
+    rows, elapsed, peak_mb = result.get()
+    proc.join()
+    return rows, elapsed, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式解析与 json.load 的内存/吞吐对比")
+    parser.add_argument('--sizes', default='100000,1000000,10000000', help="逗号分隔的消息条数")
+    parser.add_argument('--modes', default='load,stream', help="load / stream / db（db 需配置 DB_URL 或 DB_* 环境变量）")
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--content-size', type=int, default=200)
+    parser.add_argument('--workdir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    print(f"{'messages':>10} {'mode':>8} {'MB':>9} {'peak RSS MB':>12} {'rows/sec':>12}")
+    for count in [int(s) for s in args.sizes.split(',')]:
+        path = os.path.join(args.workdir, f'bench_backup_{count}.json')
+        if not os.path.exists(path):
+            generate_backup(path, count, args.content_size)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+        for mode in args.modes.split(','):
+            rows, elapsed, peak_mb = measure(mode, path, count, args.batch_size)
+            print(f"{count:>10} {mode:>8} {size_mb:>9.1f} {peak_mb:>12.1f} {rows / elapsed:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+import json
+import gzip
+import time
+import random
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # 默认 backlog 只有 5，高并发建连时会被拒绝
+    request_queue_size = 1024
+
+
+class StubGateway:
+    """本地会话网关替身，用于基准测试
+
+    /info 始终返回空消息列表（即网关上没有该会话），/update 返回成功。
+    可配置每个请求的固定延迟；requests 记录各接口的请求次数。
+
+    故障注入：
+    - capacity：同时处理的请求超过该值时直接返回 429（带 Retry-After），模拟网关容量上限；
+      超过 capacity 的一半后延迟随负载线性增长
+    - error_rate：按该概率返回 503，其中一半在已经写入之后才返回，模拟响应丢失
+    /update 按 Idempotency-Key 去重，重复写入计入 deduplicated，statuses 记录各状态码的次数。
+
+    batch=True 时提供 /batchInfo 与 /batchUpdate，否则这两个接口返回 404；
+    accept_gzip=False 时对压缩的请求体返回 415。bytes_received 为线上（压缩后）字节数。
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency: float = 0.0,
+                 capacity: int = 0, error_rate: float = 0.0, batch: bool = False, accept_gzip: bool = True):
+        self.latency = latency
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.batch = batch
+        self.accept_gzip = accept_gzip
+        self.requests = Counter()
+        self.messages_received = 0
+        self.statuses = Counter()
+        self.bytes_received = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.applied = {}
+        self.deduplicated = 0
+        self._lock = threading.Lock()
+        self.server = _Server((host, port), self._handler_class())
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def handle(self, path: str, body: bytes, key=None):
+        """返回 (状态码, 响应对象)"""
+        if path.endswith('/info'):
+            return 200, {"messages": []}
+        if self.batch and path.endswith('/batchInfo'):
+            return 200, {"results": {business_id: {"messages": []} for business_id in json.loads(body)["businessIds"]}}
+        if path.endswith('/update') or (self.batch and path.endswith('/batchUpdate')):
+            payload = json.loads(body)
+            conversations = payload.get("conversations", [payload])
+            count = sum(len(conversation.get("messages", [])) for conversation in conversations)
+            result = {"success": True, "count": count}
+            if key is not None:
+                with self._lock:
+                    if key in self.applied:
+                        self.deduplicated += 1
+                        return 200, self.applied[key]
+                    self.applied[key] = result
+            with self._lock:
+                self.messages_received += count
+            return 200, result
+        return 404, {"error": "not found"}
+
+    def _serve(self, path: str, body: bytes, key=None):
+        """在 handle 外层注入过载与故障，返回 (状态码, 响应对象, 额外响应头)"""
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            load = self.in_flight
+        try:
+            if self.capacity and load > self.capacity:
+                return 429, {"error": "too many requests"}, {'Retry-After': '0.1'}
+            latency = self.latency
+            if self.capacity and load > self.capacity / 2:
+                latency *= 2 * load / self.capacity
+            if latency:
+                time.sleep(latency)
+            if self.error_rate and random.random() < self.error_rate:
+                if random.random() < 0.5:
+                    self.handle(path, body, key)
+                return 503, {"error": "service unavailable"}, {}
+            status, result = self.handle(path, body, key)
+            return status, result, {}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def _handler_class(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # 响应头与响应体分两次写出，关闭 Nagle 避免与客户端的延迟 ACK 叠加出 40ms 停顿
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                path = self.path.rstrip('/')
+                with gateway._lock:
+                    gateway.requests[path.rsplit('/', 1)[-1]] += 1
+                    gateway.bytes_received += len(body)
+                compressed = self.headers.get('Content-Encoding') == 'gzip'
+                if compressed and not gateway.accept_gzip:
+                    status, result, headers = 415, {"error": "unsupported content encoding"}, {}
+                else:
+                    if compressed:
+                        body = gzip.decompress(body)
+                    status, result, headers = gateway._serve(path, body, self.headers.get('Idempotency-Key'))
+                with gateway._lock:
+                    gateway.statuses[status] += 1
+                data = json.dumps(result).encode()
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地会话网关替身")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help="每个请求的延迟（秒）")
+    parser.add_argument('--capacity', type=int, default=0, help="并发请求超过该值时返回 429，0 表示不限")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="随机返回 503 的概率")
+    parser.add_argument('--batch', action='store_true', help="提供批量接口")
+    parser.add_argument('--no-gzip', action='store_true', help="拒绝压缩的请求体")
+    args = parser.parse_args()
+
+    gateway = StubGateway(args.host, args.port, args.latency, args.capacity, args.error_rate,
+                          batch=args.batch, accept_gzip=not args.no_gzip)
+    print(f"Stub gateway listening on {gateway.base_url}")
+    try:
+        gateway.server.serve_forever()
+    except KeyboardInterrupt:
+        gateway.server.server_close()
+
+
+if __name__ == "__main__":
+    main()